@@ -0,0 +1,116 @@
+import asyncio
+from concurrent.futures import Executor
+from typing import List
+from database import check_factor_options
+from main import DiagnosisDetector
+from utils import metrics
+from utils.batching import AsyncMicroBatcher, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT, DEFAULT_MAX_PENDING
+
+
+class AsyncDiagnosisDetector:
+    """
+    An asyncio interface of a DiagnosisDetector and its DiagnosisDatabase, for use inside an event loop
+
+    The NLP work runs on an executor instead of the event loop, and concurrent callers are grouped into
+    micro-batches which pass through the NER model together, see utils.batching.AsyncMicroBatcher
+
+    Example
+    -------
+        detector = AsyncDiagnosisDetector(DiagnosisDetector(db))
+        diagnoses = await detector.give_diagnosis(text)
+        factors = await detector.find_factors('pulmonary embolism', top_k=10)
+        await detector.close()
+
+    Attributes:
+        detector: DiagnosisDetector
+            The detector which gives the diagnoses of clinical notes
+        batcher: AsyncMicroBatcher
+            Groups the awaited requests into batches for the NLP pipeline
+    """
+    def __init__(
+            self,
+            detector: DiagnosisDetector,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT,
+            max_concurrency: int = 1,
+            max_pending: int = DEFAULT_MAX_PENDING,
+            executor: Executor = None
+    ):
+        """
+        Initializes the AsyncDiagnosisDetector
+
+        Parameters
+        ----------
+        detector: DiagnosisDetector
+            The detector which gives the diagnoses of clinical notes
+        max_batch_size: int (default=DEFAULT_MAX_BATCH_SIZE)
+            The maximum number of requests processed together
+        max_wait: float (default=DEFAULT_MAX_WAIT)
+            The maximum number of seconds a request waits for others to join its batch
+        max_concurrency: int (default=1)
+            The maximum number of batches processed at the same time, which share one NER model
+        max_pending: int (default=DEFAULT_MAX_PENDING)
+            The maximum number of requests waiting for a batch, after which callers wait for room
+        executor: concurrent.futures.Executor (default=None)
+            The thread pool the batches run on, None for the default executor of the event loop
+        """
+        self.detector = detector
+        self.batcher = AsyncMicroBatcher(
+            self.process_batch, max_batch_size, max_wait, max_concurrency, max_pending, executor
+        )
+
+    async def load(self) -> None:
+        """
+        Load the NLP model on the executor, so the first request does not pay for it
+        """
+        await asyncio.get_running_loop().run_in_executor(self.batcher.executor, getattr, self.detector.db, 'searcher')
+
+    async def give_diagnosis(self, text: str) -> dict[str: str]:
+        """
+        Give diagnoses and factors extracted from the text of a clinical note, see DiagnosisDetector.give_diagnosis
+
+        Parameters
+        ----------
+        text: str
+            The text of a clinical note
+
+        Returns
+        -------
+        dict[str: str]
+            The canonical names of the factors of each primary diagnosis found in the note
+            Notes without a discharge diagnosis section give an empty dictionary
+
+        """
+        return await self.batcher.submit(('diagnosis', text, {}))
+
+    async def find_factors(
+            self,
+            disease: str,
+            rank_by: str = 'count',
+            top_k: int = None,
+            min_support: int = 1
+    ) -> List[str]:
+        """
+        Find the factors of a disease in the database, see DiagnosisDatabase.find_factors
+        Invalid options raise ValueError or TypeError here, before the request joins a batch
+        """
+        check_factor_options(rank_by, top_k, min_support)
+        return await self.batcher.submit(
+            ('factors', disease, {'rank_by': rank_by, 'top_k': top_k, 'min_support': min_support})
+        )
+
+    def process_batch(self, requests: list) -> list:
+        # runs on the executor
+        metrics.increment('async_batches')
+        metrics.increment('async_requests', len(requests))
+        return self.detector.process_requests(requests)
+
+    async def close(self) -> None:
+        """
+        Answer the pending requests, then save the link cache of the NER model and the result cache and stop the window workers
+        """
+        await self.batcher.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.batcher.executor, self.detector.db.save_link_cache)
+        await loop.run_in_executor(self.batcher.executor, self.detector.save_result_cache)
+        await loop.run_in_executor(self.batcher.executor, self.detector.close_window_pool)
@@ -0,0 +1,163 @@
+"""
+Compares the startup time and throughput of the DiseaseSearcher pipeline profiles
+
+Run from the root directory of the repository with
+    python -m benchmarks.compare_profiles --limit 200
+Every run of a profile loads its model in a fresh process, so no profile starts with modules or a model already
+loaded by another, and the order of the profiles alternates between repeats so that none of them always pays for
+a cold page cache. The median of the repeats is reported, with the peak memory of the process of each run
+"""
+import os
+import argparse
+import warnings
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import List
+from nlp import DiseaseSearcher, PIPELINE_PROFILES
+from utils import df_utils, load_data, text_utils
+from utils.profiling import peak_rss
+
+
+def load_contexts(data_dir: str, limit: int) -> List[str]:
+    """
+    Load the sections of clinical notes which are searched for underlying factors
+
+    Parameters
+    ----------
+    data_dir: str
+        Directory of .txt clinical notes
+    limit: int
+        The maximum number of notes to load
+
+    Returns
+    -------
+    List[str]
+        The combined diagnosis, history, and complaint of each note with a diagnosis
+
+    """
+    txt_df = load_data.load_txt(os.path.join(data_dir, '')).head(limit)
+    txt_df = df_utils.split_txt_df(txt_df)
+    return [
+        text_utils.build_context(diagnosis, history, complaint)
+        for diagnosis, history, complaint in zip(txt_df.primary_diagnosis, txt_df.history, txt_df.complaint)
+    ]
+
+
+def run_profile(model_name: str, profile: str, contexts: List[str], batch_size: int) -> dict:
+    """
+    Load the DiseaseSearcher of a profile and run it on the contexts, in the process of a single run
+
+    Parameters
+    ----------
+    model_name: str
+        The name of one of scispacy's NER models
+    profile: str
+        A key of PIPELINE_PROFILES
+    contexts: List[str]
+        The texts passed through the pipeline
+    batch_size: int
+        The number of texts processed by the pipeline at a time
+
+    Returns
+    -------
+    dict
+        The startup and processing time in seconds, the diseases found in each context,
+        the peak resident set size of the process in bytes or None, and the names of the pipeline components
+
+    """
+    # the link cache is disabled so every profile pays for the same linking work
+    start = perf_counter()
+    searcher = DiseaseSearcher(model_name, link_cache_size=0, profile=profile)
+    startup = perf_counter() - start
+
+    start = perf_counter()
+    diseases = searcher.get_diseases_batch(contexts, batch_size=batch_size)
+    elapsed = perf_counter() - start
+    return {
+        'startup': startup,
+        'elapsed': elapsed,
+        'diseases': diseases,
+        'peak_rss': peak_rss(),
+        'pipeline': searcher.nlp.pipe_names
+    }
+
+
+def run_profile_in_subprocess(model_name: str, profile: str, contexts: List[str], batch_size: int) -> dict:
+    """
+    run_profile in a freshly spawned interpreter, which has not imported or loaded anything of a previous run
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_profile, model_name, profile, contexts, batch_size).result()
+
+
+def compare_profiles(
+        model_name: str,
+        profiles: List[str],
+        contexts: List[str],
+        batch_size: int,
+        repeats: int = 3
+) -> None:
+    """
+    Print the startup time, throughput, and agreement with the first profile of each profile
+
+    Parameters
+    ----------
+    model_name: str
+        The name of one of scispacy's NER models
+    profiles: List[str]
+        Keys of PIPELINE_PROFILES
+    contexts: List[str]
+        The texts passed through each pipeline
+    batch_size: int
+        The number of texts processed by the pipeline at a time
+    repeats: int (default=3)
+        The number of runs of each profile, each in its own process, whose median is reported
+    """
+    n_chars = sum(len(context) for context in contexts)
+    runs = {profile: [] for profile in profiles}
+
+    # alternate the order of the profiles so that the cold first run does not always fall on the same profile
+    for repeat in range(repeats):
+        for profile in (profiles if repeat % 2 == 0 else profiles[::-1]):
+            runs[profile].append(run_profile_in_subprocess(model_name, profile, contexts, batch_size))
+
+    print(f'{len(contexts)} notes, {n_chars} characters, median of {repeats} runs per profile')
+    print(f'{"profile":<10}{"startup (s)":>14}{"notes/s":>12}{"chars/s":>14}{"agreement":>12}{"max rss (MB)":>14}  pipeline')
+    baseline = runs[profiles[0]][0]['diseases']
+    for profile in profiles:
+        startup = statistics.median(run['startup'] for run in runs[profile])
+        elapsed = statistics.median(run['elapsed'] for run in runs[profile])
+
+        # fraction of notes whose diseases match those of the first profile
+        diseases = runs[profile][0]['diseases']
+        agreement = sum(set(x) == set(y) for x, y in zip(diseases, baseline)) / max(len(contexts), 1)
+
+        # the peak memory cannot be measured on every platform
+        peaks = [run['peak_rss'] for run in runs[profile] if run['peak_rss'] is not None]
+        max_rss = f'{max(peaks) / 2**20:>14.0f}' if peaks else f'{"n/a":>14}'
+        print(
+            f'{profile:<10}{startup:>14.2f}{len(contexts) / elapsed:>12.1f}{n_chars / elapsed:>14.0f}'
+            f'{agreement:>12.3f}{max_rss}  {",".join(runs[profile][0]["pipeline"])}'
+        )
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Compare the DiseaseSearcher pipeline profiles')
+    parser.add_argument('--data-dir', default=os.path.join('data', 'training_20180910'),
+                        help='directory of .txt clinical notes')
+    parser.add_argument('--model', default='en_ner_bc5cdr_md', help='name of the scispacy NER model')
+    parser.add_argument('--profiles', nargs='+', default=list(PIPELINE_PROFILES), choices=list(PIPELINE_PROFILES))
+    parser.add_argument('--limit', type=int, default=200, help='maximum number of notes')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='number of runs of each profile, each in a fresh process, whose median is reported')
+    args = parser.parse_args()
+
+    compare_profiles(
+        args.model, args.profiles, load_contexts(args.data_dir, args.limit), args.batch_size, args.repeats
+    )
@@ -0,0 +1,250 @@
+"""
+Times each stage of building the database and detecting diagnoses on synthetic clinical notes
+
+Run from the root directory of the repository with
+    python -m benchmarks.stages --notes 2000
+The NER model is replaced by benchmarks.stub_searcher.StubSearcher, so no model or knowledge base is needed,
+unless a scispacy model is given with --model
+Save the results with --output and compare a later run to them with --baseline to catch regressions
+"""
+import io
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import warnings
+import contextlib
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple, Any
+from database import DiagnosisDatabase, DATABASE_FILE, MANIFEST_FILE
+from main import DiagnosisDetector
+from nlp import DiseaseSearcher, DEFAULT_BATCH_SIZE
+from utils import df_utils, load_data, text_utils
+from benchmarks import synthetic
+from benchmarks.stub_searcher import StubSearcher
+
+
+def time_stage(function: Callable[[], Any], repeat: int, setup: Callable[[], None] = None) -> Tuple[Any, float]:
+    """
+    Time a stage, keeping the fastest of several runs to reduce noise
+
+    Parameters
+    ----------
+    function: Callable[[], Any]
+        Runs the stage
+    repeat: int
+        The number of runs
+    setup: Callable[[], None] (default=None)
+        Run before each run without being timed, such as to clear caches
+
+    Returns
+    -------
+    Tuple[Any, float]
+        The output of the last run and the fastest time in seconds
+
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        result = function()
+        best = min(best, perf_counter() - start)
+    return result, best
+
+
+def recognize(searcher, contexts: List[str], batch_size: int) -> list:
+    """
+    The named entity recognition stage on its own, leaving out linking
+    """
+    if isinstance(searcher, StubSearcher):
+        return [searcher.recognize(context) for context in contexts]
+    with searcher.nlp.select_pipes(disable=['scispacy_linker']):
+        return list(searcher.nlp.pipe(contexts, batch_size=batch_size))
+
+
+def link(searcher, recognized: list) -> int:
+    """
+    The linking stage on its own, on the output of recognize
+
+    Returns
+    -------
+    int
+        The number of mentions linked
+    """
+    if isinstance(searcher, StubSearcher):
+        for mentions in recognized:
+            for _, mention in mentions:
+                searcher.link_mention(mention)
+        return sum(len(mentions) for mentions in recognized)
+    for doc in recognized:
+        searcher.linker(doc)
+    return sum(len(doc.ents) for doc in recognized)
+
+
+def run_benchmarks(
+        searcher,
+        model_name: str,
+        n_notes: int,
+        n_diagnoses: int,
+        repeat: int,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        seed: int = 0
+) -> Dict[str, Dict[str, float]]:
+    """
+    Time each stage of building the database and detecting diagnoses on synthetic clinical notes
+
+    Parameters
+    ----------
+    searcher: DiseaseSearcher or StubSearcher
+        The NER model
+    model_name: str
+        The name the database records for the NER model
+    n_notes: int
+        The number of synthetic notes the database is built from
+    n_diagnoses: int
+        The number of notes diagnosed one at a time by DiagnosisDetector.give_diagnosis
+    repeat: int
+        The number of runs of each stage, of which the fastest is kept
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    seed: int (default=0)
+        The seed of the synthetic notes
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        For each stage in order, its fastest time in "seconds", the number of "items" it processed,
+        and the items processed "per_second"
+
+    """
+    results = {}
+
+    def record(stage: str, seconds: float, items: int) -> None:
+        results[stage] = {'seconds': seconds, 'items': items, 'per_second': items / seconds if seconds else 0.0}
+
+    data_dir = tempfile.mkdtemp(prefix='diagnosis_benchmark_')
+    data_path = os.path.join(data_dir, 'training_20180910')
+    try:
+        notes = synthetic.generate_notes(n_notes, seed=seed)
+        synthetic.write_notes(notes, data_path)
+
+        # keep the progress messages of the stages out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            txt_df, seconds = time_stage(lambda: load_data.load_txt(data_path), repeat)
+            record('loading', seconds, len(txt_df))
+
+            # clear the cached section indices so every run scans the notes
+            split_df, seconds = time_stage(
+                lambda: df_utils.split_txt_df(txt_df), repeat, setup=text_utils.segment_sections.cache_clear
+            )
+            record('sectioning', seconds, len(txt_df))
+
+            contexts = [
+                text_utils.build_context(diagnosis, history, complaint)
+                for diagnosis, history, complaint in zip(split_df.primary_diagnosis, split_df.history, split_df.complaint)
+            ]
+            recognized, seconds = time_stage(lambda: recognize(searcher, contexts, batch_size), repeat)
+            record('ner', seconds, len(contexts))
+
+            n_mentions, seconds = time_stage(lambda: link(searcher, recognized), repeat)
+            record('linking', seconds, n_mentions)
+
+            processed_df, seconds = time_stage(
+                lambda: df_utils.process_txt_df(txt_df, searcher, batch_size), repeat,
+                setup=text_utils.segment_sections.cache_clear
+            )
+            record('extraction', seconds, len(txt_df))
+
+            disease_db, seconds = time_stage(lambda: df_utils.create_disease_df(processed_df), repeat)
+            record('aggregation', seconds, len(processed_df))
+
+            # remove the saved database before each run so that it is created again
+            def remove_database() -> None:
+                for file_name in [DATABASE_FILE, MANIFEST_FILE]:
+                    if os.path.exists(os.path.join(data_dir, file_name)):
+                        os.remove(os.path.join(data_dir, file_name))
+
+            db, seconds = time_stage(
+                lambda: DiagnosisDatabase(data_dir, model_name, batch_size=batch_size, searcher=searcher),
+                repeat,
+                setup=remove_database
+            )
+            record('build', seconds, len(txt_df))
+
+            # look up every canonical name and alias, plus names that are not in the database
+            queries = [name for name, aliases in synthetic.DISEASES.items() for name in [name, *aliases]]
+            queries += ['not a disease', 'unknown syndrome']
+            db.index
+            _, seconds = time_stage(lambda: [db.find_factors(query) for query in queries], repeat)
+            record('lookup', seconds, len(queries))
+
+            # rank the candidate primary diseases of every note by its factors
+            factor_lists = list(processed_df.underlying_factors)
+            db.scorer
+            _, seconds = time_stage(lambda: db.rank_diseases_batch(factor_lists), repeat)
+            record('scoring', seconds, len(factor_lists))
+
+            # diagnose notes one at a time, as the detection service does
+            detector = DiagnosisDetector(db)
+            texts = list(notes.values())[:n_diagnoses]
+
+            def diagnose() -> None:
+                for text in texts:
+                    detector.give_diagnosis(text)
+
+            _, seconds = time_stage(diagnose, repeat, setup=text_utils.segment_sections.cache_clear)
+            record('give_diagnosis', seconds, len(texts))
+    finally:
+        shutil.rmtree(data_dir)
+
+    return results
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]] = None) -> None:
+    """
+    Print the time of each stage, and its time relative to a baseline run if given
+    """
+    header = f'{"stage":<16}{"seconds":>10}{"items":>10}{"items/s":>14}'
+    print(header + (f'{"vs baseline":>14}' if baseline else ''))
+    for stage, result in results.items():
+        line = f'{stage:<16}{result["seconds"]:>10.4f}{result["items"]:>10}{result["per_second"]:>14.1f}'
+        if baseline and stage in baseline and baseline[stage]['seconds']:
+            line += f'{result["seconds"] / baseline[stage]["seconds"]:>13.2f}x'
+        print(line)
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Time each stage of building the database and detecting diagnoses')
+    parser.add_argument('--notes', type=int, default=1000, help='number of synthetic clinical notes')
+    parser.add_argument('--diagnoses', type=int, default=200, help='number of notes diagnosed one at a time')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each stage, the fastest is kept')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic clinical notes')
+    parser.add_argument('--model', default=None,
+                        help='name of a scispacy NER model to time instead of the stub, which needs the UMLS knowledge base')
+    parser.add_argument('--output', default=None, help='JSON file the results are saved to')
+    parser.add_argument('--baseline', default=None, help='JSON file of earlier results to compare to')
+    args = parser.parse_args()
+
+    if args.model is None:
+        searcher, model_name = StubSearcher(), 'stub'
+    else:
+        searcher, model_name = DiseaseSearcher(args.model), args.model
+
+    results = run_benchmarks(searcher, model_name, args.notes, args.diagnoses, args.repeat, args.batch_size, args.seed)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['stages']
+    print(f'{args.notes} synthetic notes, {model_name} NER model')
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'notes': args.notes, 'model': model_name, 'stages': results}, file, indent=2)
@@ -0,0 +1,143 @@
+"""
+A stand-in for nlp.DiseaseSearcher which runs without the scispacy models or the UMLS knowledge base
+"""
+import re
+from typing import List, Iterable, Dict, Union, Tuple
+from scispacy.linking_utils import Entity
+from nlp import DiseaseSearcher, DEFAULT_BATCH_SIZE
+from benchmarks import synthetic
+from utils.result_cache import combine_versions
+
+
+class StubSearcher:
+    """
+    Finds the mentions of a fixed vocabulary of diseases with a regular expression and links them with a dictionary,
+    with the same methods as nlp.DiseaseSearcher so it can be used in its place by utils.df_utils, DiagnosisDatabase,
+    and DiagnosisDetector
+
+    Attributes:
+        pattern: re.Pattern
+            Matches the aliases of the diseases, longest first
+        aliases: Dict[str, str]
+            The canonical name of each alias
+        entities: Dict[str, Entity]
+            The knowledge base entry of each canonical name
+        linked_cuis: Dict[str, str]
+            The concept identifier of each canonical name that was linked, see nlp.DiseaseSearcher.linked_cuis
+    """
+    def __init__(self, diseases: Dict[str, List[str]] = None):
+        """
+        Initializes the StubSearcher with a vocabulary of diseases
+
+        Parameters
+        ----------
+        diseases: Dict[str, List[str]] (default=synthetic.DISEASES)
+            The aliases of each disease by its canonical name
+        """
+        if diseases is None:
+            diseases = synthetic.DISEASES
+        self.aliases = {alias: name for name, aliases in diseases.items() for alias in aliases}
+        alternatives = '|'.join(re.escape(alias) for alias in sorted(self.aliases, key=len, reverse=True))
+        self.pattern = re.compile(rf'\b(?:{alternatives})\b')
+        self.entities = {
+            name: Entity(f'C{index:07d}', name, aliases, ['T047'])
+            for index, (name, aliases) in enumerate(diseases.items())
+        }
+        self.linked_cuis = {}
+
+    def version(self) -> str:
+        """
+        A digest of the vocabulary, which decides what the stub extracts, see DiagnosisDatabase.extraction_fingerprint
+        """
+        return combine_versions(sorted(self.aliases.items()))
+
+    def recognize(self, text: str) -> List[Tuple[int, str]]:
+        """
+        The stand-in for named entity recognition, which finds the start and text of each mention in a string
+        """
+        return [(match.start(), match.group()) for match in self.pattern.finditer(text.lower())]
+
+    def link_mention(self, mention: str) -> Union[str, None]:
+        """
+        The stand-in for entity linking, which finds the canonical name of a mention
+        """
+        name = self.aliases.get(mention)
+        if name is not None:
+            self.linked_cuis.setdefault(name, self.entities[name].concept_id)
+        return name
+
+    def canonical_names(self, mentions: Iterable[Tuple[int, str]]) -> List[str]:
+        names = [self.link_mention(mention) for _, mention in mentions]
+        return [name for name in names if name is not None]
+
+    remove_primary = staticmethod(DiseaseSearcher.remove_primary)
+    route_mentions = staticmethod(DiseaseSearcher.route_mentions)
+
+    def save_link_cache(self) -> None:
+        pass
+
+    def get_diseases(self, text: str) -> List[str]:
+        return list(set(self.canonical_names(self.recognize(text))))
+
+    def get_factors(self, text: str, primary_diseases: List[str]) -> List[str]:
+        return self.remove_primary(self.canonical_names(self.recognize(text)), primary_diseases)
+
+    def get_diseases_batch(
+            self,
+            texts: Iterable[str],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[str]]:
+        return [self.get_diseases(text) for text in texts]
+
+    def get_factors_batch(
+            self,
+            texts: Iterable[str],
+            primary_diseases: Iterable[List[str]],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[str]]:
+        return [self.get_factors(text, primary) for text, primary in zip(texts, primary_diseases)]
+
+    def get_diseases_and_factors(self, text: str, primary_span: Tuple[int, int]) -> Tuple[List[str], List[str]]:
+        start, end = primary_span
+        mentions = self.recognize(text)
+        primary_diseases = list(set(self.canonical_names(
+            (position, mention) for position, mention in mentions if start <= position < end
+        )))
+        return primary_diseases, self.remove_primary(self.canonical_names(mentions), primary_diseases)
+
+    def get_diseases_and_factors_batch(
+            self,
+            texts: Iterable[str],
+            primary_spans: Iterable[Tuple[int, int]],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[Tuple[List[str], List[str]]]:
+        return [self.get_diseases_and_factors(text, span) for text, span in zip(texts, primary_spans)]
+
+    def mentions(self, text: str) -> List[Tuple[int, int, str]]:
+        linked = [(position, mention, self.link_mention(mention)) for position, mention in self.recognize(text)]
+        return [(position, position + len(mention), name) for position, mention, name in linked if name is not None]
+
+    def get_mentions_batch(
+            self,
+            texts: Iterable[str],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[Tuple[int, int, str]]]:
+        return [self.mentions(text) for text in texts]
+
+    def link(self, text: str) -> Union[str, None]:
+        mentions = self.recognize(text)
+        return self.link_mention(mentions[0][1]) if mentions else None
+
+    def link_batch(self, texts: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> List[Union[str, None]]:
+        return [self.link(text) for text in texts]
+
+    def find_entities(self, names: Iterable[str]) -> Dict[str, Entity]:
+        return {name: self.entities[name] for name in set(names) if name in self.entities}
+
+    def find_concepts(self, cuis: Iterable[str]) -> Dict[str, Entity]:
+        concepts = {entity.concept_id: entity for entity in self.entities.values()}
+        return {cui: concepts[cui] for cui in set(cuis) if cui in concepts}
@@ -0,0 +1,151 @@
+"""
+Generates synthetic clinical notes with the sections that utils.text_utils looks for,
+so the benchmarks run without the n2c2 clinical notes
+"""
+import os
+import random
+from typing import Dict, List
+
+# canonical names of the synthetic diseases and the aliases they are mentioned by in the notes
+DISEASES = {
+    'Asthma': ['asthma'],
+    'Chronic Obstructive Airway Disease': ['copd', 'chronic obstructive pulmonary disease'],
+    'Pneumonia': ['pneumonia', 'community acquired pneumonia'],
+    'Diabetes Mellitus': ['diabetes', 'diabetes mellitus'],
+    'Hypertensive disease': ['hypertension', 'htn'],
+    'Congestive heart failure': ['chf', 'congestive heart failure'],
+    'Atrial Fibrillation': ['atrial fibrillation', 'afib'],
+    'Myocardial Infarction': ['myocardial infarction', 'heart attack'],
+    'Pulmonary Embolism': ['pulmonary embolism'],
+    'Deep Vein Thrombosis': ['dvt', 'deep vein thrombosis'],
+    'Kidney Failure, Acute': ['acute kidney injury', 'acute renal failure'],
+    'Chronic Kidney Diseases': ['ckd', 'chronic kidney disease'],
+    'Sepsis': ['sepsis'],
+    'Urinary tract infection': ['uti', 'urinary tract infection'],
+    'Cellulitis': ['cellulitis'],
+    'Anemia': ['anemia'],
+    'Gastrointestinal Hemorrhage': ['gi bleed', 'gastrointestinal bleeding'],
+    'Pancreatitis': ['pancreatitis'],
+    'Cirrhosis': ['cirrhosis'],
+    'Cerebrovascular accident': ['stroke', 'cva'],
+    'Seizures': ['seizure', 'seizures'],
+    'Delirium': ['delirium'],
+    'Dementia': ['dementia'],
+    'Depressive disorder': ['depression'],
+    'Hypothyroidism': ['hypothyroidism'],
+    'Obesity': ['obesity'],
+    'Hyperlipidemia': ['hyperlipidemia'],
+    'Coronary Artery Disease': ['cad', 'coronary artery disease'],
+    'Fever': ['fever'],
+    'Coughing': ['cough'],
+    'Chest Pain': ['chest pain'],
+    'Dyspnea': ['shortness of breath', 'dyspnea'],
+    'Nausea': ['nausea'],
+    'Vomiting': ['vomiting'],
+    'Abdominal Pain': ['abdominal pain'],
+    'Headache': ['headache'],
+    'Syncope': ['syncope'],
+    'Hypotension': ['hypotension'],
+    'Hyponatremia': ['hyponatremia'],
+    'Hypokalemia': ['hypokalemia'],
+}
+
+DIAGNOSIS_HEADERS = ['Discharge Diagnosis', 'Discharge Diagnoses', 'Final Discharge Diagnosis', 'DISCHARGE DIAGNOSIS']
+FILLER_SECTIONS = ['Allergies', 'Medications on Admission', 'Physical Exam', 'Pertinent Results', 'Brief Hospital Course']
+FILLER = [
+    'patient', 'was', 'admitted', 'with', 'and', 'noted', 'to', 'have', 'history', 'of', 'the', 'on', 'day',
+    'denies', 'reports', 'started', 'on', 'given', 'stable', 'improved', 'follow', 'up', 'with', 'pcp', 'in', 'clinic',
+    'no', 'acute', 'distress', 'labs', 'notable', 'for', 'mild', 'elevation', 'discharged', 'home', 'treated', 'for'
+]
+
+
+def mention(rng: random.Random, disease: str) -> str:
+    return rng.choice(DISEASES[disease])
+
+
+def sentence(rng: random.Random, diseases: List[str], n_words: int) -> str:
+    """
+    A sentence of filler words with mentions of the given diseases at random positions
+    """
+    words = [rng.choice(FILLER) for _ in range(n_words)]
+    for disease in diseases:
+        words.insert(rng.randrange(len(words) + 1), mention(rng, disease))
+    return ' '.join(words).capitalize() + '.'
+
+
+def generate_note(rng: random.Random, n_sentences: int = 20, p_diagnosis: float = 0.95) -> str:
+    """
+    Generate a synthetic discharge summary with a discharge diagnosis, history of present illness,
+    chief complaint, and filler sections
+
+    Parameters
+    ----------
+    rng: random.Random
+        The source of randomness
+    n_sentences: int (default=20)
+        The number of sentences in the filler sections
+    p_diagnosis: float (default=0.95)
+        The probability that the note has a discharge diagnosis section
+
+    Returns
+    -------
+    str
+        The text of the note
+
+    """
+    names = list(DISEASES)
+    primary = rng.sample(names, rng.randint(1, 2))
+    secondary = rng.sample(names, rng.randint(0, 4))
+    history = rng.sample(names, rng.randint(1, 5))
+
+    sections = [
+        'Admission Date: [**2150-1-1**]  Discharge Date: [**2150-1-9**]',
+        f'Chief Complaint:\n{mention(rng, rng.choice(history))}',
+        'History of Present Illness:\n' + ' '.join(
+            sentence(rng, [disease], rng.randint(8, 20)) for disease in history
+        ),
+    ]
+    for header in rng.sample(FILLER_SECTIONS, 3):
+        sections.append(f'{header}:\n' + ' '.join(
+            sentence(rng, [], rng.randint(8, 20)) for _ in range(n_sentences // 3)
+        ))
+    if rng.random() < p_diagnosis:
+        diagnosis = 'Primary:\n' + '\n'.join(mention(rng, disease) for disease in primary)
+        if secondary:
+            diagnosis += '\nSecondary:\n' + '\n'.join(mention(rng, disease) for disease in secondary)
+        sections.append(f'{rng.choice(DIAGNOSIS_HEADERS)}:\n{diagnosis}')
+    sections.append('Discharge Condition:\nStable.')
+    return '\n\n'.join(sections) + '\n'
+
+
+def generate_notes(n_notes: int, seed: int = 0, n_sentences: int = 20) -> Dict[str, str]:
+    """
+    Generate synthetic discharge summaries
+
+    Parameters
+    ----------
+    n_notes: int
+        The number of notes
+    seed: int (default=0)
+        The seed of the random generator, so the same notes are generated on every run
+    n_sentences: int (default=20)
+        The number of sentences in the filler sections of each note
+
+    Returns
+    -------
+    Dict[str, str]
+        The text of each note by its identifier
+
+    """
+    rng = random.Random(seed)
+    return {str(100000 + index): generate_note(rng, n_sentences) for index in range(n_notes)}
+
+
+def write_notes(notes: Dict[str, str], directory: str) -> None:
+    """
+    Write notes as .txt files named by their identifiers, as in the training_20180910 directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    for note_id, text in notes.items():
+        with open(os.path.join(directory, f'{note_id}.txt'), 'w') as file:
+            file.write(text)
@@ -1,10 +1,49 @@
 import os
 import sys
+import csv
+import json
+import argparse
 import warnings
+import contextlib
 import pandas as pd
-from utils import df_utils, load_data
-from nlp import DiseaseSearcher
-from typing import List
+from utils import df_utils, load_data, manifest, metrics, parallel, profiling, result_cache, scoring, storage, text_utils
+from nlp import DiseaseSearcher, DEFAULT_BATCH_SIZE, DEFAULT_LINK_LABELS, PIPELINE_PROFILES
+import knowledge_base
+from typing import List, Dict, Union, Iterable, TextIO, Tuple
+
+# file names of the saved database and the manifest of the notes it was created from
+DATABASE_FILE = 'disease_db.pkl'
+MANIFEST_FILE = 'disease_db_manifest.pkl'
+
+# file name of the fingerprint of the extraction settings the manifest was created with
+FINGERPRINT_FILE = 'disease_db_fingerprint.json'
+
+# directory of the database saved in the compact memory-mapped format
+COMPACT_DIR = 'disease_db'
+
+# file name of the Parquet snapshot of the loaded clinical notes
+NOTES_SNAPSHOT_FILE = 'notes.parquet'
+
+# formats the database can be saved in
+STORAGE_FORMATS = ['pickle', 'compact']
+
+# orders in which factors can be ranked
+RANKINGS = ['count', 'lift']
+
+# formats the command line can write factors in
+OUTPUT_FORMATS = ['text', 'json', 'csv']
+
+
+def check_factor_options(rank_by: str, top_k: int = None, min_support: int = 1) -> None:
+    """
+    Checks the options of DiagnosisDatabase.find_factors, raising ValueError or TypeError if one is invalid
+    """
+    if rank_by not in RANKINGS:
+        raise ValueError(f'Unknown ranking {rank_by}, expected one of {RANKINGS}')
+    if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool)):
+        raise TypeError(f'Expected top_k to be an int or None, got {type(top_k).__name__}')
+    if not isinstance(min_support, int) or isinstance(min_support, bool):
+        raise TypeError(f'Expected min_support to be an int, got {type(min_support).__name__}')
 
 
 class DiagnosisDatabase:
@@ -12,12 +51,36 @@ class DiagnosisDatabase:
     A database and associated NER model for medical terms
 
     Attributes:
+        data_dir: str
+            The directory of the saved database and the clinical notes
         searcher: DiseaseSearcher
-            A scispacy NER model and UMLS linker
+            A scispacy NER model and UMLS linker, loaded the first time it is needed
         database: pandas DataFrame
             A DataFrame of diseases and corresponding underlying factors
+            When loaded in the compact format, it is only decoded the first time it is accessed
+        index: Dict[str, int]
+            A mapping from the normalized canonical names, concept identifiers, and aliases of the diseases
+            to their row in the database
+        name_index: Dict[str, int]
+            A mapping from the normalized canonical names of the diseases alone to their row in the database
+        scorer: utils.scoring.DifferentialScorer
+            The inverted index from factors to diseases and the sparse matrices which rank diseases by their factors
     """
-    def __init__(self, data_dir: str, model_name: str):
+    def __init__(
+            self,
+            data_dir: str,
+            model_name: str,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1,
+            n_workers: int = 1,
+            chunk_size: int = parallel.DEFAULT_CHUNK_SIZE,
+            refresh: bool = False,
+            single_pass: bool = False,
+            storage_format: str = 'pickle',
+            snapshot: bool = False,
+            searcher: DiseaseSearcher = None,
+            **searcher_kwargs
+    ):
         """
         Initializes DiagnosisDatabase with given directory for clinical notes .txt files
         and model name for scispacy NER model
@@ -29,15 +92,165 @@ class DiagnosisDatabase:
         model_name: str
             The model name of the scispacy NER model
             For avaible models, see https://allenai.github.io/scispacy/
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of notes passed through the NER model at a time when creating the database
+        n_process: int (default=1)
+            The number of processes used to run the NER model when creating the database
+        n_workers: int (default=1)
+            The number of worker processes, each with its own NER model, used to create the database
+            If 1, the database is created serially in this process
+        chunk_size: int (default=parallel.DEFAULT_CHUNK_SIZE)
+            The number of clinical notes given to a worker process at a time when n_workers > 1
+        refresh: bool (default=False)
+            If true, a saved database is updated with the clinical notes which were added, changed,
+            or deleted since it was saved, only running the NER model on the added and changed notes
+        single_pass: bool (default=False)
+            If true, each clinical note only goes through the NER model once when creating the database,
+            with diseases assigned to the primary diagnosis or underlying factors by their position in the note
+        storage_format: str (default='pickle')
+            One of STORAGE_FORMATS, the format the database is saved and loaded in
+            'pickle' saves a pickled DataFrame to disease_db.pkl, 'compact' saves interned strings
+            and integer offset arrays to the directory disease_db which are memory-mapped when loaded
+            A database saved as a pickle is converted the first time it is loaded in the compact format
+        snapshot: bool (default=False)
+            If true, the loaded clinical notes are kept in a Parquet snapshot in data_dir, so that creating or
+            updating the database only reads the notes which were added or changed since, requires pyarrow
+        searcher: DiseaseSearcher (default=None)
+            An already loaded NER model, or an object with the same methods, used instead of loading model_name
+            Worker processes still load model_name when n_workers > 1
+        searcher_kwargs:
+            Additional keyword arguments passed to DiseaseSearcher, such as profile, kb_path, or link_cache_path
         """
-        self.searcher = DiseaseSearcher(model_name)
-        self.database = self.create_or_load_database(data_dir)
+        self.data_dir = data_dir
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.refresh = refresh
+        self.single_pass = single_pass
+        self.searcher_kwargs = searcher_kwargs
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f'Unknown storage format {storage_format}, expected one of {STORAGE_FORMATS}')
+        self.storage_format = storage_format
+        self.snapshot = snapshot
+        self._searcher = searcher
+        self._database = self.create_or_load_database(data_dir)
+        self._index = None
+        self._name_index = None
+        self._scorer = None
         print('Database Ready')
 
+    @property
+    def database(self) -> pd.DataFrame:
+        # the compact format is only decoded when the whole table is needed
+        if isinstance(self._database, storage.CompactDatabase):
+            self._database = self._database.to_frame()
+        return self._database
+
+    @property
+    def index(self) -> Dict[str, int]:
+        # build the index on the first lookup so loading the database stays fast
+        if self._index is None:
+            self._index = self.build_index(self._database)
+        return self._index
+
+    @property
+    def name_index(self) -> Dict[str, int]:
+        # build the index of canonical names on the first lookup of a primary disease
+        if self._name_index is None:
+            self._name_index = self.build_name_index(self._database)
+        return self._name_index
+
+    @property
+    def scorer(self) -> scoring.DifferentialScorer:
+        # build the sparse matrices on the first reverse lookup or scoring
+        if self._scorer is None:
+            self._scorer = scoring.DifferentialScorer.from_database(self._database)
+        return self._scorer
+
+    @property
+    def searcher(self) -> DiseaseSearcher:
+        # only load the NER model when a query or build needs it
+        if self._searcher is None:
+            self._searcher = DiseaseSearcher(self.model_name, **self.searcher_kwargs)
+        return self._searcher
+
+    def save_link_cache(self) -> None:
+        """
+        Save the link cache of the NER model, if the model was loaded
+        """
+        if self._searcher is not None:
+            self._searcher.save_link_cache()
+
+    def version(self) -> str:
+        """
+        A fingerprint of the saved database and the NER model, which changes whenever the database is saved again
+        or a different model, model version, pipeline profile, or knowledge base is used
+        The NER model is not loaded to find it
+
+        Returns
+        -------
+        str
+            A short hex digest
+
+        """
+        if self.storage_format == 'compact':
+            database_files = [os.path.join(self.data_dir, COMPACT_DIR, 'meta.json')]
+        else:
+            database_files = [os.path.join(self.data_dir, DATABASE_FILE)]
+
+        # the link cache only changes how fast the model is, not what it finds
+        searcher_kwargs = {key: value for key, value in self.searcher_kwargs.items() if key != 'link_cache_path'}
+        kb_path = searcher_kwargs.get('kb_path')
+        if kb_path is not None:
+            database_files.append(os.path.join(kb_path, knowledge_base.KB_META_FILE))
+
+        return result_cache.combine_versions(
+            result_cache.file_fingerprint(database_files),
+            self.model_name,
+            result_cache.package_version(self.model_name),
+            result_cache.package_version('scispacy'),
+            searcher_kwargs
+        )
+
+    def extraction_fingerprint(self) -> str:
+        """
+        A fingerprint of everything which decides the diseases extracted from a note when building the database:
+        the NER model and its version, the searcher options such as the profile, knowledge base, and linked labels,
+        and the single pass mode
+        It is saved with the manifest, so that a refresh with different settings rebuilds every note
+        instead of keeping the extractions made with the old settings
+
+        Returns
+        -------
+        str
+            A short hex digest
+
+        """
+        searcher_kwargs = {key: value for key, value in self.searcher_kwargs.items() if key != 'link_cache_path'}
+        kb_path = searcher_kwargs.get('kb_path')
+        kb_files = [os.path.join(kb_path, knowledge_base.KB_META_FILE)] if kb_path is not None else []
+
+        # a searcher given in place of the NER model, such as a stub, can describe its own version
+        searcher_version = None
+        if self._searcher is not None and hasattr(self._searcher, 'version'):
+            searcher_version = self._searcher.version()
+
+        return result_cache.combine_versions(
+            result_cache.file_fingerprint(kb_files),
+            self.model_name,
+            result_cache.package_version(self.model_name),
+            result_cache.package_version('scispacy'),
+            searcher_kwargs,
+            searcher_version,
+            self.single_pass
+        )
+
     def create_database(self, data_dir: str) -> pd.DataFrame:
         """
         Creates pandas DataFrame database of diseases and underlying factors
-        Also saves the database for future retrieval
+        Also saves the database and a manifest of the processed notes for future retrieval
 
         Parameters
         ----------
@@ -52,27 +265,85 @@ class DiagnosisDatabase:
                 factors: factors for each disease as found in the clinical notes
 
         """
-        # create data path
-        data_path = os.path.join(data_dir, 'training_20180910')
-
         # load the clinical notes data
-        txt_df = load_data.load_txt(data_path)
+        with profiling.stage('build.load_notes'):
+            txt_df = self.load_notes(data_dir)
+
+        # clean and expand the clinical notes data
+        linked_cuis = {}
+        with profiling.stage('build.process_notes'):
+            processed_df = self.process_notes(txt_df, linked_cuis)
 
-        # clearn and expand the clinical notes data
-        txt_df = df_utils.split_txt_df(txt_df)
-        txt_df = df_utils.get_primary_diseases(txt_df, self.searcher)
-        txt_df = df_utils.get_underlying_factors(txt_df, self.searcher)
+        # record what was extracted from each note so later updates only process changed notes
+        with profiling.stage('build.create_manifest'):
+            note_manifest = manifest.create_manifest(txt_df, processed_df)
+        del txt_df
 
         # create the disease database
-        disease_db = df_utils.create_disease_df(txt_df)
+        with profiling.stage('build.create_database'):
+            disease_db = df_utils.create_disease_df(processed_df)
+            disease_db = df_utils.get_disease_identifiers(disease_db, self.searcher, linked_cuis)
 
         # save the disease database for faster retrieval in the future
-        disease_db.to_pickle(os.path.join(data_dir, 'disease_db.pkl'))
+        with profiling.stage('build.save_database'):
+            self.save_database(data_dir, disease_db, note_manifest)
         return disease_db
 
-    def create_or_load_database(self, data_dir: str) -> pd.DataFrame:
+    def update_database(
+            self,
+            data_dir: str,
+            note_manifest: pd.DataFrame
+    ) -> Union[pd.DataFrame, storage.CompactDatabase]:
         """
-        Load the saved database if it exists, otherwise create and save one
+        Updates the saved database by processing only the clinical notes which were added or changed
+        since the manifest was saved, and removing the notes which were deleted
+
+        Parameters
+        ----------
+        data_dir: str
+            Directory where clinical notes data is located in the subdirectory training_20180910
+        note_manifest: pandas DataFrame
+            The manifest saved alongside the database, as output by utils.manifest.create_manifest
+
+        Returns
+        -------
+        pandas DataFrame or utils.storage.CompactDatabase
+            The same database as self.create_database would give on the current clinical notes
+
+        """
+        # load the clinical notes data and find what changed
+        with profiling.stage('build.load_notes'):
+            txt_df = self.load_notes(data_dir)
+            stale_df, deleted = manifest.diff_manifest(note_manifest, txt_df)
+        print(f'{len(stale_df)} new or changed notes, {len(deleted)} deleted notes')
+
+        # nothing to do so use the saved database
+        if stale_df.empty and not deleted:
+            return self.load_database(data_dir)
+
+        # the diseases of unchanged notes keep the concepts they were linked from when they were saved
+        linked_cuis = self.saved_cuis(data_dir)
+
+        # only process the stale notes and patch them into the manifest
+        with profiling.stage('build.process_notes'):
+            processed_df = self.process_notes(stale_df, linked_cuis) if not stale_df.empty else stale_df.assign(
+                primary_diseases=[], underlying_factors=[]
+            )
+        with profiling.stage('build.update_manifest'):
+            note_manifest = manifest.update_manifest(note_manifest, txt_df, stale_df, processed_df)
+        del txt_df, stale_df
+
+        # recreate the disease database from the extracted diseases of every note
+        with profiling.stage('build.create_database'):
+            disease_db = df_utils.create_disease_df(note_manifest)
+            disease_db = df_utils.get_disease_identifiers(disease_db, self.searcher, linked_cuis)
+        with profiling.stage('build.save_database'):
+            self.save_database(data_dir, disease_db, note_manifest)
+        return disease_db
+
+    def load_notes(self, data_dir: str) -> pd.DataFrame:
+        """
+        Loads the clinical notes, through the snapshot of the notes if it is enabled
 
         Parameters
         ----------
@@ -82,77 +353,655 @@ class DiagnosisDatabase:
         Returns
         -------
         pandas DataFrame
-            The saved data frame disease_db.pkl if it exists
+            The clinical notes DataFrame as output by utils.load_data.load_txt
+
+        """
+        # create data path
+        data_path = os.path.join(data_dir, 'training_20180910')
+        snapshot_path = os.path.join(data_dir, NOTES_SNAPSHOT_FILE) if self.snapshot else None
+        return load_data.load_txt(data_path, snapshot_path=snapshot_path)
+
+    def process_notes(self, txt_df: pd.DataFrame, linked_cuis: Dict[str, str] = None) -> pd.DataFrame:
+        """
+        Extracts the primary diseases and underlying factors of clinical notes,
+        sharded across worker processes if requested
+
+        Parameters
+        ----------
+        txt_df: pandas DataFrame
+            The clinical notes DataFrame as output by utils.load_data.load_txt
+        linked_cuis: Dict[str, str] (default=None)
+            If given, filled with the concept identifier each extracted disease was first linked from,
+            see nlp.DiseaseSearcher.linked_cuis
+
+        Returns
+        -------
+        pandas DataFrame
+            A DataFrame including the columns "file_idx", "primary_diseases", and "underlying_factors"
+
+        """
+        if self.n_workers > 1:
+            return parallel.process_txt_df_parallel(
+                txt_df,
+                self.model_name,
+                n_workers=self.n_workers,
+                chunk_size=self.chunk_size,
+                batch_size=self.batch_size,
+                single_pass=self.single_pass,
+                searcher_kwargs=self.searcher_kwargs,
+                linked_cuis=linked_cuis
+            )
+
+        processed_df = df_utils.process_txt_df(
+            txt_df,
+            self.searcher,
+            self.batch_size,
+            self.n_process,
+            single_pass=self.single_pass
+        )
+        self.save_link_cache()
+        if linked_cuis is not None:
+            for name, cui in self.searcher.linked_cuis.items():
+                linked_cuis.setdefault(name, cui)
+        return processed_df
+
+    def saved_cuis(self, data_dir: str) -> Dict[str, str]:
+        """
+        The concept identifiers of the diseases of the saved database
+
+        Parameters
+        ----------
+        data_dir: str
+            Directory where the database is saved
+
+        Returns
+        -------
+        Dict[str, str]
+            A mapping from the canonical name of each disease with a known concept to its concept identifier
+
+        """
+        saved_db = self.load_database(data_dir)
+        if 'cui' not in saved_db:
+            return {}
+        return {disease: cui for disease, cui in zip(saved_db['disease'], saved_db['cui']) if isinstance(cui, str)}
+
+    def save_database(self, data_dir: str, disease_db: pd.DataFrame, note_manifest: pd.DataFrame) -> None:
+        """
+        Saves the database in self.storage_format and the manifest of the notes it was created from
+
+        Parameters
+        ----------
+        data_dir: str
+            Directory where the database is saved
+        disease_db: pandas DataFrame
+            The database, as output by utils.df_utils.create_disease_df
+        note_manifest: pandas DataFrame
+            The manifest, as output by utils.manifest.create_manifest
+        """
+        if self.storage_format == 'compact':
+            storage.save_compact(disease_db, os.path.join(data_dir, COMPACT_DIR))
+        else:
+            disease_db.to_pickle(os.path.join(data_dir, DATABASE_FILE))
+        note_manifest.to_pickle(os.path.join(data_dir, MANIFEST_FILE))
+        manifest.save_fingerprint(os.path.join(data_dir, FINGERPRINT_FILE), self.extraction_fingerprint())
+
+    def has_saved_database(self, data_dir: str) -> bool:
+        return os.path.isfile(os.path.join(data_dir, DATABASE_FILE)) or (
+            self.storage_format == 'compact' and storage.is_compact(os.path.join(data_dir, COMPACT_DIR))
+        )
+
+    def load_database(self, data_dir: str) -> Union[pd.DataFrame, storage.CompactDatabase]:
+        """
+        Load the saved database in self.storage_format
+
+        Parameters
+        ----------
+        data_dir: str
+            Directory where the database is saved
+
+        Returns
+        -------
+        pandas DataFrame or utils.storage.CompactDatabase
+            The pickled DataFrame, or the memory-mapped compact database
+            If the compact format is requested but only a pickle exists, the pickle is converted first
+
+        """
+        compact_path = os.path.join(data_dir, COMPACT_DIR)
+        if self.storage_format == 'compact':
+            if not storage.is_compact(compact_path):
+                print('Converting saved database to the compact format')
+                storage.save_compact(pd.read_pickle(os.path.join(data_dir, DATABASE_FILE)), compact_path)
+            return storage.CompactDatabase(compact_path)
+        return pd.read_pickle(os.path.join(data_dir, DATABASE_FILE))
+
+    def create_or_load_database(self, data_dir: str) -> Union[pd.DataFrame, storage.CompactDatabase]:
+        """
+        Load the saved database if it exists, otherwise create and save one
+        If self.refresh is set, the saved database is first updated with any added, changed, or deleted notes
+
+        Parameters
+        ----------
+        data_dir: str
+            Directory where clinical notes data is located in the subdirectory training_20180910
+
+        Returns
+        -------
+        pandas DataFrame or utils.storage.CompactDatabase
+            The saved database if it exists, see self.load_database
             otherwise the output of self.create_database
 
         """
 
         # check if we can load the file
-        if os.path.isfile(os.path.join(data_dir, 'disease_db.pkl')):
-            print('Loading saved database')
-            return pd.read_pickle(os.path.join(data_dir, 'disease_db.pkl'))
+        if self.has_saved_database(data_dir):
+            if not self.refresh:
+                print('Loading saved database')
+                return self.load_database(data_dir)
+
+            # update the database with the changed notes if we know which notes were processed
+            # the saved extractions can only be kept if they were made with the same model and settings
+            note_manifest = manifest.load_manifest(os.path.join(data_dir, MANIFEST_FILE))
+            fingerprint = manifest.load_fingerprint(os.path.join(data_dir, FINGERPRINT_FILE))
+            if note_manifest is None:
+                print('No manifest for saved database')
+            elif fingerprint != self.extraction_fingerprint():
+                print('Extraction settings changed since the saved database was created')
+            else:
+                print('Updating saved database')
+                return self.update_database(data_dir, note_manifest)
 
         # file does not exist so create one instead
         print('Creating and saving new database')
         return self.create_database(data_dir)
 
-    def find_factors(self, disease: str) -> List[str]:
+    @staticmethod
+    def build_index(database: Union[pd.DataFrame, storage.CompactDatabase]) -> Dict[str, int]:
+        """
+        Creates a hash index of the diseases in the database
+
+        Parameters
+        ----------
+        database: pandas DataFrame or utils.storage.CompactDatabase
+            A database of diseases as output by utils.df_utils.create_disease_df,
+            optionally with the columns added by utils.df_utils.get_disease_identifiers
+
+        Returns
+        -------
+        Dict[str, int]
+            A dictionary whose keys are normalized canonical names, concept identifiers, and aliases of diseases
+            and whose values are the positions of the corresponding rows in the database
+            Canonical names take precedence over identifiers, which take precedence over aliases
+
+        """
+        # index the canonical names
+        index = DiagnosisDatabase.build_name_index(database)
+
+        # databases created before identifiers were stored can only be looked up by canonical name
+        if 'cui' not in database:
+            return index
+
+        # index the concept identifiers and then the aliases
+        for row, cui in enumerate(database['cui']):
+            if cui:
+                index.setdefault(text_utils.normalize_name(cui), row)
+        for row, aliases in enumerate(database['aliases']):
+            for alias in aliases:
+                index.setdefault(text_utils.normalize_name(alias), row)
+        return index
+
+    @staticmethod
+    def build_name_index(database: Union[pd.DataFrame, storage.CompactDatabase]) -> Dict[str, int]:
+        """
+        Creates a hash index of the diseases in the database by canonical name only
+
+        Parameters
+        ----------
+        database: pandas DataFrame or utils.storage.CompactDatabase
+            A database of diseases as output by utils.df_utils.create_disease_df
+
+        Returns
+        -------
+        Dict[str, int]
+            A dictionary whose keys are normalized canonical names of diseases
+            and whose values are the positions of the corresponding rows in the database
+
+        """
+        index = {}
+        for row, disease in enumerate(database['disease']):
+            index.setdefault(text_utils.normalize_name(disease), row)
+        return index
+
+    def find_factors(
+            self,
+            disease: str,
+            rank_by: str = 'count',
+            top_k: int = None,
+            min_support: int = 1
+    ) -> List[str]:
         """
         Find the corresponding factors for the given disease in the database
+        Names found in the index are looked up directly, otherwise the NER model is used to find the canonical name
 
         Parameters
         ----------
         disease: str
             The name of a disease
             Note it does not have to be a canonical name
+        rank_by: str (default='count')
+            One of RANKINGS, how the factors are ordered
+            'count' ranks by the number of notes in which the factor occurs with the disease,
+            'lift' by how many times more often the factor occurs with the disease than in all notes
+        top_k: int (default=None)
+            If given, at most this many factors are returned
+        min_support: int (default=1)
+            Only factors which occur with the disease in at least this many notes are returned
 
         Returns
         -------
         List[str]
             The canonical names of the diseases which are factors of the given disease,
-            as extracted from the database
+            as extracted from the database, from highest to lowest rank
 
         """
-        # extract entities
-        doc = self.searcher.nlp(disease)
+        check_factor_options(rank_by, top_k, min_support)
 
-        # if no entities, return nothing
-        if len(doc.ents) == 0:
-            return []
+        # look for the name in the index without running the NER model
+        row = self.index.get(text_utils.normalize_name(disease))
 
-        # get first entity
-        entity = doc.ents[0]
+        if row is None:
+            # get the canonical name of the disease
+            disease = self.searcher.link(disease)
 
-        # if no canonical names of this disease, return nothing
-        if len(entity._.kb_ents) == 0:
-            return []
+            # if no canonical names of this disease, return nothing
+            if disease is None:
+                return []
 
-        # get the canonical name of the disease
-        disease = self.searcher.linker.kb.cui_to_entity[entity._.kb_ents[0][0]].canonical_name
+            # look for canonical name in database
+            row = self.index.get(text_utils.normalize_name(disease))
 
-        # look for canonical name in database and return factors if it exists
-        # otherwise return nothing
-        try:
-            return self.database.loc[self.database.disease == disease].factors.values[0]
-        except IndexError:
+        # return factors if it exists otherwise return nothing
+        if row is None:
             return []
+        return self.ranked_factors(row, rank_by, top_k, min_support)
+
+    def find_factors_many(
+            self,
+            diseases: Iterable[str],
+            rank_by: str = 'count',
+            top_k: int = None,
+            min_support: int = 1
+    ) -> List[List[str]]:
+        """
+        Batched version of self.find_factors, which looks all names up in the index at once and links
+        the names which are not in it with a single batched pass of the NER model
 
+        Parameters
+        ----------
+        diseases: Iterable[str]
+            The names of diseases, which do not have to be canonical names
+        rank_by: str (default='count')
+            One of RANKINGS, how the factors are ordered, see self.find_factors
+        top_k: int (default=None)
+            If given, at most this many factors are returned per disease
+        min_support: int (default=1)
+            Only factors which occur with a disease in at least this many notes are returned
 
-if __name__ == '__main__':
-    warnings.filterwarnings('ignore')
+        Returns
+        -------
+        List[List[str]]
+            For each disease, in order, the output of self.find_factors
 
-    if len(sys.argv) <= 1:
-        raise KeyError('No disease given')
+        """
+        check_factor_options(rank_by, top_k, min_support)
+
+        # look for each distinct name in the index without running the NER model
+        keys = [text_utils.normalize_name(disease) for disease in diseases]
+        rows = {key: self.index.get(key) for key in set(keys)}
+
+        # link the names which were not found in one pass of the NER model and look up their canonical names
+        unknown = [key for key, row in rows.items() if row is None]
+        if unknown:
+            linked = self.searcher.link_batch(unknown, batch_size=self.batch_size)
+            for key, disease in zip(unknown, linked):
+                if disease is not None:
+                    rows[key] = self.index.get(text_utils.normalize_name(disease))
+
+        # rank the factors of each distinct row once
+        factors = {row: self.ranked_factors(row, rank_by, top_k, min_support) for row in set(rows.values())
+                   if row is not None}
+        return [list(factors[rows[key]]) if rows[key] is not None else [] for key in keys]
+
+    def ranked_factors(self, row: int, rank_by: str = 'count', top_k: int = None, min_support: int = 1) -> List[str]:
+        """
+        The factors of the disease at a row of the database, ranked and filtered as described in self.find_factors
+        """
+        factors = self.get_row('factors', row)
+
+        # databases created before counts were stored keep their factors unranked
+        if 'counts' not in self._database:
+            return factors[:top_k]
+
+        # factors are stored by decreasing count, so filter and reorder them if needed
+        counts = self.get_row('counts', row)
+        ranked = [(factor, count, index) for index, (factor, count) in enumerate(zip(factors, counts))
+                  if count >= min_support]
+        if rank_by == 'lift':
+            lifts = self.get_row('lifts', row)
+            ranked.sort(key=lambda x: (-lifts[x[2]], -x[1]))
+        return [factor for factor, _, _ in ranked[:top_k]]
+
+    def find_diseases(self, factor: str, top_k: int = None) -> List[str]:
+        """
+        Find the diseases whose notes the given factor occurs in, the reverse of self.find_factors
+
+        Parameters
+        ----------
+        factor: str
+            The canonical name of a factor, as output by self.find_factors or DiseaseSearcher.get_factors
+        top_k: int (default=None)
+            If given, at most this many diseases are returned
+
+        Returns
+        -------
+        List[str]
+            The canonical names of the diseases the factor occurs with, from the most to the least notes
+
+        """
+        return self.scorer.find_diseases(factor, top_k)
+
+    def match_factors(self, primary_diseases: Iterable[str], factors: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Find the factors of a clinical note which are known factors of each of its primary diseases
+        The diseases are looked up by canonical name and the factors are compared by integer id,
+        so the NER model is never run
+        A primary disease which is only an alias or identifier of another disease is not matched to it
+
+        Parameters
+        ----------
+        primary_diseases: Iterable[str]
+            The canonical names of the primary diseases of a note, as output by DiseaseSearcher.get_diseases
+        factors: Iterable[str]
+            The canonical names of the factors found in the note
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            For each primary disease, the factors of the note which occur with it in the database,
+            from the most to the least frequent, or an empty list if the disease is not in the database
+
+        """
+        primary_diseases = list(primary_diseases)
+        rows = [self.name_index.get(text_utils.normalize_name(disease)) for disease in primary_diseases]
+        return dict(zip(primary_diseases, self.scorer.match_factors(rows, factors)))
+
+    def rank_diseases(
+            self,
+            factors: Iterable[str],
+            weighting: str = 'frequency',
+            top_k: int = 10
+    ) -> List[Tuple[str, float]]:
+        """
+        Rank the candidate primary diseases of a clinical note by the weighted overlap of the factors found in it
+        with the factors of each disease in the database
+
+        Parameters
+        ----------
+        factors: Iterable[str]
+            The canonical names of the factors found in a note
+        weighting: str (default='frequency')
+            One of utils.scoring.WEIGHTINGS, how much each shared factor adds to the score of a disease
+        top_k: int (default=10)
+            The maximum number of diseases returned, or None for all diseases sharing a factor with the note
+
+        Returns
+        -------
+        List[Tuple[str, float]]
+            Pairs of a disease and its score, from the highest to the lowest score
+
+        """
+        return self.scorer.score(factors, weighting, top_k)
+
+    def rank_diseases_batch(
+            self,
+            factor_lists: Iterable[Iterable[str]],
+            weighting: str = 'frequency',
+            top_k: int = 10
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Batched version of self.rank_diseases, which scores all notes with one sparse matrix product
+
+        Parameters
+        ----------
+        factor_lists: Iterable[Iterable[str]]
+            For each note, the canonical names of the factors found in it
+        weighting: str (default='frequency')
+            One of utils.scoring.WEIGHTINGS
+        top_k: int (default=10)
+            The maximum number of diseases returned per note
+
+        Returns
+        -------
+        List[List[Tuple[str, float]]]
+            For each note, the output of self.rank_diseases
+
+        """
+        return self.scorer.score_batch(factor_lists, weighting, top_k)
+
+    def get_row(self, column: str, row: int):
+        """
+        Look up the value of a column of the database at a row, without decoding the rest of a compact database
+
+        Parameters
+        ----------
+        column: str
+            The name of the column
+        row: int
+            The position of the row, as given by self.index
+
+        Returns
+        -------
+        The value of the column at the row
+
+        """
+        if isinstance(self._database, storage.CompactDatabase):
+            return self._database.row(column, row)
+        return self._database[column].values[row]
+
+
+def add_database_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the command line options shared by the scripts which load a DiagnosisDatabase
+
+    Parameters
+    ----------
+    parser: argparse.ArgumentParser
+        The parser of the script
+    """
+    parser.add_argument('--data-dir', default='data',
+                        help='directory of the saved database and the training_20180910 clinical notes')
+    parser.add_argument('--model', default='en_ner_bc5cdr_md', help='name of the scispacy NER model')
+    parser.add_argument('--profile', default='full', choices=list(PIPELINE_PROFILES),
+                        help='components of the NER model to load, minimal only loads what entity recognition needs')
+    parser.add_argument('--storage', default='pickle', choices=STORAGE_FORMATS,
+                        help='format the database is saved and loaded in, compact is memory-mapped and loads fastest')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of notes passed through the NER model at a time, when building and in bulk mode')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes which build the database from shards of the notes, '
+                             'each with its own NER model')
+    parser.add_argument('--chunk-size', type=int, default=parallel.DEFAULT_CHUNK_SIZE,
+                        help='number of notes given to a worker process at a time when --workers is more than 1')
+    parser.add_argument('--refresh', action='store_true',
+                        help='update the saved database with the notes added, changed, or deleted since it was created, '
+                             'rebuilding it if the model or extraction options changed')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='pass the relevant sections of each note through the NER model once, assigning diseases '
+                             'to the primary diagnoses or the factors by their position, both when building the '
+                             'database and when diagnosing notes')
+    parser.add_argument('--kb', default=None,
+                        help='directory of a restricted knowledge base created by knowledge_base.py, '
+                             'linked to instead of the full UMLS to save memory and loading time')
+    parser.add_argument('--link-labels', nargs='+', default=list(DEFAULT_LINK_LABELS),
+                        help='labels of the entities linked to the knowledge base, all to link every entity')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='keep a Parquet snapshot of the clinical notes so that rebuilds only read changed notes')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='lowest level of the logged messages, DEBUG logs the duration of every stage')
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'],
+                        help='json logs each message as a JSON object on its own line')
+    parser.add_argument('--metrics-file', default=None,
+                        help='record per-stage durations, entity counts, and cache hits, '
+                             'and write them to this file in the Prometheus text format on exit')
+
+
+def database_from_args(args: argparse.Namespace) -> DiagnosisDatabase:
+    """
+    Creates the DiagnosisDatabase described by the options of add_database_arguments
 
-    db = DiagnosisDatabase('data', 'en_ner_bc5cdr_md')
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The parsed command line options
+
+    Returns
+    -------
+    DiagnosisDatabase
+        The database, with its link cache kept in the data directory
+
+    """
+    metrics.configure_logging(args.log_level, json_format=args.log_format == 'json')
+    if args.metrics_file is not None:
+        metrics.METRICS.enabled = True
+
+    # cached links point into the knowledge base they were made with, so each knowledge base has its own cache
+    link_cache_file = 'link_cache.pkl'
+    if args.kb is not None:
+        link_cache_file = f'link_cache_{os.path.basename(os.path.normpath(args.kb))}.pkl'
+
+    return DiagnosisDatabase(
+        args.data_dir,
+        args.model,
+        batch_size=args.batch_size,
+        n_workers=args.workers,
+        chunk_size=args.chunk_size,
+        refresh=args.refresh,
+        single_pass=args.single_pass,
+        storage_format=args.storage,
+        snapshot=args.snapshot,
+        profile=args.profile,
+        kb_path=args.kb,
+        link_cache_path=os.path.join(args.data_dir, link_cache_file),
+        link_labels=None if 'all' in args.link_labels else args.link_labels
+    )
+
+
+def write_metrics_from_args(args: argparse.Namespace) -> None:
+    """
+    Writes the recorded metrics to the file given by the --metrics-file option of add_database_arguments, if any
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The parsed command line options
+    """
+    if args.metrics_file is not None:
+        metrics.METRICS.write_prometheus(args.metrics_file)
 
-    diseases = [' '.join(x.split('_')) for x in sys.argv[1:]]
-    for disease in diseases:
-        print(f'Underlying Factors for {disease}:')
-        factors = db.find_factors(disease)
 
-        if not factors:
-            print('Disease not found in database')
+def read_names(file: TextIO) -> List[str]:
+    """
+    Reads disease names, one per line, skipping blank lines
+    """
+    with file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def write_factors(
+        diseases: List[str],
+        factors: List[List[str]],
+        output: TextIO,
+        output_format: str = 'text',
+        reverse: bool = False
+) -> None:
+    """
+    Writes the factors of diseases, as output by DiagnosisDatabase.find_factors_many
+
+    Parameters
+    ----------
+    diseases: List[str]
+        The names of the diseases which were looked up
+    factors: List[List[str]]
+        For each disease, its ranked factors
+    output: TextIO
+        Where the factors are written
+    output_format: str (default='text')
+        One of OUTPUT_FORMATS
+        'text' lists the factors of each disease, 'json' writes one line {"disease": name, "factors": [...]}
+        per disease, 'csv' writes the columns disease, rank, factor with one row per factor
+        and an empty rank and factor for diseases without factors
+    reverse: bool (default=False)
+        If true, the names are factors and their lists are the diseases they occur with, as output by
+        DiagnosisDatabase.find_diseases, and the fields are named accordingly
+    """
+    name_field, list_field, item_field = ('factor', 'diseases', 'disease') if reverse else ('disease', 'factors', 'factor')
+    if output_format == 'json':
+        for disease, disease_factors in zip(diseases, factors):
+            output.write(json.dumps({name_field: disease, list_field: disease_factors}) + '\n')
+    elif output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow([name_field, 'rank', item_field])
+        for disease, disease_factors in zip(diseases, factors):
+            if not disease_factors:
+                writer.writerow([disease, '', ''])
+            writer.writerows([disease, rank, factor] for rank, factor in enumerate(disease_factors))
+    else:
+        for disease, disease_factors in zip(diseases, factors):
+            output.write(f'Diseases with {disease}:\n' if reverse else f'Underlying Factors for {disease}:\n')
+            if not disease_factors:
+                output.write(f'{name_field.capitalize()} not found in database\n')
+            for index, factor in enumerate(disease_factors):
+                output.write(f'{index}. {factor}\n')
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Look up the underlying factors of diseases in the database')
+    parser.add_argument('diseases', nargs='*', help='names of diseases, with words separated by underscores')
+    parser.add_argument('--input', default=None,
+                        help='file of disease names, one per line, to look up in addition to those given (- for stdin)')
+    parser.add_argument('--reverse', action='store_true',
+                        help='look up the diseases which the given factors occur with instead')
+    parser.add_argument('--format', default='text', choices=OUTPUT_FORMATS, help='format of the factors')
+    parser.add_argument('--output', default='-', help='file the factors are written to (- for stdout)')
+    parser.add_argument('--rank-by', default='count', choices=RANKINGS, help='order of the factors')
+    parser.add_argument('--top-k', type=int, default=None, help='maximum number of factors per disease')
+    parser.add_argument('--min-support', type=int, default=1,
+                        help='minimum number of notes in which a factor occurs with the disease')
+    add_database_arguments(parser)
+    args = parser.parse_args()
+
+    diseases = [' '.join(x.split('_')) for x in args.diseases]
+    if args.input is not None:
+        diseases += read_names(sys.stdin if args.input == '-' else open(args.input, 'r'))
+    if not diseases:
+        raise KeyError('No disease given')
 
-        for index, factor in enumerate(factors):
-            print(f'{index}. {factor}')
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    try:
+        # keep progress messages out of machine readable output when it goes to stdout
+        with contextlib.redirect_stdout(sys.stderr if args.format != 'text' else sys.stdout):
+            db = database_from_args(args)
+            if args.reverse:
+                factors = [db.find_diseases(factor, top_k=args.top_k) for factor in diseases]
+            else:
+                factors = db.find_factors_many(
+                    diseases, rank_by=args.rank_by, top_k=args.top_k, min_support=args.min_support
+                )
+        write_factors(diseases, factors, output, args.format, reverse=args.reverse)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    db.save_link_cache()
+    write_metrics_from_args(args)
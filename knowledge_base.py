@@ -0,0 +1,455 @@
+import os
+import json
+import shutil
+import joblib
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from collections.abc import Mapping, Sequence
+from typing import Iterable, Iterator, List, Set, Union, Dict
+from scispacy.file_cache import cached_path
+from scispacy.linking_utils import KnowledgeBase, Entity, DEFAULT_UMLS_PATH
+from scispacy.candidate_generation import (
+    CandidateGenerator, LinkerPaths, DEFAULT_PATHS, DEFAULT_KNOWLEDGE_BASES,
+    create_tfidf_ann_index, load_approximate_nearest_neighbours_index
+)
+from utils import storage
+
+# UMLS semantic types of disorders and findings, the entities the database keeps
+# T019 Congenital Abnormality, T020 Acquired Abnormality, T033 Finding, T037 Injury or Poisoning,
+# T046 Pathologic Function, T047 Disease or Syndrome, T048 Mental or Behavioral Dysfunction,
+# T049 Cell or Molecular Dysfunction, T050 Experimental Model of Disease, T184 Sign or Symptom,
+# T190 Anatomical Abnormality, T191 Neoplastic Process
+DISORDER_TYPES = ['T019', 'T020', 'T033', 'T037', 'T046', 'T047', 'T048', 'T049', 'T050', 'T184', 'T190', 'T191']
+
+# file names of a knowledge base directory, alongside the candidate index files written by scispacy
+KB_FILE = 'kb.jsonl'
+KB_META_FILE = 'kb_meta.json'
+
+# directory of the memory-mapped knowledge base within a knowledge base directory
+MAPPED_DIR = 'mapped'
+
+
+def iter_restricted_concepts(
+        source: str,
+        types: Iterable[str] = None,
+        cuis: Iterable[str] = None
+) -> Iterator[dict]:
+    """
+    Streams the concepts of a scispacy knowledge base file which have one of the given semantic types
+    or one of the given concept identifiers
+
+    Parameters
+    ----------
+    source: str
+        A local path or URL of a knowledge base in scispacy's JSONL format, such as DEFAULT_UMLS_PATH
+        URLs are downloaded once to the scispacy cache
+    types: Iterable[str] (default=None)
+        The semantic types to keep, such as DISORDER_TYPES
+    cuis: Iterable[str] (default=None)
+        The concept identifiers to keep, such as those of the diseases in the database
+
+    Returns
+    -------
+    Iterator[dict]
+        The concepts kept, as read from the file
+
+    """
+    types = set(types or [])
+    cuis = set(cuis or [])
+    with open(cached_path(source), 'r') as file:
+        for line in file:
+            concept = json.loads(line)
+            if concept['concept_id'] in cuis or types.intersection(concept.get('types', [])):
+                yield concept
+
+
+def build_restricted_kb(
+        output_dir: str,
+        source: str = DEFAULT_UMLS_PATH,
+        types: Iterable[str] = DISORDER_TYPES,
+        cuis: Iterable[str] = None
+) -> int:
+    """
+    Builds a knowledge base and candidate index for the linker restricted to a subset of the UMLS,
+    which loads in a fraction of the memory and time of the full UMLS linker
+
+    Parameters
+    ----------
+    output_dir: str
+        The directory the knowledge base and its tfidf vectorizer and approximate nearest neighbours index
+        are written to, which is then passed to DiseaseSearcher as kb_path
+    source: str (default=DEFAULT_UMLS_PATH)
+        A local path or URL of the full knowledge base in scispacy's JSONL format
+    types: Iterable[str] (default=DISORDER_TYPES)
+        The semantic types of the concepts kept, or None to only keep the concepts in cuis
+    cuis: Iterable[str] (default=None)
+        The identifiers of additional concepts kept, such as those of the diseases in the database
+
+    Returns
+    -------
+    int
+        The number of concepts in the restricted knowledge base
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    types = sorted(types or [])
+    cuis = sorted(set(cuis or []))
+
+    # write the restricted concepts in the same format as the source
+    n_concepts = 0
+    with open(os.path.join(output_dir, KB_FILE), 'w') as file:
+        for concept in iter_restricted_concepts(source, types, cuis):
+            file.write(json.dumps(concept) + '\n')
+            n_concepts += 1
+    if n_concepts == 0:
+        raise ValueError(f'No concepts of {source} match the given types or identifiers')
+    print(f'Kept {n_concepts} concepts of {source}')
+
+    # fit the tfidf vectorizer and candidate index on the aliases of the restricted concepts
+    kb = KnowledgeBase(os.path.join(output_dir, KB_FILE))
+    concept_aliases, _, _ = create_tfidf_ann_index(output_dir, kb)
+
+    # save the memory-mapped copy of the knowledge base that the linker loads
+    save_mapped_kb(kb, concept_aliases, os.path.join(output_dir, MAPPED_DIR))
+
+    with open(os.path.join(output_dir, KB_META_FILE), 'w') as file:
+        json.dump({'source': source, 'types': types, 'n_cuis': len(cuis), 'n_concepts': n_concepts}, file)
+    return n_concepts
+
+
+def export_linker(output_dir: str, linker_name: str = 'umls') -> None:
+    """
+    Copies the candidate index of one of scispacy's linkers, such as the full UMLS linker, into a knowledge base
+    directory alongside a memory-mapped copy of its knowledge base, so that it can be passed to DiseaseSearcher
+    as kb_path and shared between processes like a restricted knowledge base
+
+    Parameters
+    ----------
+    output_dir: str
+        The directory the knowledge base is written to
+    linker_name: str (default='umls')
+        The name of the scispacy linker, one of the keys of scispacy's DEFAULT_PATHS
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # copy the index files from the scispacy cache, downloading them first if needed
+    for source, target in zip(DEFAULT_PATHS[linker_name], linker_paths(output_dir)):
+        shutil.copyfile(cached_path(source), target)
+
+    with open(linker_paths(output_dir).concept_aliases_list, 'r') as file:
+        concept_aliases = json.load(file)
+    kb = DEFAULT_KNOWLEDGE_BASES[linker_name]()
+    save_mapped_kb(kb, concept_aliases, os.path.join(output_dir, MAPPED_DIR))
+
+    with open(os.path.join(output_dir, KB_META_FILE), 'w') as file:
+        json.dump({'source': linker_name, 'n_concepts': len(kb.cui_to_entity)}, file)
+
+
+def save_mapped_kb(kb: KnowledgeBase, concept_aliases: List[str], path: str) -> None:
+    """
+    Saves a knowledge base as two tables in the compact format of utils.storage, which MappedKnowledgeBase
+    memory-maps instead of building dictionaries of every concept and alias in each process
+        concepts: the concept_id, canonical_name, aliases, types, and definition of each concept,
+                  sorted by concept_id so that concepts are found by binary search
+        aliases: each alias in the order of the candidate index, the rows of its concepts,
+                 and the "order" of the aliases when sorted so that aliases are found by binary search
+
+    Parameters
+    ----------
+    kb: scispacy KnowledgeBase
+        The knowledge base
+    concept_aliases: List[str]
+        The aliases in the order of the candidate index, as in its concept_aliases.json file
+    path: str
+        The directory to save to
+    """
+    concepts = sorted(kb.cui_to_entity.values(), key=lambda entity: entity.concept_id)
+    concept_rows = {entity.concept_id: row for row, entity in enumerate(concepts)}
+    storage.save_compact(pd.DataFrame({
+        'concept_id': [entity.concept_id for entity in concepts],
+        'canonical_name': [entity.canonical_name for entity in concepts],
+        'aliases': [list(entity.aliases) for entity in concepts],
+        'types': [list(entity.types) for entity in concepts],
+        'definition': [entity.definition for entity in concepts]
+    }), os.path.join(path, 'concepts'))
+
+    # aliases which are not in the candidate index go after those which are, so the index positions still match
+    indexed = set(concept_aliases)
+    aliases = list(concept_aliases) + [alias for alias in kb.alias_to_cuis if alias not in indexed]
+    storage.save_compact(pd.DataFrame({
+        'alias': aliases,
+        'concepts': [sorted(concept_rows[cui] for cui in kb.alias_to_cuis.get(alias, [])) for alias in aliases],
+        'order': np.asarray(sorted(range(len(aliases)), key=aliases.__getitem__), dtype=np.int64)
+    }), os.path.join(path, 'aliases'))
+
+
+class _MappedColumn(Sequence):
+    """
+    A string column of a memory-mapped table, decoded one value at a time
+    """
+    def __init__(self, table: storage.CompactDatabase, column: str):
+        self._table = table
+        self._column = column
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __getitem__(self, row: int) -> str:
+        return self._table.row(self._column, int(row))
+
+
+def _find_row(table: storage.CompactDatabase, column: str, key: str, order: np.ndarray = None) -> Union[int, None]:
+    """
+    Binary search for the row of a sorted string column which equals key
+
+    Parameters
+    ----------
+    table: utils.storage.CompactDatabase
+        The table
+    column: str
+        A string column, either sorted itself or sorted by order
+    key: str
+        The value to look for
+    order: numpy ndarray (default=None)
+        The rows of the table in sorted order of the column, or None if the column is sorted
+
+    Returns
+    -------
+    int or None
+        The row whose value is key, or None if there is none
+
+    """
+    low, high = 0, len(table)
+    while low < high:
+        middle = (low + high) // 2
+        row = middle if order is None else int(order[middle])
+        value = table.row(column, row)
+        if value == key:
+            return row
+        if value < key:
+            low = middle + 1
+        else:
+            high = middle
+    return None
+
+
+class _MappedConcepts(Mapping):
+    """
+    The read only cui_to_entity mapping of a MappedKnowledgeBase
+    """
+    def __init__(self, table: storage.CompactDatabase):
+        self._table = table
+
+    def entity(self, row: int) -> Entity:
+        return Entity(*[self._table.row(column, row) for column in Entity._fields])
+
+    def __getitem__(self, cui: str) -> Entity:
+        row = _find_row(self._table, 'concept_id', cui)
+        if row is None:
+            raise KeyError(cui)
+        return self.entity(row)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._table.row('concept_id', row) for row in range(len(self._table)))
+
+    def values(self) -> Iterator[Entity]:
+        return (self.entity(row) for row in range(len(self._table)))
+
+
+class _MappedAliases(Mapping):
+    """
+    The read only alias_to_cuis mapping of a MappedKnowledgeBase
+    """
+    def __init__(self, table: storage.CompactDatabase, concepts: storage.CompactDatabase):
+        self._table = table
+        self._concepts = concepts
+        self._order = table.array('order')
+
+    def __getitem__(self, alias: str) -> Set[str]:
+        row = _find_row(self._table, 'alias', alias, self._order)
+        if row is None:
+            raise KeyError(alias)
+        return {self._concepts.row('concept_id', concept) for concept in self._table.row('concepts', row)}
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._table.row('alias', row) for row in range(len(self._table)))
+
+
+class MappedKnowledgeBase:
+    """
+    A read only knowledge base saved by save_mapped_kb, with the same cui_to_entity and alias_to_cuis mappings
+    as scispacy's KnowledgeBase, whose arrays are memory-mapped and whose entries are only decoded when looked up
+
+    Every process which loads the same directory, such as the worker processes of a parallel build,
+    shares one copy of the knowledge base through the page cache instead of holding its own dictionaries
+    When pickled, only the path is sent, so spawned processes map the files again instead of copying them
+
+    Attributes:
+        path: str
+            The directory the knowledge base was loaded from
+        cui_to_entity: Mapping[str, Entity]
+            The entity of each concept identifier
+        alias_to_cuis: Mapping[str, Set[str]]
+            The concept identifiers of each alias
+        aliases: Sequence[str]
+            The aliases in the order of the candidate index, to be used as its concept aliases list
+    """
+    def __init__(self, path: str):
+        """
+        Memory-maps a knowledge base saved by save_mapped_kb
+
+        Parameters
+        ----------
+        path: str
+            The directory the knowledge base was saved to
+        """
+        self.path = path
+        concepts = storage.CompactDatabase(os.path.join(path, 'concepts'))
+        aliases = storage.CompactDatabase(os.path.join(path, 'aliases'))
+        self.cui_to_entity = _MappedConcepts(concepts)
+        self.alias_to_cuis = _MappedAliases(aliases, concepts)
+        self.aliases = _MappedColumn(aliases, 'alias')
+        self._concepts = concepts
+
+    def __reduce__(self):
+        return MappedKnowledgeBase, (self.path,)
+
+    def find_canonical_names(self, names: Iterable[str]) -> Dict[str, Entity]:
+        """
+        Looks up entities by canonical name, only decoding the canonical names of the other concepts
+
+        Parameters
+        ----------
+        names: Iterable[str]
+            Canonical names of concepts
+
+        Returns
+        -------
+        Dict[str, Entity]
+            The first entity in concept identifier order with each canonical name that was found
+
+        """
+        names = set(names)
+        entities = {}
+        for row in range(len(self._concepts)):
+            name = self._concepts.row('canonical_name', row)
+            if name in names and name not in entities:
+                entities[name] = self.cui_to_entity.entity(row)
+        return entities
+
+
+def linker_paths(kb_path: str) -> LinkerPaths:
+    """
+    The paths of the candidate index files of a knowledge base directory written by build_restricted_kb
+    """
+    return LinkerPaths(
+        ann_index=os.path.join(kb_path, 'nmslib_index.bin'),
+        tfidf_vectorizer=os.path.join(kb_path, 'tfidf_vectorizer.joblib'),
+        tfidf_vectors=os.path.join(kb_path, 'tfidf_vectors_sparse.npz'),
+        concept_aliases_list=os.path.join(kb_path, 'concept_aliases.json')
+    )
+
+
+def is_kb_dir(kb_path: str) -> bool:
+    has_kb = os.path.isfile(os.path.join(kb_path, KB_FILE)) or is_mapped(kb_path)
+    return has_kb and all(os.path.isfile(path) for path in linker_paths(kb_path))
+
+
+def is_mapped(kb_path: str) -> bool:
+    return all(storage.is_compact(os.path.join(kb_path, MAPPED_DIR, table)) for table in ['concepts', 'aliases'])
+
+
+def load_candidate_generator(kb_path: str, ef_search: int = 200) -> CandidateGenerator:
+    """
+    Loads the candidate generator of a knowledge base directory written by build_restricted_kb
+
+    Parameters
+    ----------
+    kb_path: str
+        The directory of the knowledge base
+    ef_search: int (default=200)
+        The search depth of the approximate nearest neighbours index, as in scispacy's CandidateGenerator
+
+    Returns
+    -------
+    scispacy CandidateGenerator
+        The candidate generator, to be passed to scispacy's EntityLinker
+        Its knowledge base is a MappedKnowledgeBase if the directory has one, otherwise it is read from kb.jsonl
+        The approximate nearest neighbours index is still loaded into the memory of each process
+
+    """
+    if not is_kb_dir(kb_path):
+        raise FileNotFoundError(f'{kb_path} is not a knowledge base directory, create it with knowledge_base.py')
+    paths = linker_paths(kb_path)
+
+    # attach to the memory-mapped knowledge base if there is one
+    if is_mapped(kb_path):
+        kb = MappedKnowledgeBase(os.path.join(kb_path, MAPPED_DIR))
+        concept_aliases = kb.aliases
+    else:
+        kb = KnowledgeBase(os.path.join(kb_path, KB_FILE))
+        with open(paths.concept_aliases_list, 'r') as file:
+            concept_aliases = json.load(file)
+
+    return CandidateGenerator(
+        ann_index=load_approximate_nearest_neighbours_index(paths, ef_search=ef_search),
+        tfidf_vectorizer=joblib.load(paths.tfidf_vectorizer),
+        ann_concept_aliases_list=concept_aliases,
+        kb=kb
+    )
+
+
+def database_cuis(path: str) -> Set[str]:
+    """
+    The concept identifiers of the diseases of a saved database
+
+    Parameters
+    ----------
+    path: str
+        The pickled database disease_db.pkl or the directory of a compact database
+
+    Returns
+    -------
+    Set[str]
+        The identifiers of the diseases which were found in the knowledge base
+
+    """
+    database = storage.CompactDatabase(path) if storage.is_compact(path) else pd.read_pickle(path)
+    if 'cui' not in database:
+        raise ValueError(f'The database {path} has no concept identifiers, create it again to store them')
+    return {cui for cui in database['cui'] if cui}
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Build a knowledge base for the linker restricted to disorders')
+    parser.add_argument('--output', default='data/disorders_kb', help='directory the knowledge base is written to')
+    parser.add_argument('--full', action='store_true',
+                        help='export the whole UMLS linker with a memory-mapped knowledge base instead of restricting it')
+    parser.add_argument('--source', default=DEFAULT_UMLS_PATH,
+                        help='local path or URL of the full knowledge base in scispacy JSONL format')
+    parser.add_argument('--types', nargs='*', default=DISORDER_TYPES, help='UMLS semantic types of the concepts kept')
+    parser.add_argument('--no-types', action='store_true',
+                        help='keep no concepts by semantic type, only those of --cuis-from')
+    parser.add_argument('--cuis-from', default=None,
+                        help='saved database (disease_db.pkl or the compact disease_db directory) '
+                             'whose concepts are also kept')
+    args = parser.parse_args()
+
+    if args.full:
+        export_linker(args.output)
+    else:
+        types: Union[List[str], None] = None if args.no_types else args.types
+        cuis = database_cuis(args.cuis_from) if args.cuis_from is not None else None
+        if not types and not cuis:
+            raise ValueError('No semantic types or database given, the knowledge base would be empty')
+        build_restricted_kb(args.output, args.source, types, cuis)
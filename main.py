@@ -1,9 +1,16 @@
-from database import DiagnosisDatabase
-from utils import text_utils
-import sys
+from database import DiagnosisDatabase, add_database_arguments, database_from_args, write_metrics_from_args
+from utils import text_utils, load_data, metrics
+from utils.batching import iter_batches
+from utils.parallel import WindowPool
+from utils.result_cache import ResultCache, DEFAULT_RESULT_CACHE_SIZE, combine_versions
+from nlp import DEFAULT_BATCH_SIZE
 import os
+import sys
+import json
+import contextlib
+import argparse
 import warnings
-from typing import Tuple, List
+from typing import Tuple, List, Iterable, TextIO, Union
 
 
 class DiagnosisDetector:
@@ -13,8 +20,26 @@ class DiagnosisDetector:
     Attributes:
         db: DiagnosisDatabase
             A database of diagnoses and factors with linked NER model
+        single_pass: bool
+            Whether each clinical note only goes through the NER model once
+        result_cache: ResultCache or None
+            The cached diagnoses of clinical notes which were already diagnosed, or None if they are not cached
+        window_size: int or None
+            The number of characters above which the sections of a note are split into windows, or None
+        window_overlap: int
+            The number of characters shared by consecutive windows
+        window_pool: utils.parallel.WindowPool or None
+            The worker processes which run the windows of a note in parallel, or None to run them in this process
     """
-    def __init__(self, database: DiagnosisDatabase):
+    def __init__(
+            self,
+            database: DiagnosisDatabase,
+            single_pass: bool = False,
+            result_cache: ResultCache = None,
+            window_size: int = None,
+            window_overlap: int = text_utils.DEFAULT_WINDOW_OVERLAP,
+            window_pool: WindowPool = None
+    ):
         """
         Initialized the DiagnosisDetector with the given DiagnosisDatabase instance
 
@@ -22,8 +47,29 @@ class DiagnosisDetector:
         ----------
         database: DiagnosisDatabase
             A database of diagnoses and factors with linked NER model
+        single_pass: bool (default=False)
+            If true, the relevant sections of a clinical note go through the NER model once
+            and each disease is assigned to the primary diagnoses or the factors by its position,
+            instead of running the model separately on the primary diagnosis and on all sections
+        result_cache: ResultCache (default=None)
+            If given, the diagnoses of notes are looked up in it by their text before running the NER model,
+            and stored in it afterwards
+            Its version should come from self.db.version and single_pass, see create_result_cache
+        window_size: int (default=None)
+            If given, notes whose combined sections are longer than this many characters are split into
+            overlapping windows at sentence boundaries, whose diseases are found separately and merged,
+            see utils.text_utils.find_mentions_windowed
+        window_overlap: int (default=text_utils.DEFAULT_WINDOW_OVERLAP)
+            The maximum number of characters shared by consecutive windows
+        window_pool: utils.parallel.WindowPool (default=None)
+            If given, the windows of long notes go through the NER models of its worker processes in parallel
         """
         self.db = database
+        self.single_pass = single_pass
+        self.result_cache = result_cache
+        self.window_size = window_size
+        self.window_overlap = window_overlap
+        self.window_pool = window_pool
 
     def give_diagnosis(self, text: str, print_out: bool = False) -> dict[str: str]:
         """
@@ -42,10 +88,148 @@ class DiagnosisDetector:
             A dictionary whose keys are primary diagnosis disease canonical names
             and whose values are the canonical names of factors extracted from the note
             that correspond to this disease
+            Notes without a discharge diagnosis section give an empty dictionary
+
+        """
+        # notes which were already diagnosed are answered from the result cache
+        diagnoses = self.cached_diagnoses([text])[0]
+        if diagnoses is not None:
+            if print_out:
+                self.pretty_print(diagnoses)
+            return diagnoses
+
+        with metrics.stage('give_diagnosis'):
+            primary_disease, factors = self.extract_diseases_and_factors(text)
+            diagnoses = self.get_diagnosis_and_factors(primary_disease, factors, print_out)
+        metrics.increment('notes_diagnosed')
+        if self.result_cache is not None:
+            self.result_cache.put(text, diagnoses)
+        return diagnoses
+
+    def give_diagnosis_batch(self, texts: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> List[dict[str: str]]:
+        """
+        Batched version of self.give_diagnosis, which passes the clinical notes through the NER model together
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            The texts of clinical notes
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of notes passed through the NER model at a time
+
+        Returns
+        -------
+        List[dict[str: str]]
+            For each note, the output of self.give_diagnosis
+            Notes without a discharge diagnosis section give an empty dictionary
+
+        """
+        # only run the NER model on the notes which are not in the result cache
+        texts = list(texts)
+        diagnoses = self.cached_diagnoses(texts)
+        missing = [index for index, diagnosis in enumerate(diagnoses) if diagnosis is None]
+        if not missing:
+            return diagnoses
+
+        with metrics.stage('give_diagnosis_batch'):
+            results = self.extract_diseases_and_factors_batch([texts[index] for index in missing], batch_size)
+            for index, (primary_diseases, factors) in zip(missing, results):
+                diagnoses[index] = self.get_diagnosis_and_factors(primary_diseases, factors)
+        metrics.increment('notes_diagnosed', len(missing))
+        if self.result_cache is not None:
+            for index in missing:
+                self.result_cache.put(texts[index], diagnoses[index])
+        return diagnoses
+
+    def cached_diagnoses(self, texts: List[str]) -> List[Union[dict, None]]:
+        """
+        Look up the diagnoses of clinical notes in the result cache
+
+        Parameters
+        ----------
+        texts: List[str]
+            The texts of clinical notes
+
+        Returns
+        -------
+        List[dict or None]
+            For each note, its cached diagnoses or None if they are not cached or there is no result cache
+
+        """
+        if self.result_cache is None:
+            return [None] * len(texts)
+        diagnoses = [self.result_cache.get(text) for text in texts]
+        n_hits = sum(diagnosis is not None for diagnosis in diagnoses)
+        metrics.increment('result_cache_hits', n_hits)
+        metrics.increment('result_cache_misses', len(texts) - n_hits)
+        return diagnoses
+
+    def save_result_cache(self) -> None:
+        """
+        Save the result cache, if there is one and it has a path
+        """
+        if self.result_cache is not None:
+            self.result_cache.save()
+
+    def close_window_pool(self) -> None:
+        """
+        Stop the worker processes of the windows of long notes, if there are any
+        """
+        if self.window_pool is not None:
+            self.window_pool.close()
 
+    def process_requests(self, requests: List[Tuple[str, str, dict]]) -> list:
         """
-        primary_disease, factors = self.extract_diseases_and_factors(text)
-        return self.get_diagnosis_and_factors(primary_disease, factors, print_out)
+        Answers a batch of diagnosis and factor requests, such as those grouped by a micro-batcher,
+        passing all clinical notes of the batch through the NER model together
+
+        Parameters
+        ----------
+        requests: List[Tuple[str, str, dict]]
+            Triples of the kind of request, "diagnosis" or "factors", the clinical note or disease name,
+            and keyword arguments of DiagnosisDatabase.find_factors for factor requests
+
+        Returns
+        -------
+        list
+            The diagnoses of each clinical note and the factors of each disease, in the order of requests
+            A request which fails gives the exception it raised instead, so it does not fail the rest of the batch
+
+        """
+        results = [None] * len(requests)
+
+        # diagnose all notes of the batch together, then one at a time if one of them fails
+        notes = [index for index, (kind, _, _) in enumerate(requests) if kind == 'diagnosis']
+        if notes:
+            try:
+                diagnoses = self.give_diagnosis_batch([requests[index][1] for index in notes])
+            except Exception:
+                diagnoses = [self.try_diagnosis(requests[index][1]) for index in notes]
+            for index, diagnosis in zip(notes, diagnoses):
+                results[index] = diagnosis
+
+        # look up the diseases with the same options together, linking those not in the index in one pass
+        lookups = {}
+        for index, (kind, _, options) in enumerate(requests):
+            if kind == 'factors':
+                lookups.setdefault(tuple(sorted(options.items())), []).append(index)
+        for options, indices in lookups.items():
+            try:
+                factors = self.db.find_factors_many([requests[index][1] for index in indices], **dict(options))
+            except Exception as error:
+                factors = [error] * len(indices)
+            for index, disease_factors in zip(indices, factors):
+                results[index] = disease_factors
+        return results
+
+    def try_diagnosis(self, text: str) -> Union[dict, Exception]:
+        """
+        The diagnoses of a single clinical note as given by self.give_diagnosis_batch, or the exception it raised
+        """
+        try:
+            return self.give_diagnosis_batch([text])[0]
+        except Exception as error:
+            return error
 
     def extract_diseases_and_factors(self, text: str) -> Tuple[List[str], List[str]]:
         """
@@ -63,21 +247,155 @@ class DiagnosisDetector:
             A tuple of two strings:
                 1. The list of the canonical names of the primary diagnoses
                 2. The list of the canonical names of the underlying factors
+            Notes without a discharge diagnosis section give two empty lists
 
         """
         # extract relevant sections from the clinical note
-        diagnosis, history, complaint = self.find_contexts(text)
+        with metrics.stage('sectioning'):
+            diagnosis, history, complaint = self.find_contexts(text)
+
+        # notes without a discharge diagnosis section have no primary diseases to give factors for
+        if diagnosis is None:
+            return [], []
+
+        with metrics.stage('extraction'):
+            # split long notes into windows, which can go through the NER model in parallel
+            if self.is_long((diagnosis, history, complaint)):
+                return self.extract_windowed([(diagnosis, history, complaint)])[0]
 
-        # find the primary diagnosis
-        primary_diagnosis = text_utils.find_primary_diagnoses(diagnosis)
+            # find the primary diseases and factors with one pass of the NER model
+            if self.single_pass:
+                context, primary_span = text_utils.build_routed_context(diagnosis, history, complaint)
+                return self.db.searcher.get_diseases_and_factors(context, primary_span)
 
-        # extract the canonical names of diseases in the primary diagnosis
-        primary_diseases = self.db.searcher.get_diseases(primary_diagnosis)
+            # find the primary diagnosis
+            primary_diagnosis = text_utils.find_primary_diagnoses(diagnosis)
 
-        # extract all other diseases in the relevant section
-        factors = text_utils.find_factors(diagnosis, history, complaint, primary_diseases, self.db.searcher)
+            # extract the canonical names of diseases in the primary diagnosis
+            primary_diseases = self.db.searcher.get_diseases(primary_diagnosis)
+
+            # extract all other diseases in the relevant section
+            factors = text_utils.find_factors(diagnosis, history, complaint, primary_diseases, self.db.searcher)
         return primary_diseases, factors
 
+    def extract_diseases_and_factors_batch(
+            self,
+            texts: Iterable[str],
+            batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> List[Tuple[List[str], List[str]]]:
+        """
+        Batched version of self.extract_diseases_and_factors
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            The texts of clinical notes
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of notes passed through the NER model at a time
+
+        Returns
+        -------
+        List[Tuple[List[str], List[str]]]
+            For each note, the output of self.extract_diseases_and_factors
+            Notes without a discharge diagnosis section give two empty lists
+
+        """
+        # extract relevant sections from the clinical notes, leaving out notes without a diagnosis
+        contexts = []
+        with metrics.stage('sectioning'):
+            for text in texts:
+                contexts.append(self.find_contexts(text))
+        n_texts = len(contexts)
+        found = [index for index, (diagnosis, _, _) in enumerate(contexts) if diagnosis is not None]
+
+        # long notes are split into windows, see self.extract_windowed
+        long = [index for index in found if self.is_long(contexts[index])]
+        found = [index for index in found if not self.is_long(contexts[index])]
+        contexts, long_contexts = [contexts[index] for index in found], [contexts[index] for index in long]
+        searcher = self.db.searcher
+
+        with metrics.stage('extraction'):
+            windowed = self.extract_windowed(long_contexts) if long_contexts else []
+
+            # find the primary diseases and factors with one pass of the NER model
+            if self.single_pass:
+                routed = [text_utils.build_routed_context(*context) for context in contexts]
+                extracted = searcher.get_diseases_and_factors_batch(
+                    [context for context, _ in routed],
+                    [span for _, span in routed],
+                    batch_size=batch_size
+                )
+
+            # find the primary diseases and then the other diseases in the relevant sections
+            else:
+                primary_diagnoses = [text_utils.find_primary_diagnoses(diagnosis) for diagnosis, _, _ in contexts]
+                primary_diseases = searcher.get_diseases_batch(primary_diagnoses, batch_size=batch_size)
+                factors = searcher.get_factors_batch(
+                    [text_utils.build_context(*context) for context in contexts],
+                    primary_diseases,
+                    batch_size=batch_size
+                )
+                extracted = list(zip(primary_diseases, factors))
+
+        # put the results back in the order of the notes
+        results = [([], []) for _ in range(n_texts)]
+        for index, result in zip(found + long, extracted + windowed):
+            results[index] = result
+        return results
+
+    def is_long(self, context: Tuple[str, str, str]) -> bool:
+        """
+        Whether the sections of a note, as output by self.find_contexts, are split into windows
+        """
+        if self.window_size is None:
+            return False
+        # the length of text_utils.build_context, without building it
+        return sum(len(section) for section in context if section) + 2 > self.window_size
+
+    def extract_windowed(self, contexts: List[Tuple[str, str, str]]) -> List[Tuple[List[str], List[str]]]:
+        """
+        Version of self.extract_diseases_and_factors_batch for long notes, which runs the NER model on overlapping
+        windows of the combined sections of each note, in parallel if self.window_pool is set
+
+        Parameters
+        ----------
+        contexts: List[Tuple[str, str, str]]
+            The sections of clinical notes, as output by self.find_contexts
+
+        Returns
+        -------
+        List[Tuple[List[str], List[str]]]
+            For each note, the canonical names of the primary diseases and of the underlying factors
+
+        """
+        searcher = self.db.searcher
+        metrics.increment('windowed_notes', len(contexts))
+
+        # find the diseases of the windows of every note together, so a pool can spread them over its workers
+        mentions = text_utils.find_mentions_windowed(
+            [text_utils.build_context(*context) for context in contexts],
+            searcher,
+            self.window_size,
+            self.window_overlap,
+            self.window_pool.map if self.window_pool is not None else None
+        )
+
+        # assign each disease to the primary diagnoses or the factors by its position
+        if self.single_pass:
+            return [
+                searcher.route_mentions(note_mentions, text_utils.primary_span(diagnosis))
+                for note_mentions, (diagnosis, _, _) in zip(mentions, contexts)
+            ]
+
+        # the primary diagnoses are short, so they go through the NER model whole
+        primary_diseases = searcher.get_diseases_batch(
+            [text_utils.find_primary_diagnoses(diagnosis) for diagnosis, _, _ in contexts]
+        )
+        return [
+            (primary, searcher.remove_primary([name for _, _, name in note_mentions], primary))
+            for primary, note_mentions in zip(primary_diseases, mentions)
+        ]
+
     def get_diagnosis_and_factors(self, primary_diseases: List[str], factors: List[str], print_out: bool = False) -> dict[str: str]:
         """
         For each diagnosis, find the relevant factors and compare them to the known factors in the database
@@ -100,19 +418,9 @@ class DiagnosisDetector:
 
         """
 
-        # create dictionary to store disease and corresponding factors
-        disease_factor_dict = {}
-
-        # iterate through primary_diseases
-        for disease in primary_diseases:
-            # find the factors for the disease in the database
-            underlying_factors = self.db.find_factors(disease)
-
-            # find the intersection of factors in the database and factors in the clinical note
-            relevant_factors = [factor for factor in underlying_factors if factor in factors]
-
-            # store factors
-            disease_factor_dict[disease] = relevant_factors
+        # intersect the factors of the note with the known factors of each disease, compared by integer id
+        with metrics.stage('lookup'):
+            disease_factor_dict = self.db.match_factors(primary_diseases, factors)
 
         if print_out:
             self.pretty_print(disease_factor_dict)
@@ -120,12 +428,9 @@ class DiagnosisDetector:
 
     @staticmethod
     def find_contexts(text: str) -> Tuple[str, str, str]:
-        diagnosis = text_utils.get_category(text, ('Discharge Diagnosis',
-                                                   'Discharge Diagnoses',
-                                                   'Final Discharge Diagnosis',
-                                                   'Final Discharge Diagnoses'))
-        complaint = text_utils.contains_category(text, ('Chief Complaint',))
-        history = text_utils.get_category(text, ('History of Present Illness',))
+        diagnosis = text_utils.get_category(text, text_utils.DIAGNOSIS_HEADERS)
+        complaint = text_utils.contains_category(text, text_utils.COMPLAINT_HEADERS)
+        history = text_utils.get_category(text, text_utils.HISTORY_HEADERS)
 
         return diagnosis, history, complaint
 
@@ -147,25 +452,189 @@ class DiagnosisDetector:
                 print(f'\t{index+1}.{sub_index+1}. {factor}')
 
 
+def create_result_cache(
+        database: DiagnosisDatabase,
+        single_pass: bool = False,
+        maxsize: int = DEFAULT_RESULT_CACHE_SIZE,
+        path: str = None,
+        window_size: int = None,
+        window_overlap: int = text_utils.DEFAULT_WINDOW_OVERLAP
+) -> ResultCache:
+    """
+    Creates the result cache of a DiagnosisDetector, whose entries are only reused while the saved database,
+    the NER model, and the extraction mode stay the same
+
+    Parameters
+    ----------
+    database: DiagnosisDatabase
+        The database of the detector
+    single_pass: bool (default=False)
+        Whether the detector runs in single pass mode, which can find different diseases
+    maxsize: int (default=DEFAULT_RESULT_CACHE_SIZE)
+        The maximum number of notes whose diagnoses are remembered
+    path: str (default=None)
+        If given, the file the cache is loaded from and saved to
+    window_size: int (default=None)
+        The window size of the detector, since entities at the edges of windows can be found differently
+    window_overlap: int (default=text_utils.DEFAULT_WINDOW_OVERLAP)
+        The window overlap of the detector
+
+    Returns
+    -------
+    ResultCache
+        The result cache, with the saved entries of the same version loaded
+
+    """
+    if window_size is None:
+        return ResultCache(combine_versions(database.version(), single_pass), maxsize, path)
+    return ResultCache(combine_versions(database.version(), single_pass, window_size, window_overlap), maxsize, path)
+
+
+def add_detector_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the command line options of the scripts which create a DiagnosisDetector
+    """
+    parser.add_argument('--result-cache-size', type=int, default=0,
+                        help='number of notes whose diagnoses are cached by the hash of their text in '
+                             'result_cache.pkl in the data directory, 0 disables the cache')
+    parser.add_argument('--window-size', type=int, default=0,
+                        help='number of characters above which the sections of a note are split into overlapping '
+                             'windows at sentence boundaries, 0 disables windows')
+    parser.add_argument('--window-overlap', type=int, default=text_utils.DEFAULT_WINDOW_OVERLAP,
+                        help='number of characters shared by consecutive windows')
+    parser.add_argument('--window-workers', type=int, default=0,
+                        help='number of worker processes which run the windows of a note in parallel, '
+                             '0 runs them in the main process')
+
+
+def detector_from_args(args: argparse.Namespace, database: DiagnosisDatabase) -> DiagnosisDetector:
+    """
+    Creates the DiagnosisDetector described by the options of add_detector_arguments
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        The parsed command line options
+    database: DiagnosisDatabase
+        The database of the detector, as given by database_from_args
+
+    Returns
+    -------
+    DiagnosisDetector
+        The detector, with its result cache kept in the data directory if enabled
+        and the worker processes of its windows started if enabled
+
+    """
+    window_size = args.window_size if args.window_size > 0 else None
+    result_cache = None
+    if args.result_cache_size > 0:
+        result_cache = create_result_cache(
+            database,
+            maxsize=args.result_cache_size,
+            path=os.path.join(args.data_dir, 'result_cache.pkl'),
+            single_pass=database.single_pass,
+            window_size=window_size,
+            window_overlap=args.window_overlap
+        )
+
+    # the workers load the same NER model and knowledge base as the database
+    window_pool = None
+    if window_size is not None and args.window_workers > 0:
+        window_pool = WindowPool(database.model_name, args.window_workers, database.searcher_kwargs)
+    return DiagnosisDetector(
+        database,
+        single_pass=database.single_pass,
+        result_cache=result_cache,
+        window_size=window_size,
+        window_overlap=args.window_overlap,
+        window_pool=window_pool
+    )
+
+
+def run_bulk(
+        detector: DiagnosisDetector,
+        source: str,
+        output: TextIO,
+        batch_size: int = DEFAULT_BATCH_SIZE
+) -> int:
+    """
+    Diagnose a stream of clinical notes in batches, writing one JSON line per note
+
+    Parameters
+    ----------
+    detector: DiagnosisDetector
+        The detector which gives the diagnoses of clinical notes
+    source: str
+        A directory, glob pattern, or JSONL file of clinical notes, as accepted by utils.load_data.iter_notes
+    output: TextIO
+        Where the JSON lines {"id": note identifier, "diagnoses": {disease: [factor, ...]}} are written
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes held in memory and passed through the NER model at a time
+
+    Returns
+    -------
+    int
+        The number of notes diagnosed
+
+    """
+    n_notes = 0
+    for batch in iter_batches(load_data.iter_notes(source), batch_size):
+        diagnoses = detector.give_diagnosis_batch([text for _, text in batch], batch_size)
+        for (note_id, _), diagnosis in zip(batch, diagnoses):
+            output.write(json.dumps({'id': note_id, 'diagnoses': diagnosis}) + '\n')
+        n_notes += len(batch)
+    return n_notes
+
+
 if __name__ == '__main__':
     warnings.filterwarnings('ignore')
 
-    if len(sys.argv) <= 1:
-        raise FileNotFoundError('No File Path Given')
-    file_paths = sys.argv[1:]
+    parser = argparse.ArgumentParser(description='Extract primary diagnoses and relevant factors from clinical notes')
+    parser.add_argument('file_paths', nargs='*', help='paths to .txt clinical notes')
+    parser.add_argument('--bulk', default=None,
+                        help='directory, glob pattern, or JSONL file (- for stdin) of clinical notes to diagnose in bulk')
+    parser.add_argument('--output', default='-', help='JSONL file the bulk diagnoses are written to (- for stdout)')
+    add_database_arguments(parser)
+    add_detector_arguments(parser)
+    args = parser.parse_args()
 
-    db = DiagnosisDatabase('data', 'en_ner_bc5cdr_md')
-    detector = DiagnosisDetector(db)
-    for file_path in file_paths:
-        if not os.path.isfile(file_path):
-            print(f'No such file {file_path}')
-            continue
+    if args.bulk is not None:
+        # write through a large buffer so millions of small records do not each cost a system call
+        output = sys.stdout if args.output == '-' else open(args.output, 'w', buffering=1 << 20)
 
-        print(f'Diagnosis for {file_path}')
-        text = text_utils.load_text(file_path)
+        # keep progress messages out of the JSON lines when they go to stdout
         try:
+            with contextlib.redirect_stdout(sys.stderr):
+                db = database_from_args(args)
+                detector = detector_from_args(args, db)
+                n_notes = run_bulk(detector, args.bulk, output, args.batch_size)
+                db.save_link_cache()
+                detector.save_result_cache()
+                detector.close_window_pool()
+                write_metrics_from_args(args)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        print(f'Diagnosed {n_notes} notes', file=sys.stderr)
+
+    else:
+        if not args.file_paths:
+            raise FileNotFoundError('No File Path Given')
+        file_paths = args.file_paths
+
+        db = database_from_args(args)
+        detector = detector_from_args(args, db)
+        for file_path in file_paths:
+            if not os.path.isfile(file_path):
+                print(f'No such file {file_path}')
+                continue
+
+            print(f'Diagnosis for {file_path}')
+            text = text_utils.load_text(file_path)
             detector.give_diagnosis(text, print_out=True)
-        except AttributeError:
-            print('No diagnoses found')
-        print()
+            print()
 
+        db.save_link_cache()
+        detector.save_result_cache()
+        detector.close_window_pool()
+        write_metrics_from_args(args)
@@ -1,9 +1,137 @@
+import sys
 import spacy
 import scispacy
+from spacy.language import Language
+from spacy.tokens import Doc, Span
 from scispacy.abbreviation import AbbreviationDetector
 from scispacy.umls_linking import UmlsEntityLinker
 from scispacy.linking import EntityLinker
-from typing import List
+from scispacy.linking_utils import Entity
+from collections import Counter
+from typing import List, Iterable, Iterator, Dict, Union, Optional, Tuple
+from utils import metrics
+from utils.batching import iter_batches
+from utils.cache import LRUCache
+import knowledge_base
+
+# default number of texts sent through the spacy pipeline at a time
+DEFAULT_BATCH_SIZE = 32
+
+# default number of mention strings whose linked entities are remembered
+DEFAULT_LINK_CACHE_SIZE = 100000
+
+# labels of the entities linked to the knowledge base by default, which are the only ones kept by DiseaseSearcher
+DEFAULT_LINK_LABELS = ('DISEASE',)
+
+# components of the scispacy models left out by each pipeline profile
+# only the entities, their labels, the abbreviation detector, and the linker are used,
+# so the minimal profile drops the tagging, parsing, and lemmatization components
+PIPELINE_PROFILES = {
+    'full': [],
+    'minimal': ['tagger', 'morphologizer', 'attribute_ruler', 'lemmatizer', 'parser', 'senter']
+}
+
+
+@Language.factory("cached_scispacy_linker")
+class CachedEntityLinker(EntityLinker):
+    """
+    A scispacy entity linker which remembers the linked entities of mention strings it has already seen,
+    so that candidate generation only runs once for repeated mentions
+
+    Attributes:
+        cache: LRUCache
+            The linked entities of normalized mention strings
+        kb_path: str or None
+            The directory of a restricted knowledge base written by knowledge_base.build_restricted_kb
+            which is linked to instead of the knowledge base named by linker_name
+        labels: set or None
+            The labels of the entities which are linked, or None to link every entity
+            Other entities keep an empty list of kb_ents, so no candidates are generated for them
+    """
+    def __init__(
+            self,
+            nlp: Optional[Language] = None,
+            name: str = "cached_scispacy_linker",
+            resolve_abbreviations: bool = True,
+            k: int = 30,
+            threshold: float = 0.7,
+            no_definition_threshold: float = 0.95,
+            filter_for_definitions: bool = True,
+            max_entities_per_mention: int = 5,
+            linker_name: Optional[str] = None,
+            cache_size: int = DEFAULT_LINK_CACHE_SIZE,
+            kb_path: Optional[str] = None,
+            labels: Optional[List[str]] = None
+    ):
+        super().__init__(
+            nlp=nlp,
+            name=name,
+            candidate_generator=knowledge_base.load_candidate_generator(kb_path) if kb_path is not None else None,
+            resolve_abbreviations=resolve_abbreviations,
+            k=k,
+            threshold=threshold,
+            no_definition_threshold=no_definition_threshold,
+            filter_for_definitions=filter_for_definitions,
+            max_entities_per_mention=max_entities_per_mention,
+            linker_name=linker_name
+        )
+        self.cache = LRUCache(cache_size)
+        self.kb_path = kb_path
+        self.labels = set(labels) if labels is not None else None
+
+    def __call__(self, doc: Doc) -> Doc:
+        # only link the entities with the wanted labels, such as leaving out the chemicals of en_ner_bc5cdr_md
+        ents = doc.ents
+        if self.labels is not None:
+            ents = [ent for ent in ents if ent.label_ in self.labels]
+            metrics.increment('link_skipped', len(doc.ents) - len(ents))
+
+        # find the string to link for each entity, using the long form of abbreviations
+        mention_strings = [self.mention_string(ent) for ent in ents]
+        keys = [' '.join(mention.lower().split()) for mention in mention_strings]
+
+        # look up each mention in the cache and only generate candidates for those not seen yet
+        kb_ents = [self.cache.get(key) for key in keys]
+        missing = {key: mention for key, mention, linked in zip(keys, mention_strings, kb_ents) if linked is None}
+        if missing:
+            batch_candidates = self.candidate_generator(list(missing.values()), self.k)
+            missing = {key: self.predict(candidates) for key, candidates in zip(missing.keys(), batch_candidates)}
+            for key, linked in missing.items():
+                self.cache.put(key, linked)
+
+        for ent, key, linked in zip(ents, keys, kb_ents):
+            ent._.kb_ents = linked if linked is not None else missing[key]
+
+        # record how often repeated mentions skipped candidate generation
+        n_misses = sum(linked is None for linked in kb_ents)
+        metrics.increment('link_cache_hits', len(kb_ents) - n_misses)
+        metrics.increment('link_cache_misses', n_misses)
+        metrics.set_gauge('link_cache_entries', len(self.cache))
+        return doc
+
+    def mention_string(self, ent: Span) -> str:
+        if self.resolve_abbreviations and Doc.has_extension("abbreviations"):
+            if isinstance(ent._.long_form, Span):
+                return ent._.long_form.text
+            if isinstance(ent._.long_form, str):
+                return ent._.long_form
+        return ent.text
+
+    def predict(self, candidates) -> List[Tuple[str, float]]:
+        # score the candidates the same way as scispacy's EntityLinker
+        predicted = []
+        for cand in candidates:
+            score = max(cand.similarities)
+            if (
+                self.filter_for_definitions
+                and self.kb.cui_to_entity[cand.concept_id].definition is None
+                and score < self.no_definition_threshold
+            ):
+                continue
+            if score > self.threshold:
+                predicted.append((cand.concept_id, score))
+        sorted_predicted = sorted(predicted, reverse=True, key=lambda x: x[1])
+        return sorted_predicted[:self.max_entities_per_mention]
 
 
 class DiseaseSearcher:
@@ -13,8 +141,19 @@ class DiseaseSearcher:
     Attributes:
         nlp: A scispacy NER model
         linker: scispacy ULMS linker
+        link_cache: LRUCache of the linked entities of mention strings
+        link_cache_path: Where the link cache is saved, or None if it is not saved
+        linked_cuis: The concept identifier each canonical name was first linked from
     """
-    def __init__(self, model_name: str):
+    def __init__(
+            self,
+            model_name: str,
+            link_cache_size: int = DEFAULT_LINK_CACHE_SIZE,
+            link_cache_path: Optional[str] = None,
+            profile: str = 'full',
+            kb_path: Optional[str] = None,
+            link_labels: Optional[Iterable[str]] = DEFAULT_LINK_LABELS
+    ):
         """
         Initializes DiseaseSearcher with the given NER model
 
@@ -23,22 +162,130 @@ class DiseaseSearcher:
         model_name: str
             The name of one of scispacy's NER models
             For available models, see https://allenai.github.io/scispacy/
+        link_cache_size: int (default=DEFAULT_LINK_CACHE_SIZE)
+            The number of mention strings whose linked entities are remembered, 0 disables the cache
+        link_cache_path: str (default=None)
+            If given, the link cache is loaded from this file if it exists and self.save_link_cache writes to it
+            Note that when nlp.pipe runs with n_process > 1, linking happens in child processes
+            and only the caches of those processes are filled
+        profile: str (default='full')
+            One of the keys of PIPELINE_PROFILES
+            'full' keeps every component of the model, 'minimal' only keeps what entity recognition needs
+        kb_path: str (default=None)
+            If given, the directory of a restricted knowledge base written by knowledge_base.build_restricted_kb,
+            such as one of only disorders, which is linked to instead of the full UMLS
+            It takes a fraction of the memory and loading time, but mentions of concepts it leaves out are not linked
+            Its memory-mapped knowledge base is shared with every other process which loads the same directory
+        link_labels: Iterable[str] (default=DEFAULT_LINK_LABELS)
+            The labels of the entities which the linker generates candidates for, or None to link every entity
+            They are also the only entities kept by every method, see self.linked_entities
+            Only diseases are used by default, so the chemicals found by models such as en_ner_bc5cdr_md are not linked
         """
         print('Loading NLP model')
 
-        # create initial model
-        self.nlp = spacy.load(model_name)
+        if profile not in PIPELINE_PROFILES:
+            raise ValueError(f'Unknown pipeline profile {profile}, expected one of {list(PIPELINE_PROFILES)}')
+
+        # create initial model without the components the profile leaves out
+        self.nlp = spacy.load(model_name, exclude=PIPELINE_PROFILES[profile])
+
+        # the shared token embeddings are only needed if a remaining component listens to them
+        if PIPELINE_PROFILES[profile] and 'tok2vec' in self.nlp.pipe_names:
+            if not self.nlp.get_pipe('tok2vec').listening_components:
+                self.nlp.disable_pipe('tok2vec')
 
         # add abbreviation detector
-        self.nlp.add_pipe("abbreviation_detector")
+        # serializable abbreviations are needed to send docs back from nlp.pipe worker processes
+        self.nlp.add_pipe("abbreviation_detector", config={"make_serializable": True})
 
-        # add UMLS linker
-        self.nlp.add_pipe("scispacy_linker", config={"resolve_abbreviations": True, "linker_name": "umls"})
+        # add UMLS linker which remembers the entities of repeated mentions
+        self.nlp.add_pipe(
+            "cached_scispacy_linker",
+            name="scispacy_linker",
+            config={
+                "resolve_abbreviations": True,
+                "linker_name": "umls",
+                "cache_size": link_cache_size,
+                "kb_path": kb_path,
+                "labels": list(link_labels) if link_labels is not None else None
+            }
+        )
 
         # split off the linker
         self.linker = self.nlp.get_pipe('scispacy_linker')
+
+        # canonical names of the linked concepts, see self.canonical_name
+        self._canonical_names = {}
+
+        # the concept each canonical name was first linked from, see self.canonical_name
+        self.linked_cuis = {}
+
+        # restore the saved link cache
+        self.link_cache_path = link_cache_path
+        if link_cache_path is not None:
+            self.linker.cache = LRUCache.load(link_cache_path, link_cache_size)
         print('NLP model loaded')
 
+    @property
+    def link_cache(self) -> LRUCache:
+        return self.linker.cache
+
+    def save_link_cache(self) -> None:
+        """
+        Save the link cache to self.link_cache_path, if it is set
+        """
+        if self.link_cache_path is not None:
+            self.linker.cache.save(self.link_cache_path)
+
+    def process(self, texts: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE, n_process: int = 1) -> Iterator[Doc]:
+        """
+        Runs the pipeline on texts like self.nlp.pipe, recording the time spent in each component
+        and the number of entities found of each label in utils.metrics if it is enabled
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            Subsections of clinical notes
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of texts processed by the pipeline at a time
+        n_process: int (default=1)
+            The number of processes spacy uses to run the pipeline
+            Components are not timed when it is more than 1, since they run in other processes
+
+        Returns
+        -------
+        Iterator[spacy Doc]
+            The processed document of each text, in order
+
+        """
+        if not metrics.METRICS.enabled or n_process > 1:
+            yield from self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+            return
+
+        # run the components one batch at a time so each of them can be timed
+        for batch in iter_batches(texts, batch_size):
+            with metrics.stage('nlp.tokenizer'):
+                docs = [self.nlp.make_doc(text) for text in batch]
+            for name, component in self.nlp.pipeline:
+                with metrics.stage(f'nlp.{name}'):
+                    if hasattr(component, 'pipe'):
+                        docs = list(component.pipe(docs, batch_size=batch_size))
+                    else:
+                        docs = [component(doc) for doc in docs]
+
+            labels = Counter(ent.label_ for doc in docs for ent in doc.ents)
+            for label, count in labels.items():
+                metrics.increment('entities', count, label=label)
+            yield from docs
+
+    def process_one(self, text: str) -> Doc:
+        """
+        Runs the pipeline on a single text like self.nlp, see self.process
+        """
+        if not metrics.METRICS.enabled:
+            return self.nlp(text)
+        return next(self.process([text], batch_size=1))
+
     def get_diseases(self, text: str) -> List[str]:
         """
         Extract diseases and find canonical names from a string
@@ -55,18 +302,10 @@ class DiseaseSearcher:
 
         """
         # extract entities
-        doc = self.nlp(text)
-
-        # filter for those that are diseases
-        entities = [x for x in doc.ents if x.label_ == 'DISEASE']
+        doc = self.process_one(text)
 
-        # convert each disease to its canonical name
-        diseases = [
-            self.linker.kb.cui_to_entity[entity._.kb_ents[0][0]].canonical_name for entity in entities if len(entity._.kb_ents) > 0
-        ]
-
-        # remove duplicates and return
-        return list(set(diseases))
+        # convert each disease to its canonical name, remove duplicates and return
+        return list(set(self.canonical_names(doc.ents)))
 
     def get_factors(self, text: str, primary_diseases: List[str]) -> List[str]:
         """
@@ -88,18 +327,356 @@ class DiseaseSearcher:
 
         """
         # extract entities
-        doc = self.nlp(text)
+        doc = self.process_one(text)
+
+        # convert each disease to its canonical name and filter for those already in primary_diseases
+        return self.remove_primary(self.canonical_names(doc.ents), primary_diseases)
+
+    def get_diseases_batch(
+            self,
+            texts: Iterable[str],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[str]]:
+        """
+        Batched version of self.get_diseases which streams the texts through nlp.pipe
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            Subsections of clinical notes
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of texts processed by the pipeline at a time
+        n_process: int (default=1)
+            The number of processes spacy uses to run the pipeline
+
+        Returns
+        -------
+        List[List[str]]
+            For each text, a list of the canonical names of diseases found in the text
+
+        """
+        docs = self.process(texts, batch_size=batch_size, n_process=n_process)
+        return [list(set(self.canonical_names(doc.ents))) for doc in docs]
+
+    def get_factors_batch(
+            self,
+            texts: Iterable[str],
+            primary_diseases: Iterable[List[str]],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[str]]:
+        """
+        Batched version of self.get_factors which streams the texts through nlp.pipe
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            Subsections of clinical notes
+        primary_diseases: Iterable[List[str]]
+            For each text, a list of canonical names of diseases as output in self.get_diseases
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of texts processed by the pipeline at a time
+        n_process: int (default=1)
+            The number of processes spacy uses to run the pipeline
 
-        # filter for those that are diseases
-        entities = [x for x in doc.ents if x.label_ == 'DISEASE']
+        Returns
+        -------
+        List[List[str]]
+            For each text, a list of the canonical names of diseases found in the text,
+            with those found in the corresponding primary diseases removed
 
-        # convert each disease to its canonical name
-        diseases = [
-            self.linker.kb.cui_to_entity[entity._.kb_ents[0][0]].canonical_name for entity in entities if len(entity._.kb_ents) > 0
+        """
+        docs = self.process(texts, batch_size=batch_size, n_process=n_process)
+        return [
+            self.remove_primary(self.canonical_names(doc.ents), primary)
+            for doc, primary in zip(docs, primary_diseases)
         ]
 
-        # filter for those already in primary_diseases
-        factors = [disease for disease in diseases if disease not in primary_diseases]
+    def get_diseases_and_factors(self, text: str, primary_span: Tuple[int, int]) -> Tuple[List[str], List[str]]:
+        """
+        Extract diseases from a string with a single pass of the pipeline, splitting them into the primary diseases
+        found within primary_span and the underlying factors found elsewhere
+
+        Parameters
+        ----------
+        text: str
+            The combined sections of a clinical note, as output by utils.text_utils.build_routed_context
+        primary_span: Tuple[int, int]
+            The start and end character offsets of the primary diagnoses in text
+
+        Returns
+        -------
+        Tuple[List[str], List[str]]
+            A tuple of:
+                1. The canonical names of diseases found in the primary diagnoses, as in self.get_diseases
+                2. The canonical names of the other diseases found in the text, as in self.get_factors
+
+        """
+        # extract entities
+        doc = self.process_one(text)
+        return self.route_diseases(doc, primary_span)
+
+    def get_diseases_and_factors_batch(
+            self,
+            texts: Iterable[str],
+            primary_spans: Iterable[Tuple[int, int]],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[Tuple[List[str], List[str]]]:
+        """
+        Batched version of self.get_diseases_and_factors which streams the texts through nlp.pipe
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            The combined sections of clinical notes, as output by utils.text_utils.build_routed_context
+        primary_spans: Iterable[Tuple[int, int]]
+            For each text, the start and end character offsets of the primary diagnoses
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of texts processed by the pipeline at a time
+        n_process: int (default=1)
+            The number of processes spacy uses to run the pipeline
+
+        Returns
+        -------
+        List[Tuple[List[str], List[str]]]
+            For each text, the primary diseases and underlying factors as in self.get_diseases_and_factors
+
+        """
+        docs = self.process(texts, batch_size=batch_size, n_process=n_process)
+        return [self.route_diseases(doc, span) for doc, span in zip(docs, primary_spans)]
+
+    def route_diseases(self, doc, primary_span: Tuple[int, int]) -> Tuple[List[str], List[str]]:
+        """
+        Splits the linked diseases of a processed document by whether they start within primary_span
+
+        Parameters
+        ----------
+        doc: spacy Doc
+            A document processed by self.nlp
+        primary_span: Tuple[int, int]
+            The start and end character offsets of the primary diagnoses in the document
+
+        Returns
+        -------
+        Tuple[List[str], List[str]]
+            The deduplicated canonical names of the primary diseases and of the underlying factors
+
+        """
+        return self.route_mentions(self.mentions(doc), primary_span)
+
+    def mentions(self, doc) -> List[Tuple[int, int, str]]:
+        """
+        The linked diseases of a processed document with their positions, see self.canonical_names
+
+        Parameters
+        ----------
+        doc: spacy Doc
+            A document processed by self.nlp
+
+        Returns
+        -------
+        List[Tuple[int, int, str]]
+            The start and end character offsets and the canonical name of each linked disease, in order
+
+        """
+        return [
+            (ent.start_char, ent.end_char, self.canonical_name(ent._.kb_ents[0][0]))
+            for ent in self.linked_entities(doc.ents)
+        ]
+
+    def get_mentions_batch(
+            self,
+            texts: Iterable[str],
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            n_process: int = 1
+    ) -> List[List[Tuple[int, int, str]]]:
+        """
+        Batched version of self.mentions which streams the texts through nlp.pipe, such as the windows of a long note
+        """
+        return [self.mentions(doc) for doc in self.process(texts, batch_size=batch_size, n_process=n_process)]
+
+    @staticmethod
+    def route_mentions(
+            mentions: Iterable[Tuple[int, int, str]],
+            primary_span: Tuple[int, int]
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Splits linked diseases by whether they start within primary_span, see self.route_diseases
+
+        Parameters
+        ----------
+        mentions: Iterable[Tuple[int, int, str]]
+            The linked diseases of a text, as output by self.mentions
+        primary_span: Tuple[int, int]
+            The start and end character offsets of the primary diagnoses in the text
+
+        Returns
+        -------
+        Tuple[List[str], List[str]]
+            The deduplicated canonical names of the primary diseases and of the underlying factors
+
+        """
+        start, end = primary_span
+        mentions = list(mentions)
+        primary_diseases = list({name for mention_start, _, name in mentions if start <= mention_start < end})
+        return primary_diseases, DiseaseSearcher.remove_primary([name for _, _, name in mentions], primary_diseases)
+
+    def link(self, text: str) -> Union[str, None]:
+        """
+        Find the canonical name of the first entity in a string
+
+        Parameters
+        ----------
+        text: str
+            The name of a disease
+            Note it does not have to be a canonical name
+
+        Returns
+        -------
+        str or None
+            The canonical name of the first entity found in the text if it has a match in the knowledge base
+            Otherwise returns None
+
+        """
+        # extract entities
+        doc = self.process_one(text)
+        return self.first_canonical_name(doc)
+
+    def link_batch(self, texts: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> List[Union[str, None]]:
+        """
+        Batched version of self.link which streams the texts through nlp.pipe
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            The names of diseases
+        batch_size: int (default=DEFAULT_BATCH_SIZE)
+            The number of texts processed by the pipeline at a time
+
+        Returns
+        -------
+        List[str or None]
+            For each text, its canonical name as in self.link
+
+        """
+        return [self.first_canonical_name(doc) for doc in self.process(texts, batch_size=batch_size)]
+
+    def first_canonical_name(self, doc: Doc) -> Union[str, None]:
+        """
+        The canonical name of the first linked entity of a processed document, or None if it has no linked entity
+        Entities with labels the linker leaves out are skipped, such as the chemical of "aspirin induced asthma"
+        """
+        for entity in self.linked_entities(doc.ents):
+            return self.canonical_name(entity._.kb_ents[0][0])
+
+        # if no entity has a canonical name, return nothing
+        return None
+
+    def linked_entities(self, ents: Iterable[Span]) -> List[Span]:
+        """
+        The entities of a processed document which were linked to the knowledge base
+        Their labels are the ones given to the linker as link_labels, which are also the only ones kept,
+        so every method extracts the same diseases
+
+        Parameters
+        ----------
+        ents: Iterable[spacy Span]
+            Entities of a document processed by self.nlp, such as doc.ents
+
+        Returns
+        -------
+        List[spacy Span]
+            The entities with one of the linked labels and a match in the knowledge base, in order
+
+        """
+        labels = self.linker.labels
+        return [ent for ent in ents if (labels is None or ent.label_ in labels) and len(ent._.kb_ents) > 0]
+
+    def find_entities(self, names: Iterable[str]) -> Dict[str, Entity]:
+        """
+        Look up knowledge base entries by canonical name
+
+        Parameters
+        ----------
+        names: Iterable[str]
+            Canonical names of entities in the knowledge base, as output by self.get_diseases
+
+        Returns
+        -------
+        Dict[str, Entity]
+            A dictionary whose keys are the canonical names that were found
+            and whose values are the first knowledge base entry with that canonical name
+
+        """
+        # a memory-mapped knowledge base only decodes the canonical names while scanning
+        if isinstance(self.linker.kb, knowledge_base.MappedKnowledgeBase):
+            return self.linker.kb.find_canonical_names(names)
+
+        names = set(names)
+        entities = {}
+
+        # canonical names are not indexed by the knowledge base, so scan it once
+        for entity in self.linker.kb.cui_to_entity.values():
+            if entity.canonical_name in names and entity.canonical_name not in entities:
+                entities[entity.canonical_name] = entity
+        return entities
+
+    def canonical_names(self, ents: Iterable[Span]) -> List[str]:
+        """
+        Canonical names of the linked diseases among entities of a processed document
+
+        Parameters
+        ----------
+        ents: Iterable[spacy Span]
+            Entities of a document processed by self.nlp, such as doc.ents
+
+        Returns
+        -------
+        List[str]
+            The canonical names of the entities with one of the linked labels which have a match in the knowledge base,
+            possibly with duplicates, see self.linked_entities
+
+        """
+        # convert each linked disease to its canonical name
+        return [self.canonical_name(entity._.kb_ents[0][0]) for entity in self.linked_entities(ents)]
+
+    def canonical_name(self, cui: str) -> str:
+        """
+        The canonical name of a concept identifier of the knowledge base
+
+        Names are remembered, so each concept is only looked up in the knowledge base once,
+        and interned, so every mention of a concept shares one string which compares by identity first
+        The concept is also recorded in self.linked_cuis if it is the first one linked with its name,
+        since different concepts can share a canonical name
+        """
+        name = self._canonical_names.get(cui)
+        if name is None:
+            name = sys.intern(self.linker.kb.cui_to_entity[cui].canonical_name)
+            self._canonical_names[cui] = name
+            self.linked_cuis.setdefault(name, cui)
+        return name
+
+    def find_concepts(self, cuis: Iterable[str]) -> Dict[str, Entity]:
+        """
+        Look up knowledge base entries by concept identifier
+
+        Parameters
+        ----------
+        cuis: Iterable[str]
+            Concept identifiers of the knowledge base, such as the values of self.linked_cuis
+
+        Returns
+        -------
+        Dict[str, Entity]
+            A dictionary whose keys are the concept identifiers that were found and whose values are their entries
+
+        """
+        concepts = self.linker.kb.cui_to_entity
+        return {cui: concepts[cui] for cui in set(cuis) if cui in concepts}
 
-        # remove duplicates and return
-        return list(set(factors))
+    @staticmethod
+    def remove_primary(diseases: List[str], primary_diseases: List[str]) -> List[str]:
+        # remove duplicates and those already in primary_diseases
+        return list(set(diseases).difference(primary_diseases))
@@ -0,0 +1,217 @@
+import os
+import json
+import argparse
+import warnings
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import List, Tuple
+from database import add_database_arguments, database_from_args, write_metrics_from_args
+from main import DiagnosisDetector, add_detector_arguments, detector_from_args
+from utils import metrics
+from utils.batching import MicroBatcher, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT
+
+
+class DiagnosisService:
+    """
+    Serves a DiagnosisDetector and its DiagnosisDatabase to concurrent requests,
+    running all NLP work on one thread in micro-batches
+
+    Attributes:
+        detector: DiagnosisDetector
+            The detector which gives the diagnoses of clinical notes
+        batcher: MicroBatcher
+            Groups the in-flight requests into batches for the NLP pipeline
+    """
+    def __init__(
+            self,
+            detector: DiagnosisDetector,
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT
+    ):
+        """
+        Initializes the DiagnosisService and loads the NLP model so the first request does not pay for it
+
+        Parameters
+        ----------
+        detector: DiagnosisDetector
+            The detector which gives the diagnoses of clinical notes
+        max_batch_size: int (default=DEFAULT_MAX_BATCH_SIZE)
+            The maximum number of requests processed together
+        max_wait: float (default=DEFAULT_MAX_WAIT)
+            The maximum number of seconds a request waits for others to join its batch
+        """
+        self.detector = detector
+
+        # load the NLP model now so the first request does not pay for it
+        self.detector.db.searcher
+        self.batcher = MicroBatcher(self.process_batch, max_batch_size, max_wait)
+
+    def give_diagnosis(self, text: str) -> dict[str: str]:
+        return self.batcher.submit(('diagnosis', text, {})).result()
+
+    def find_factors(self, disease: str) -> List[str]:
+        return self.batcher.submit(('factors', disease, {})).result()
+
+    def process_batch(self, requests: List[Tuple[str, str, dict]]) -> list:
+        """
+        Answers a batch of requests, see DiagnosisDetector.process_requests
+
+        Parameters
+        ----------
+        requests: List[Tuple[str, str, dict]]
+            Triples of the kind of request, "diagnosis" or "factors", the clinical note or disease name,
+            and keyword arguments of DiagnosisDatabase.find_factors
+
+        Returns
+        -------
+        list
+            The diagnoses of each clinical note and the factors of each disease, in the order of requests
+
+        """
+        metrics.increment('service_batches')
+        metrics.increment('service_requests', len(requests))
+        return self.detector.process_requests(requests)
+
+    def close(self) -> None:
+        self.batcher.close()
+        self.detector.db.save_link_cache()
+        self.detector.save_result_cache()
+        self.detector.close_window_pool()
+
+
+class DiagnosisRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of a DiagnosisService
+        POST /diagnosis with a JSON body {"text": note} gives {"diagnoses": {disease: [factor, ...]}}
+        GET /factors?disease=name gives {"disease": name, "factors": [factor, ...]}
+        GET /health gives {"status": "ok"}
+        GET /metrics gives the recorded metrics in the Prometheus text format
+    """
+    service: DiagnosisService = None
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif url.path == '/metrics':
+            data = metrics.METRICS.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif url.path == '/factors':
+            diseases = parse_qs(url.query).get('disease')
+            if not diseases:
+                self.send_json(400, {'error': 'No disease given'})
+                return
+            try:
+                factors = self.service.find_factors(diseases[0])
+            except Exception as error:
+                self.send_json(500, {'error': f'Failed to find the factors: {error}'})
+                return
+            self.send_json(200, {'disease': diseases[0], 'factors': factors})
+        else:
+            self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path != '/diagnosis':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            text = body['text']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'Expected a JSON body with a "text" field'})
+            return
+        if not isinstance(text, str):
+            self.send_json(400, {'error': 'Expected the "text" field to be a string'})
+            return
+
+        # answer with an error instead of dropping the connection if the note cannot be diagnosed
+        try:
+            diagnoses = self.service.give_diagnosis(text)
+        except Exception as error:
+            self.send_json(500, {'error': f'Failed to diagnose the note: {error}'})
+            return
+        self.send_json(200, {'diagnoses': diagnoses})
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # clients of a unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service: DiagnosisService, host: str, port: int, socket_path: str = None) -> socketserver.BaseServer:
+    """
+    Creates an HTTP server for a DiagnosisService, which handles each connection on its own thread
+
+    Parameters
+    ----------
+    service: DiagnosisService
+        The service answering the requests
+    host: str
+        The host name or address to listen on, if socket_path is not given
+    port: int
+        The TCP port to listen on, if socket_path is not given
+    socket_path: str (default=None)
+        If given, the server listens on a unix socket at this path instead of a TCP port
+
+    Returns
+    -------
+    socketserver.BaseServer
+        The server, ready for serve_forever
+
+    """
+    handler = type('BoundDiagnosisRequestHandler', (DiagnosisRequestHandler,), {'service': service})
+    if socket_path is None:
+        return ThreadingHTTPServer((host, port), handler)
+
+    # remove the socket of a previous run
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return ThreadingUnixHTTPServer(socket_path, handler)
+
+
+if __name__ == '__main__':
+    warnings.filterwarnings('ignore')
+
+    parser = argparse.ArgumentParser(description='Serve diagnoses of clinical notes and factors of diseases over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', default=None, help='path of a unix socket to listen on instead of a TCP port')
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help='maximum number of requests passed through the NLP pipeline together')
+    parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT * 1000,
+                        help='maximum number of milliseconds a request waits for others to join its batch')
+    add_database_arguments(parser)
+    add_detector_arguments(parser)
+    args = parser.parse_args()
+
+    # always record metrics, since they are served at /metrics
+    metrics.METRICS.enabled = True
+    db = database_from_args(args)
+    service = DiagnosisService(detector_from_args(args, db), args.max_batch_size, args.max_wait_ms / 1000)
+    server = create_server(service, args.host, args.port, args.socket)
+
+    print(f'Serving on {args.socket or f"{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        write_metrics_from_args(args)
@@ -0,0 +1,349 @@
+import queue
+import asyncio
+import threading
+from time import monotonic
+from concurrent.futures import Future, Executor
+from typing import Any, Callable, List, Iterable, Iterator, Tuple, Union
+
+# default maximum number of items processed together
+DEFAULT_MAX_BATCH_SIZE = 32
+
+# default maximum number of seconds the first item of a batch waits for more items
+DEFAULT_MAX_WAIT = 0.01
+
+# default maximum number of items waiting for a batch before submitting blocks
+DEFAULT_MAX_PENDING = 1024
+
+# sentinel which stops the worker thread
+_STOP = object()
+
+
+def iter_batches(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    """
+    Lazily group the items of an iterable into lists
+
+    Parameters
+    ----------
+    items: Iterable[Any]
+        The items to group, only batch_size of which are held in memory at a time
+    batch_size: int
+        The number of items in each list, except possibly the last
+
+    Returns
+    -------
+    Iterator[List[Any]]
+        Consecutive lists of items, in order
+
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_items(
+        process_batch: Callable[[List[Any]], List[Any]],
+        items: List[Any]
+) -> List[Tuple[Any, Union[Exception, None]]]:
+    """
+    Runs process_batch on a batch of items, keeping the failure of an item from failing the others
+
+    Parameters
+    ----------
+    process_batch: Callable[[List[Any]], List[Any]]
+        Function which takes a list of items and returns a list of results in the same order
+    items: List[Any]
+        The items of the batch
+
+    Returns
+    -------
+    List[Tuple[Any, Exception or None]]
+        For each item, its result and None, or None and the exception raised while processing it
+        If the batch fails, or does not give one result per item, the items are processed again one at a time
+        so that only the items which fail on their own get an exception
+        A result which is an exception is the failure of its item alone, see main.DiagnosisDetector.process_requests
+
+    """
+    try:
+        results = process_batch(items)
+        if len(results) != len(items):
+            raise RuntimeError(f'Expected {len(items)} results from the batch, got {len(results)}')
+    except Exception as error:
+        if len(items) == 1:
+            return [(None, error)]
+        return [process_items(process_batch, [item])[0] for item in items]
+    return [(None, result) if isinstance(result, Exception) else (result, None) for result in results]
+
+
+class MicroBatcher:
+    """
+    Groups items submitted concurrently from many threads into batches processed by a single worker thread
+
+    A batch is processed as soon as it has max_batch_size items or its first item has waited max_wait seconds,
+    so a lone item is only delayed by max_wait while a burst of items shares one call of process_batch
+
+    Attributes:
+        process_batch: Callable[[List[Any]], List[Any]]
+            Function which takes a list of items and returns a list of results in the same order
+        max_batch_size: int
+            The maximum number of items processed together
+        max_wait: float
+            The maximum number of seconds the first item of a batch waits for more items
+    """
+    def __init__(
+            self,
+            process_batch: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT
+    ):
+        """
+        Initializes the MicroBatcher and starts its worker thread
+
+        Parameters
+        ----------
+        process_batch: Callable[[List[Any]], List[Any]]
+            Function which takes a list of items and returns a list of results in the same order
+        max_batch_size: int (default=DEFAULT_MAX_BATCH_SIZE)
+            The maximum number of items processed together
+        max_wait: float (default=DEFAULT_MAX_WAIT)
+            The maximum number of seconds the first item of a batch waits for more items
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """
+        Queue an item to be processed in the next batch
+
+        Parameters
+        ----------
+        item: Any
+            The item to process
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future which receives the result of the item, or the exception raised while processing it,
+            see process_items
+            Cancelling the future before its batch starts removes the item from the batch
+
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self) -> None:
+        """
+        Process the queued items and stop the worker thread
+        """
+        self._queue.put((_STOP, None))
+        self._thread.join()
+
+    def _next_batch(self) -> List[tuple]:
+        # block until there is a first item, then collect more until the batch is full or the wait is over
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1][0] is not _STOP:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1][0] is _STOP
+            if stop:
+                batch = batch[:-1]
+
+            # drop the items whose callers gave up waiting
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+
+            if batch:
+                outcomes = process_items(self.process_batch, [item for item, _ in batch])
+                for (_, future), (result, error) in zip(batch, outcomes):
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+
+            if stop:
+                return
+
+
+class AsyncMicroBatcher:
+    """
+    The asyncio counterpart of MicroBatcher, which groups items awaited concurrently by coroutines into batches
+    and runs process_batch on an executor so that the event loop is never blocked
+
+    Batches are formed and timed as by MicroBatcher. At most max_concurrency batches are processed at a time,
+    and at most max_pending items wait for a batch, after which submit waits for room, so a burst of callers
+    slows down instead of queueing without bound
+    Cancelling a caller before its batch starts removes its item from the batch, cancelling it later only
+    discards its result, since the executor cannot interrupt a running batch
+
+    Attributes:
+        process_batch: Callable[[List[Any]], List[Any]]
+            Function which takes a list of items and returns a list of results in the same order
+        max_batch_size: int
+            The maximum number of items processed together
+        max_wait: float
+            The maximum number of seconds the first item of a batch waits for more items
+        max_concurrency: int
+            The maximum number of batches processed at the same time
+        max_pending: int
+            The maximum number of items waiting for a batch
+        executor: concurrent.futures.Executor or None
+            Where the batches are processed, None for the default executor of the event loop
+    """
+    def __init__(
+            self,
+            process_batch: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait: float = DEFAULT_MAX_WAIT,
+            max_concurrency: int = 1,
+            max_pending: int = DEFAULT_MAX_PENDING,
+            executor: Executor = None
+    ):
+        """
+        Initializes the AsyncMicroBatcher, whose collecting task starts with the first submitted item
+
+        Parameters
+        ----------
+        process_batch: Callable[[List[Any]], List[Any]]
+            Function which takes a list of items and returns a list of results in the same order
+        max_batch_size: int (default=DEFAULT_MAX_BATCH_SIZE)
+            The maximum number of items processed together
+        max_wait: float (default=DEFAULT_MAX_WAIT)
+            The maximum number of seconds the first item of a batch waits for more items
+        max_concurrency: int (default=1)
+            The maximum number of batches processed at the same time
+        max_pending: int (default=DEFAULT_MAX_PENDING)
+            The maximum number of items waiting for a batch
+        executor: concurrent.futures.Executor (default=None)
+            Where the batches are processed, None for the default executor of the event loop
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.executor = executor
+        self._queue = None
+        self._task = None
+        self._semaphore = None
+        self._running = set()
+
+    def _start(self) -> None:
+        # the queue and semaphore belong to the event loop they are created in
+        if self._task is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        """
+        Process an item in the next batch
+
+        Parameters
+        ----------
+        item: Any
+            The item to process
+
+        Returns
+        -------
+        Any
+            The result of the item
+            The exception raised while processing it is raised instead, see process_items
+
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+
+        # wait for room in the queue if too many items are pending
+        await self._queue.put((item, future))
+        return await future
+
+    async def close(self) -> None:
+        """
+        Process the queued items and wait for the running batches to finish
+        """
+        if self._task is None:
+            return
+        await self._queue.put((_STOP, None))
+        await self._task
+        if self._running:
+            await asyncio.gather(*self._running)
+        self._task = None
+
+    async def _next_batch(self) -> List[tuple]:
+        # wait until there is a first item, then collect more until the batch is full or the wait is over
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1][0] is not _STOP:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1][0] is _STOP
+            if stop:
+                batch = batch[:-1]
+
+            # drop the items whose callers gave up waiting
+            batch = [(item, future) for item, future in batch if not future.done()]
+
+            if batch:
+                # wait for a free slot, leaving later items queued so that submitters feel the backpressure
+                await self._semaphore.acquire()
+                task = asyncio.get_running_loop().create_task(self._process(batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            if stop:
+                return
+
+    async def _process(self, batch: List[tuple]) -> None:
+        try:
+            # items cancelled while waiting for a slot are dropped too
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                return
+            outcomes = await asyncio.get_running_loop().run_in_executor(
+                self.executor, process_items, self.process_batch, [item for item, _ in batch]
+            )
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            # each future gets the result or the exception of its own item, see process_items
+            for (_, future), (result, error) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            self._semaphore.release()
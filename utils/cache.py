@@ -0,0 +1,165 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LRUCache:
+    """
+    A bounded mapping which evicts its least recently used entries and counts hits and misses
+    It is safe to use from several threads, such as batches of the NER model running on an executor
+
+    Attributes:
+        maxsize: int
+            The maximum number of entries, entries are never stored if it is 0
+        hits: int
+            The number of lookups which found an entry
+        misses: int
+            The number of lookups which did not find an entry
+    """
+    def __init__(self, maxsize: int):
+        """
+        Initializes an empty LRUCache
+
+        Parameters
+        ----------
+        maxsize: int
+            The maximum number of entries
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Look up an entry and mark it as the most recently used
+
+        Parameters
+        ----------
+        key: Hashable
+            The key of the entry
+        default: Any (default=None)
+            The value returned if there is no entry for key
+
+        Returns
+        -------
+        Any
+            The value of the entry if it exists, otherwise default
+
+        """
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Store an entry as the most recently used, evicting the least recently used entry if the cache is full
+
+        Parameters
+        ----------
+        key: Hashable
+            The key of the entry
+        value: Any
+            The value of the entry
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Summary statistics of the cache
+
+        Returns
+        -------
+        dict
+            A dictionary with the number of "hits", "misses", the "hit_rate",
+            the current number of entries "size", and the "maxsize"
+
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+    def save(self, file_path: str) -> None:
+        """
+        Save the entries of the cache, from least to most recently used
+
+        Parameters
+        ----------
+        file_path: str
+            Path to the pickled entries
+        """
+        # write to a temporary file first so a crash never leaves a truncated cache behind
+        tmp_path = file_path + '.tmp'
+        with self._lock:
+            entries = list(self._entries.items())
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(entries, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, file_path)
+
+    def __getstate__(self) -> dict:
+        # locks cannot be pickled, such as when the linker is sent to a spawned process
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, file_path: str, maxsize: int, keep: Callable[[Hashable], bool] = None) -> 'LRUCache':
+        """
+        Create a cache with the entries saved by LRUCache.save, if they exist
+
+        Parameters
+        ----------
+        file_path: str
+            Path to the pickled entries
+        maxsize: int
+            The maximum number of entries, the least recently used saved entries are dropped if there are more
+        keep: Callable[[Hashable], bool] (default=None)
+            If given, only the saved entries whose key it accepts are loaded
+
+        Returns
+        -------
+        LRUCache
+            The cache with the saved entries, or an empty cache if there are none
+
+        """
+        cache = cls(maxsize)
+        if os.path.isfile(file_path):
+            with open(file_path, 'rb') as file:
+                for key, value in pickle.load(file):
+                    if keep is None or keep(key):
+                        cache.put(key, value)
+        return cache
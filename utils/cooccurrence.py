@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import NamedTuple
+
+
+class Cooccurrence(NamedTuple):
+    """
+    Counts of how often each underlying factor occurs in clinical notes with each primary disease
+
+    Attributes:
+        counts: scipy.sparse.csr_matrix
+            Matrix of shape (len(diseases), len(factors)) whose entry (i, j) is the number of notes
+            with the primary disease diseases[i] and the underlying factor factors[j]
+        diseases: pandas Index
+            The disease vocabulary, in order of first appearance in the notes
+        factors: pandas Index
+            The factor vocabulary, in order of first appearance in the notes
+        disease_support: numpy ndarray
+            The number of notes with each disease as a primary disease
+        factor_support: numpy ndarray
+            The number of notes with a primary disease that have each factor
+        n_notes: int
+            The number of notes with a primary disease
+    """
+    counts: sparse.csr_matrix
+    diseases: pd.Index
+    factors: pd.Index
+    disease_support: np.ndarray
+    factor_support: np.ndarray
+    n_notes: int
+
+
+def _incidence(lists: pd.Series, n_rows: int):
+    # one row per note and one column per distinct value, with a 1 where the note's list contains the value
+    values = lists.explode().dropna()
+    codes, vocabulary = pd.factorize(values)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(codes), dtype=np.int64), (values.index.to_numpy(), codes)),
+        shape=(n_rows, len(vocabulary))
+    )
+    # repeated values within a note only count once
+    matrix.data[:] = 1
+    return matrix, pd.Index(vocabulary)
+
+
+def create_cooccurrence(txt_df: pd.DataFrame) -> Cooccurrence:
+    """
+    Procedure to count the co-occurrences of primary diseases and underlying factors
+    in a DataFrame of clinical notes, using sparse matrix products instead of a loop over the notes
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        A DataFrame of clinical notes with the columns "primary_diseases" and "underlying_factors"
+        of lists of canonical names, as output by utils.df_utils.get_underlying_factors
+
+    Returns
+    -------
+    Cooccurrence
+        The co-occurrence counts and supports of the diseases and factors
+
+    """
+    notes = txt_df[['primary_diseases', 'underlying_factors']].reset_index(drop=True)
+
+    # note x disease and note x factor incidence matrices
+    disease_incidence, diseases = _incidence(notes.primary_diseases, len(notes))
+    factor_incidence, factors = _incidence(notes.underlying_factors, len(notes))
+
+    # only notes with a primary disease take part in the statistics
+    has_disease = np.asarray(disease_incidence.sum(axis=1)).ravel() > 0
+
+    return Cooccurrence(
+        counts=(disease_incidence.T @ factor_incidence).tocsr(),
+        diseases=diseases,
+        factors=factors,
+        disease_support=np.asarray(disease_incidence.sum(axis=0)).ravel(),
+        factor_support=np.asarray(factor_incidence[has_disease].sum(axis=0)).ravel(),
+        n_notes=int(has_disease.sum())
+    )
+
+
+def lift(cooccurrence: Cooccurrence) -> sparse.csr_matrix:
+    """
+    The lift of each factor for each disease, how many times more often the factor occurs in notes
+    with the disease than in all notes with a primary disease
+
+    Parameters
+    ----------
+    cooccurrence: Cooccurrence
+        The output of create_cooccurrence
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix with the same sparsity as cooccurrence.counts whose entry (i, j) is
+        counts[i, j] * n_notes / (disease_support[i] * factor_support[j])
+
+    """
+    counts = cooccurrence.counts
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    data = counts.data * cooccurrence.n_notes / (
+        cooccurrence.disease_support[rows] * cooccurrence.factor_support[counts.indices]
+    )
+    return sparse.csr_matrix((data, counts.indices, counts.indptr), shape=counts.shape)
+
+
+def to_disease_df(cooccurrence: Cooccurrence) -> pd.DataFrame:
+    """
+    Procedure to convert co-occurrence counts into the disease database,
+    with the factors of each disease ranked by how often they occur with it
+
+    Parameters
+    ----------
+    cooccurrence: Cooccurrence
+        The output of create_cooccurrence
+
+    Returns
+    -------
+    pandas DataFrame
+        A DataFrame with a row per disease and the columns:
+            "disease": the name of the disease
+            "factors": the factors which occur with the disease, from most to least frequent,
+                       with ties in order of first appearance
+            "counts": the number of notes in which each factor occurs with the disease
+            "lifts": the lift of each factor for the disease, see lift
+            "support": the number of notes with the disease as a primary disease
+
+    """
+    counts = cooccurrence.counts
+    lifts = lift(cooccurrence)
+
+    # sort the entries of each row by decreasing count, then by factor id
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    order = np.lexsort((counts.indices, -counts.data, rows))
+    factor_names = np.asarray(cooccurrence.factors, dtype=object)[counts.indices[order]]
+
+    return pd.DataFrame({
+        'disease': list(cooccurrence.diseases),
+        'factors': [x.tolist() for x in _split_rows(factor_names, counts.indptr)],
+        'counts': [x.tolist() for x in _split_rows(counts.data[order], counts.indptr)],
+        'lifts': [x.tolist() for x in _split_rows(lifts.data[order], counts.indptr)],
+        'support': cooccurrence.disease_support
+    }, columns=['disease', 'factors', 'counts', 'lifts', 'support'])
+
+
+def _split_rows(values: np.ndarray, indptr: np.ndarray) -> list:
+    # split the flat values of a CSR matrix into one array per row
+    return np.split(values, indptr[1:-1])[:len(indptr) - 1]
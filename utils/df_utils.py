@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
-from utils import text_utils
-from nlp import DiseaseSearcher
+from typing import Dict, List, Tuple, Iterable
+from utils import text_utils, cooccurrence
+from nlp import DiseaseSearcher, DEFAULT_BATCH_SIZE
 
 
 def fix_slashes(df: pd.DataFrame) -> pd.DataFrame:
@@ -27,7 +29,7 @@ def clean_ent_df(ent_df: pd.DataFrame) -> pd.DataFrame:
     """
     Performs basic data cleaning on ent_df
         Strips entity name text
-        Removes semicolons from end indices
+        Removes semicolons from end indices given as strings
         Converts start and end indices to integers
 
     Parameters
@@ -43,7 +45,10 @@ def clean_ent_df(ent_df: pd.DataFrame) -> pd.DataFrame:
     """
     new_df = ent_df.copy()
     new_df['text'] = new_df.text.str.strip()
-    new_df['end_idx'] = new_df.end_idx.str.split(';').str[-1]
+
+    # load_ann already gives integer offsets, only offsets loaded as strings need cleaning
+    if not pd.api.types.is_integer_dtype(new_df.end_idx):
+        new_df['end_idx'] = new_df.end_idx.str.split(';').str[-1]
     for pos in ['start', 'end']:
         new_df[f'{pos}_idx'] = new_df[f'{pos}_idx'].astype(int)
     return new_df
@@ -91,10 +96,7 @@ def get_diagnosis(txt_df: pd.DataFrame) -> pd.DataFrame:
 
     """
     new_df = txt_df.copy()
-    new_df['diagnosis'] = txt_df.text.map(lambda x: text_utils.get_category(x, ('Discharge Diagnosis',
-                                                                                'Discharge Diagnoses',
-                                                                                'Final Discharge Diagnosis',
-                                                                                'Final Discharge Diagnoses')))
+    new_df['diagnosis'] = txt_df.text.map(lambda x: text_utils.get_category(x, text_utils.DIAGNOSIS_HEADERS))
     return new_df.dropna()
 
 
@@ -139,7 +141,7 @@ def get_history(txt_df: pd.DataFrame) -> pd.DataFrame:
 
     """
     new_df = txt_df.copy()
-    new_df['history'] = new_df.text.map(lambda x: text_utils.get_category(x, ('History of Present Illness',)))
+    new_df['history'] = new_df.text.map(lambda x: text_utils.get_category(x, text_utils.HISTORY_HEADERS))
     return new_df
 
 
@@ -161,14 +163,14 @@ def get_complaint(txt_df: pd.DataFrame) -> pd.DataFrame:
 
     """
     new_df = txt_df.copy()
-    new_df['complaint'] = new_df.text.map(lambda x: text_utils.contains_category(x, ('Chief Complaint',)))
+    new_df['complaint'] = new_df.text.map(lambda x: text_utils.contains_category(x, text_utils.COMPLAINT_HEADERS))
     return new_df
 
 
 def split_txt_df(txt_df: pd.DataFrame) -> pd.DataFrame:
     """
     Performs the methods get_diagnosis, get_primary_diagnosis, get_history, and get_complaint
-    in order on the same DataFrame
+    on the same DataFrame in a single pass over the notes, without intermediate copies
 
     Parameters
     ----------
@@ -182,14 +184,136 @@ def split_txt_df(txt_df: pd.DataFrame) -> pd.DataFrame:
         and "complaint" added by the above procedures
 
     """
-    new_df = txt_df.copy()
-    categories = ['diagnosis', 'primary_diagnosis', 'history', 'complaint']
-    for category in categories:
-        new_df = globals()[f'get_{category}'](new_df)
-    return new_df
+    # find all the sections of each note together, so that each note is only scanned once
+    sections = {'diagnosis': [], 'primary_diagnosis': [], 'history': [], 'complaint': []}
+    has_diagnosis = []
+    for text in txt_df.text:
+        diagnosis = text_utils.get_category(text, text_utils.DIAGNOSIS_HEADERS)
+        has_diagnosis.append(diagnosis is not None)
+
+        # leave out notes without a discharge diagnosis
+        if diagnosis is None:
+            continue
+        sections['diagnosis'].append(diagnosis)
+        sections['primary_diagnosis'].append(text_utils.find_primary_diagnoses(diagnosis))
+        sections['history'].append(text_utils.get_category(text, text_utils.HISTORY_HEADERS))
+        sections['complaint'].append(text_utils.contains_category(text, text_utils.COMPLAINT_HEADERS))
+
+    # the new frame shares the note texts with txt_df
+    return txt_df.loc[np.array(has_diagnosis, dtype=bool)].assign(**sections)
+
+
+def find_primary_diseases(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> List[List[str]]:
+    """
+    Finds the canonical names of diseases in the "primary_diagnosis" column of a DataFrame
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        A DataFrame of clinical notes as output by split_txt_df
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
+
+    Returns
+    -------
+    List[List[str]]
+        For each note, the canonical names of diseases in its primary diagnosis
+
+    """
+    return searcher.get_diseases_batch(txt_df.primary_diagnosis, batch_size=batch_size, n_process=n_process)
+
+
+def find_underlying_factors(
+        txt_df: pd.DataFrame,
+        primary_diseases: Iterable[List[str]],
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> List[List[str]]:
+    """
+    Finds the canonical names of diseases in the diagnosis, chief complaint, and history of primary illness
+    of each note in a DataFrame that are not one of its primary diagnoses
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        A DataFrame of clinical notes as output by split_txt_df
+    primary_diseases: Iterable[List[str]]
+        For each note, the canonical names of its primary diseases as output by find_primary_diseases
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
+
+    Returns
+    -------
+    List[List[str]]
+        For each note, the canonical names of its underlying factors
+
+    """
+    # combine the searched sections of each note as the model asks for them, instead of all at once
+    contexts = (
+        text_utils.build_context(diagnosis, history, complaint)
+        for diagnosis, history, complaint in zip(txt_df.primary_diagnosis, txt_df.history, txt_df.complaint)
+    )
+    return searcher.get_factors_batch(contexts, primary_diseases, batch_size=batch_size, n_process=n_process)
+
+
+def find_diseases_and_factors(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> Tuple[List[List[str]], List[List[str]]]:
+    """
+    Finds the outputs of find_primary_diseases and find_underlying_factors with a single NER pass per clinical note,
+    assigning each disease to the primary diagnosis or the other sections by its position in the note
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        A DataFrame of clinical notes as output by split_txt_df
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
+
+    Returns
+    -------
+    Tuple[List[List[str]], List[List[str]]]
+        For each note, the canonical names of its primary diseases and of its underlying factors
+
+    """
+    # combine the searched sections of each note as the model asks for them, remembering where the primary diagnosis is
+    contexts = (
+        text_utils.build_context(diagnosis, history, complaint)
+        for diagnosis, history, complaint in zip(txt_df.primary_diagnosis, txt_df.history, txt_df.complaint)
+    )
+    spans = [text_utils.primary_span(diagnosis) for diagnosis in txt_df.primary_diagnosis]
 
+    results = searcher.get_diseases_and_factors_batch(contexts, spans, batch_size=batch_size, n_process=n_process)
+    return [primary_diseases for primary_diseases, _ in results], [factors for _, factors in results]
 
-def get_primary_diseases(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> pd.DataFrame:
+
+def get_primary_diseases(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> pd.DataFrame:
     """
     Procedure to create a new column in a pandas DataFrame which consists of List[str]
     that are the canonical names of diseases found in the "primary_diagnosis" column
@@ -200,6 +324,10 @@ def get_primary_diseases(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> pd.
         A DataFrame of clinical notes as output by split_txt_df
     searcher: DiseaseSearcher
         A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
 
     Returns
     -------
@@ -208,11 +336,16 @@ def get_primary_diseases(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> pd.
 
     """
     new_df = txt_df.copy()
-    new_df['primary_diseases'] = new_df.primary_diagnosis.map(lambda x: searcher.get_diseases(x))
+    new_df['primary_diseases'] = find_primary_diseases(new_df, searcher, batch_size, n_process)
     return new_df
 
 
-def get_underlying_factors(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> pd.DataFrame:
+def get_underlying_factors(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> pd.DataFrame:
     """
     Procedure to create a new column in a pandas DataFrame which consists of List[str]
     that are the canonical names of diseases found in the diagnosis, chief complaint, and
@@ -224,6 +357,10 @@ def get_underlying_factors(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> p
         A DataFrame of clinical notes as output by get_primary_disease
     searcher: DiseaseSearcher
         A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
 
     Returns
     -------
@@ -232,19 +369,98 @@ def get_underlying_factors(txt_df: pd.DataFrame, searcher: DiseaseSearcher) -> p
 
     """
     new_df = txt_df.copy()
-    new_df['underlying_factors'] = new_df \
-        .apply(lambda x: text_utils.find_factors(
-            x['primary_diagnosis'],
-            x['history'],
-            x['complaint'],
-            x['primary_diseases'],
-            searcher
-        ),
-        axis=1
+    new_df['underlying_factors'] = find_underlying_factors(
+        new_df,
+        new_df.primary_diseases,
+        searcher,
+        batch_size,
+        n_process
+    )
+    return new_df
+
+
+def get_diseases_and_factors(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1
+) -> pd.DataFrame:
+    """
+    Procedure to create the columns "primary_diseases" and "underlying_factors" of get_primary_diseases
+    and get_underlying_factors with a single NER pass per clinical note, assigning each disease
+    to the primary diagnosis or the other sections by its position in the note
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        A DataFrame of clinical notes as output by split_txt_df
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
+
+    Returns
+    -------
+    pandas DataFrame
+        A copy of txt_df with the additional columns "primary_diseases" and "underlying_factors"
+
+    """
+    new_df = txt_df.copy()
+    new_df['primary_diseases'], new_df['underlying_factors'] = find_diseases_and_factors(
+        new_df,
+        searcher,
+        batch_size,
+        n_process
     )
     return new_df
 
 
+def process_txt_df(
+        txt_df: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        n_process: int = 1,
+        single_pass: bool = False
+) -> pd.DataFrame:
+    """
+    Performs split_txt_df, get_primary_diseases, and get_underlying_factors
+    in order on the same DataFrame, adding each column to a single new DataFrame
+    instead of copying it at every step
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        The clinical notes DataFrame as output by utils.load_data.load_txt
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time
+    n_process: int (default=1)
+        The number of processes used to run the NER model
+    single_pass: bool (default=False)
+        If true, get_diseases_and_factors is used instead of get_primary_diseases and get_underlying_factors
+        so that each note only goes through the NER model once
+
+    Returns
+    -------
+    pandas DataFrame
+        A copy of txt_df with the columns added by the above procedures,
+        ready to be passed to create_disease_df
+
+    """
+    new_df = split_txt_df(txt_df)
+    if single_pass:
+        primary_diseases, factors = find_diseases_and_factors(new_df, searcher, batch_size, n_process)
+    else:
+        primary_diseases = find_primary_diseases(new_df, searcher, batch_size, n_process)
+        factors = find_underlying_factors(new_df, primary_diseases, searcher, batch_size, n_process)
+    new_df['primary_diseases'] = primary_diseases
+    new_df['underlying_factors'] = factors
+    return new_df
+
+
 def create_disease_df(txt_df: pd.DataFrame) -> pd.DataFrame:
     """
     Procedure to create a new DataFrame that consists of diseases
@@ -259,33 +475,49 @@ def create_disease_df(txt_df: pd.DataFrame) -> pd.DataFrame:
     Returns
     -------
     pandas DataFrame
-        A DataFrame with two columns:
+        A DataFrame with the columns:
             "disease": the name of a disease found in the "primary_diseases" column of txt_df
             "factors": the underlying factors as found in the "underlying_factors" column of
-                       txt_df for the given disease
+                       txt_df for the given disease, from most to least frequent
+            "counts": the number of notes in which each factor occurs with the disease
+            "lifts": how many times more often each factor occurs with the disease than in all notes
+            "support": the number of notes with the disease as a primary disease
 
     """
-    # create empty dictionary to store diseases and their factors
-    disease_dict = {}
+    # count the co-occurrences of diseases and factors as a sparse matrix and rank the factors of each disease
+    return cooccurrence.to_disease_df(cooccurrence.create_cooccurrence(txt_df))
+
 
-    # iterate through row of the DataFrame
-    for index, row in txt_df[['primary_diseases', 'underlying_factors']].iterrows():
-        diseases, factors = row.primary_diseases, row.underlying_factors
+def get_disease_identifiers(
+        disease_db: pd.DataFrame,
+        searcher: DiseaseSearcher,
+        linked_cuis: Dict[str, str]
+) -> pd.DataFrame:
+    """
+    Procedure to create new columns in the disease database with the knowledge base identifiers
+    of each disease, so that it can be looked up without running the NER model
 
-        # iterate through diseases in the row
-        for disease in diseases:
-            if disease not in disease_dict:
-                # add set to remove duplicates
-                disease_dict[disease] = set(factors)
-            else:
-                # union sets to prevent adding duplicates
-                disease_dict[disease] = disease_dict[disease].union(set(factors))
+    Parameters
+    ----------
+    disease_db: pandas DataFrame
+        A DataFrame of diseases as output by create_disease_df
+    searcher: DiseaseSearcher
+        A NER model linked to a medical knowledge database
+    linked_cuis: Dict[str, str]
+        The concept identifier each disease was linked from while extracting it, see nlp.DiseaseSearcher.linked_cuis
+        Different concepts can share a canonical name, so it is not looked up again by name
 
-    # convert sets back into lists
-    disease_dict = {key: list(value) for key, value in disease_dict.items()}
+    Returns
+    -------
+    pandas DataFrame
+        A copy of disease_db with the additional columns:
+            "cui": the concept identifier of the disease in the knowledge base, or None if it was not recorded
+            "aliases": the known aliases of the disease in the knowledge base
 
-    # create pandas DataFrame and return it
-    return pd.DataFrame({
-        'disease': disease_dict.keys(),
-        'factors': disease_dict.values()
-    })
+    """
+    new_df = disease_db.copy()
+    cuis = [linked_cuis.get(disease) for disease in new_df.disease]
+    entities = searcher.find_concepts(cui for cui in cuis if cui is not None)
+    new_df['cui'] = [cui if cui in entities else None for cui in cuis]
+    new_df['aliases'] = [list(entities[cui].aliases) if cui in entities else [] for cui in cuis]
+    return new_df
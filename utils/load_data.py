@@ -1,10 +1,47 @@
+import os
+import sys
 import glob
+import json
+import logging
+import numpy as np
 import pandas as pd
 from time import time
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Iterator, List
+from utils import metrics
 
+# number of threads reading note files at a time
+DEFAULT_IO_WORKERS = 32
 
-def load_txt(data_path: str) -> pd.DataFrame:
+logger = logging.getLogger("diagnosis.load_data")
+
+# columns of the entity and relationship dfs output by load_ann
+ENTITY_COLUMNS = ["file_idx", "entity_id", "category", "start_idx", "end_idx", "text"]
+RELATIONSHIP_COLUMNS = ["file_idx", "relationship_id", "category", "entity1", "entity2"]
+
+
+def _file_idx(file_path: str) -> str:
+    # the identifier of a note is its file name without extension
+    return os.path.basename(file_path).split(".")[0]
+
+
+def _list_files(data_path: str, extension: str) -> List[str]:
+    # sort the files so that notes are loaded in the same order on every run
+    return sorted(glob.glob(os.path.join(data_path, "*" + extension)))
+
+
+def _read_file(file_path: str) -> str:
+    with open(file_path, "r") as file:
+        return file.read()
+
+
+def _read_files(file_paths: List[str], n_workers: int) -> List[str]:
+    # reading is dominated by waiting on storage, so threads overlap the waits despite the GIL
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_read_file, file_paths))
+
+
+def load_txt(data_path: str, n_workers: int = DEFAULT_IO_WORKERS, snapshot_path: str = None) -> pd.DataFrame:
     """
     Load the text from the .txt files as a df.
     
@@ -12,7 +49,13 @@ def load_txt(data_path: str) -> pd.DataFrame:
     ----------
     data_path: str
         Path to location of .txt files.
-    
+    n_workers: int (default=DEFAULT_IO_WORKERS)
+        Number of threads reading files concurrently.
+    snapshot_path: str (default=None)
+        Path to a Parquet snapshot of the loaded notes. If given, notes
+        whose file size and modification time are unchanged since the
+        snapshot was saved are taken from it instead of being read again,
+        and the snapshot is updated if any note was read. Needs pyarrow.
     
     Returns
     -------
@@ -23,17 +66,20 @@ def load_txt(data_path: str) -> pd.DataFrame:
     # load txt files
     t0 = time()
     
-    file_paths = glob.glob(data_path + "*.txt")
-    files = []
-    for i in file_paths:
-        with open(i, "r") as file:
-            l = file.read()
-            files.append(l)
-
-    print(f"Time taken to read .txt files: {time() - t0}")
+    file_paths = _list_files(data_path, ".txt")
+    if snapshot_path is None:
+        files = _read_files(file_paths, n_workers)
+    else:
+        files = _load_snapshot_texts(file_paths, snapshot_path, n_workers)
+
+    elapsed = time() - t0
+    metrics.observe("load_txt", elapsed)
+    metrics.increment("notes_loaded", len(files))
+    logger.info(f"Read {len(files)} .txt files in {elapsed:.2f}s",
+                extra={"stage": "load_txt", "seconds": elapsed, "files": len(files)})
     
     # convert to df
-    file_names = [p.split("/")[-1].split(".")[0] for p in file_paths]
+    file_names = [_file_idx(p) for p in file_paths]
     text_df = pd.DataFrame({
         "file_idx": file_names,
         "text": files
@@ -42,7 +88,102 @@ def load_txt(data_path: str) -> pd.DataFrame:
     return text_df
 
 
-def load_ann(data_path: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def _load_snapshot_texts(file_paths: List[str], snapshot_path: str, n_workers: int) -> List[str]:
+    """
+    Load the text of .txt files, reusing the text saved in a snapshot
+    for files which did not change since, and update the snapshot.
+
+    Parameters
+    ----------
+    file_paths: List[str]
+        Paths to the .txt files.
+    snapshot_path: str
+        Path to the Parquet snapshot.
+    n_workers: int
+        Number of threads reading files concurrently.
+
+    Returns
+    -------
+    List[str]
+        The text of each file.
+    """
+    # stat the files concurrently, which is much cheaper than reading them
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        stats = list(executor.map(os.stat, file_paths))
+    keys = [(p, st.st_size, st.st_mtime_ns) for p, st in zip(file_paths, stats)]
+
+    # take the text of unchanged files from the snapshot
+    cached = {}
+    if os.path.isfile(snapshot_path):
+        snapshot = pd.read_parquet(snapshot_path)
+        cached = {
+            (p, size, mtime): text
+            for p, size, mtime, text in zip(snapshot.path, snapshot["size"], snapshot.mtime, snapshot.text)
+        }
+    files = [cached.get(key) for key in keys]
+
+    # read the new and changed files
+    stale = [i for i, text in enumerate(files) if text is None]
+    for i, text in zip(stale, _read_files([file_paths[i] for i in stale], n_workers)):
+        files[i] = text
+    metrics.increment("snapshot_hits", len(files) - len(stale))
+    metrics.increment("snapshot_misses", len(stale))
+    logger.info(f"Took {len(files) - len(stale)} of {len(files)} notes from the snapshot")
+
+    # save the snapshot again if any file was added, changed, or deleted
+    if stale or len(cached) != len(keys):
+        snapshot = pd.DataFrame({
+            "path": file_paths,
+            "size": np.array([size for _, size, _ in keys], dtype=np.int64),
+            "mtime": np.array([mtime for _, _, mtime in keys], dtype=np.int64),
+            "text": files
+        })
+        tmp_path = snapshot_path + ".tmp"
+        snapshot.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, snapshot_path)
+
+    return files
+
+
+def _parse_ann(file_path: str) -> Tuple[List[tuple], List[tuple]]:
+    """
+    Parse the entities and relationships of a single .ann file.
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the .ann file.
+
+    Returns
+    -------
+    Tuple[List[tuple], List[tuple]]
+        The rows of the entity and relationship dfs of load_ann for this file.
+    """
+    file_idx = _file_idx(file_path)
+    entities, relationships = [], []
+    with open(file_path, "r") as f:
+        for line in f:
+            out = line.split("\t")
+            ann_type = line[:1]
+
+            if ann_type == "T":
+                # entities, whose offsets are "start end" or "start end;start end" for discontinuous spans
+                category, offsets = out[1].split(" ", 1)
+                start_idx = int(offsets.split(" ", 1)[0])
+                end_idx = int(offsets.rsplit(" ", 1)[-1])
+                entities.append((file_idx, out[0], category, start_idx, end_idx, out[2]))
+
+            elif ann_type == "R":
+                # relationships
+                fields = out[1].split(" ")
+                relationships.append((file_idx, out[0], fields[0], fields[1], fields[2]))
+
+            # skip annotator notes
+
+    return entities, relationships
+
+
+def load_ann(data_path: str, n_workers: int = DEFAULT_IO_WORKERS) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     The .ann files contain metadata on entities present in the clinical
     documentation as well as some relationships between some of the
@@ -52,70 +193,90 @@ def load_ann(data_path: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
     ----------
     data_path: str
         Path to location of .ann files.
+    n_workers: int (default=DEFAULT_IO_WORKERS)
+        Number of threads reading files concurrently.
         
     Returns
     -------
     Tuple[pandas DataFrame, pandas DataFrame]
         Two DFs indexed by file name. One contains all the labeled entities
-        from the .txt files. The other contains the relationships between
-        some of the entities.
+        from the .txt files, with integer start and end offsets. The other
+        contains the relationships between some of the entities.
     """
     # load ann files
     t0 = time()
 
-    ann_paths = glob.glob(data_path + "*.ann") 
-    entity_dict = {
-        "file_idx": [],
-        "entity_id": [],
-        "category": [],
-        "start_idx": [],
-        "end_idx": [],
-        "text": []
-    }
-
-    rel_dict = {
-        "file_idx": [],
-        "relationship_id": [],
-        "category": [],
-        "entity1": [],
-        "entity2": []
-    }
-
-    for i in ann_paths:
-        file_idx = i.split("/")[-1].split(".")[0]
-        with open(i, "r") as f:
-            lines = f.readlines()
-            # reasons.append(lines)
-
-        for line in lines:
-            out = line.split("\t")
-            ann_type = out[0][0]
+    ann_paths = _list_files(data_path, ".ann")
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        parsed = list(executor.map(_parse_ann, ann_paths))
 
-            if ann_type == "T":
-                # entities
-                entity_dict["file_idx"].append(file_idx)
-                entity_dict["entity_id"].append(out[0])
-                entity_dict["category"].append(out[1].split(" ")[0])
-                entity_dict["start_idx"].append(out[1].split(" ")[1])
-                entity_dict["end_idx"].append(out[1].split(" ")[2])
-                entity_dict["text"].append(out[2])
+    elapsed = time() - t0
+    metrics.observe("load_ann", elapsed)
+    logger.info(f"Read {len(ann_paths)} .ann files and extracted all metadata in {elapsed:.2f}s",
+                extra={"stage": "load_ann", "seconds": elapsed, "files": len(ann_paths)})
 
-            elif ann_type == "R":
-                # relationships
-                rel_dict["file_idx"].append(file_idx)
-                rel_dict["relationship_id"].append(out[0])
-                rel_dict["category"].append(out[1].split(" ")[0])
-                rel_dict["entity1"].append(out[1].split(" ")[1])
-                rel_dict["entity2"].append(out[1].split(" ")[2])
-
-            else:
-                # skip annotator notes
-                continue
-
-    print("Time taken to read .ann files and extract all " + 
-          f"metadata: {time() - t0}")
-    
-    ann_df = pd.DataFrame(entity_dict)
-    rel_df = pd.DataFrame(rel_dict)
+    ann_df = pd.DataFrame.from_records(
+        [row for entities, _ in parsed for row in entities],
+        columns=ENTITY_COLUMNS
+    ).astype({"start_idx": np.int64, "end_idx": np.int64})
+    rel_df = pd.DataFrame.from_records(
+        [row for _, relationships in parsed for row in relationships],
+        columns=RELATIONSHIP_COLUMNS
+    )
     
     return ann_df, rel_df
+
+
+def iter_notes(source: str) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily read clinical notes one at a time, so that any number of notes can be processed in bounded memory
+
+    Parameters
+    ----------
+    source: str
+        One of:
+            A directory, whose .txt files are read
+            A path ending in .jsonl, or - for stdin, with one JSON object per line with the fields "id" and "text"
+            A glob pattern of .txt files
+
+    Returns
+    -------
+    Iterator[Tuple[str, str]]
+        Pairs of the identifier and the text of each note
+        The identifier of a .txt file is its file name without extension,
+        and the identifier of a JSON line without an "id" field is its line number, counted from 1 as in the warnings
+        JSON lines which cannot be parsed or have no "text" string are skipped with a warning,
+        and counted in the metric notes_skipped
+
+    """
+    # stream JSON lines
+    if source == "-" or source.endswith(".jsonl"):
+        file = sys.stdin if source == "-" else open(source, "r")
+        try:
+            for line_number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+
+                # skip malformed records instead of stopping the whole stream
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    record, reason = None, f"invalid JSON ({error})"
+                else:
+                    reason = "no \"text\" string"
+                if not isinstance(record, dict) or not isinstance(record.get("text"), str):
+                    logger.warning(f"Skipping line {line_number} of {source}: {reason}")
+                    metrics.increment("notes_skipped")
+                    continue
+                yield str(record.get("id", line_number)), record["text"]
+        finally:
+            if file is not sys.stdin:
+                file.close()
+        return
+
+    # stream .txt files
+    pattern = os.path.join(source, "*.txt") if os.path.isdir(source) else source
+    for file_path in glob.iglob(pattern):
+        with open(file_path, "r") as file:
+            text = file.read()
+        yield _file_idx(file_path), text
@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from typing import Tuple, List, Union
+
+# columns of a manifest DataFrame
+MANIFEST_COLUMNS = ['file_idx', 'digest', 'primary_diseases', 'underlying_factors']
+
+
+def hash_text(text: str) -> str:
+    """
+    Content hash of the text of a clinical note
+
+    Parameters
+    ----------
+    text: str
+        The text of a clinical note
+
+    Returns
+    -------
+    str
+        The hex digest of the SHA-256 hash of the UTF-8 encoded text
+
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def create_manifest(txt_df: pd.DataFrame, processed_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Procedure to create a manifest of processed clinical notes, recording the content hash of every note
+    together with the primary diseases and underlying factors extracted from it
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        The clinical notes DataFrame as output by utils.load_data.load_txt
+    processed_df: pandas DataFrame
+        A DataFrame with columns "file_idx", "primary_diseases", and "underlying_factors"
+        as output by utils.df_utils.process_txt_df on txt_df
+        Notes of txt_df missing from processed_df, such as those without a diagnosis, are recorded with no diseases
+
+    Returns
+    -------
+    pandas DataFrame
+        A DataFrame with one row per note of txt_df, in the same order, and columns
+            "file_idx": the name of the note
+            "digest": the content hash of the note as given by hash_text
+            "primary_diseases": the canonical names of the primary diseases of the note
+            "underlying_factors": the canonical names of the underlying factors of the note
+
+    """
+    # look up the extracted diseases of each note
+    processed = processed_df.set_index('file_idx')
+    primary_diseases = processed.primary_diseases.to_dict()
+    underlying_factors = processed.underlying_factors.to_dict()
+
+    return pd.DataFrame({
+        'file_idx': txt_df.file_idx.values,
+        'digest': txt_df.text.map(hash_text).values,
+        'primary_diseases': [primary_diseases.get(file_idx, []) for file_idx in txt_df.file_idx],
+        'underlying_factors': [underlying_factors.get(file_idx, []) for file_idx in txt_df.file_idx]
+    }, columns=MANIFEST_COLUMNS)
+
+
+def diff_manifest(manifest: pd.DataFrame, txt_df: pd.DataFrame) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Compares a manifest to the current clinical notes
+
+    Parameters
+    ----------
+    manifest: pandas DataFrame
+        A manifest as output by create_manifest
+    txt_df: pandas DataFrame
+        The current clinical notes DataFrame as output by utils.load_data.load_txt
+
+    Returns
+    -------
+    Tuple[pandas DataFrame, List[str]]
+        A tuple of:
+            1. The rows of txt_df which are new or whose content changed since the manifest was created
+            2. The file names in the manifest which no longer exist in txt_df
+
+    """
+    known_digests = dict(zip(manifest.file_idx, manifest.digest))
+    digests = txt_df.text.map(hash_text)
+
+    # a note needs processing if we have never seen its name with this content
+    stale = [known_digests.get(file_idx) != digest for file_idx, digest in zip(txt_df.file_idx, digests)]
+
+    current = set(txt_df.file_idx)
+    deleted = [file_idx for file_idx in manifest.file_idx if file_idx not in current]
+    return txt_df.loc[stale], deleted
+
+
+def update_manifest(
+        manifest: pd.DataFrame,
+        txt_df: pd.DataFrame,
+        stale_df: pd.DataFrame,
+        processed_df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Patches a manifest with newly processed clinical notes and removes deleted notes
+
+    Parameters
+    ----------
+    manifest: pandas DataFrame
+        A manifest as output by create_manifest
+    txt_df: pandas DataFrame
+        The current clinical notes DataFrame as output by utils.load_data.load_txt
+    stale_df: pandas DataFrame
+        The new or changed notes of txt_df, as output by diff_manifest
+    processed_df: pandas DataFrame
+        The output of utils.df_utils.process_txt_df on stale_df
+
+    Returns
+    -------
+    pandas DataFrame
+        A manifest of every note in txt_df, in the same order as txt_df,
+        as if create_manifest had been run on the whole of txt_df
+
+    """
+    patch = create_manifest(stale_df, processed_df)
+
+    # replace the stale rows with the patch and drop rows of deleted notes
+    kept = manifest.loc[~manifest.file_idx.isin(patch.file_idx) & manifest.file_idx.isin(txt_df.file_idx)]
+    new_manifest = pd.concat([kept, patch]).set_index('file_idx')
+
+    # order the notes as they are loaded so the database matches a full rebuild
+    return new_manifest.loc[txt_df.file_idx.values].reset_index()
+
+
+def load_manifest(file_path: str) -> Union[pd.DataFrame, None]:
+    """
+    Load a saved manifest
+
+    Parameters
+    ----------
+    file_path: str
+        Path to the pickled manifest
+
+    Returns
+    -------
+    pandas DataFrame or None
+        The saved manifest if it exists, otherwise None
+
+    """
+    if not os.path.isfile(file_path):
+        return None
+    return pd.read_pickle(file_path)
+
+
+def save_fingerprint(file_path: str, fingerprint: str) -> None:
+    """
+    Save the fingerprint of the extraction settings a manifest was created with,
+    such as given by DiagnosisDatabase.extraction_fingerprint
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the JSON file the fingerprint is written to
+    fingerprint: str
+        The fingerprint
+    """
+    with open(file_path, 'w') as file:
+        json.dump({'fingerprint': fingerprint}, file)
+
+
+def load_fingerprint(file_path: str) -> Union[str, None]:
+    """
+    Load the fingerprint saved by save_fingerprint
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the JSON file of the fingerprint
+
+    Returns
+    -------
+    str or None
+        The saved fingerprint if it exists, otherwise None
+
+    """
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'r') as file:
+        return json.load(file).get('fingerprint')
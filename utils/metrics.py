@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple, Union
+
+# prefix of the exported metric names
+METRIC_PREFIX = 'diagnosis'
+
+logger = logging.getLogger('diagnosis.metrics')
+
+
+class Metrics:
+    """
+    A thread-safe registry of the durations of the stages of detection and database creation,
+    and of counters such as the number of entities found and link cache hits
+
+    Stage durations are also logged at the DEBUG level of the diagnosis.metrics logger,
+    with the stage name and duration as the extra fields "stage" and "seconds" for structured logs
+
+    Attributes:
+        enabled: bool
+            Whether stages and counters are recorded, when False recording costs close to nothing
+            and the NER pipeline runs without being split into timed components
+    """
+    def __init__(self, enabled: bool = False):
+        """
+        Initializes an empty Metrics registry
+
+        Parameters
+        ----------
+        enabled: bool (default=False)
+            Whether stages and counters are recorded
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Records how long the body of the with statement takes as a stage
+
+        Parameters
+        ----------
+        name: str
+            The name of the stage, such as "ner" or "load_txt"
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Records a duration of a stage which was timed elsewhere
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            count, total, maximum = self._stages.get(name, (0, 0.0, 0.0))
+            self._stages[name] = (count + 1, total + seconds, max(maximum, seconds))
+        logger.debug(f'{name} took {seconds:.6f}s', extra={'stage': name, 'seconds': seconds})
+
+    def increment(self, name: str, value: Union[int, float] = 1, **labels: str) -> None:
+        """
+        Adds to a counter, such as the number of entities found
+
+        Parameters
+        ----------
+        name: str
+            The name of the counter
+        value: int or float (default=1)
+            The amount added
+        labels: str
+            Labels which distinguish series of the same counter, such as label="DISEASE"
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: Union[int, float], **labels: str) -> None:
+        """
+        Sets a value which can go up and down, such as the size of a cache
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def reset(self) -> None:
+        """
+        Forgets everything recorded so far
+        """
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Everything recorded so far
+
+        Returns
+        -------
+        Dict[str, dict]
+            A dictionary with the keys:
+                "stages": for each stage, its "count", "total_seconds", and "max_seconds"
+                "counters" and "gauges": for each name, the value of each set of labels,
+                                         with the labels formatted as in the Prometheus text format
+        """
+        with self._lock:
+            stages = {
+                name: {'count': count, 'total_seconds': total, 'max_seconds': maximum}
+                for name, (count, total, maximum) in self._stages.items()
+            }
+            counters, gauges = {}, {}
+            for values, series in [(counters, self._counters), (gauges, self._gauges)]:
+                for (name, labels), value in series.items():
+                    values.setdefault(name, {})[_format_labels(labels)] = value
+        return {'stages': stages, 'counters': counters, 'gauges': gauges}
+
+    def to_prometheus(self) -> str:
+        """
+        Everything recorded so far in the Prometheus text exposition format
+
+        Returns
+        -------
+        str
+            The stage durations as the summary diagnosis_stage_seconds and its maximum diagnosis_stage_seconds_max,
+            labeled by stage, followed by the counters as diagnosis_<name>_total and the gauges as diagnosis_<name>
+        """
+        with self._lock:
+            stages = sorted(self._stages.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        if stages:
+            name = f'{METRIC_PREFIX}_stage_seconds'
+            lines.append(f'# HELP {name} Time spent in each stage of detection and database creation')
+            lines.append(f'# TYPE {name} summary')
+            for stage, (count, total, _) in stages:
+                labels = _format_labels((('stage', stage),))
+                lines.append(f'{name}_count{labels} {count}')
+                lines.append(f'{name}_sum{labels} {total!r}')
+            lines.append(f'# TYPE {name}_max gauge')
+            for stage, (_, _, maximum) in stages:
+                lines.append(f'{name}_max{_format_labels((("stage", stage),))} {maximum!r}')
+
+        for series, suffix, kind in [(counters, '_total', 'counter'), (gauges, '', 'gauge')]:
+            previous = None
+            for (name, labels), value in series:
+                full_name = f'{METRIC_PREFIX}_{name}{suffix}'
+                if full_name != previous:
+                    lines.append(f'# TYPE {full_name} {kind}')
+                    previous = full_name
+                lines.append(f'{full_name}{_format_labels(labels)} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes self.to_prometheus() to a file, such as one read by the node exporter textfile collector,
+        replacing it atomically so it is never read half written
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line, including the extra fields of the record such as
+    the "stage" and "seconds" of the stages recorded by Metrics
+    """
+    # attributes every log record has, which are not extra fields
+    _STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self._STANDARD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = 'INFO', json_format: bool = False) -> None:
+    """
+    Sends the log messages of the diagnosis loggers to stderr
+
+    Parameters
+    ----------
+    level: str (default='INFO')
+        The lowest level logged, DEBUG also logs the duration of every stage
+    json_format: bool (default=False)
+        If true, each message is logged as a JSON object on its own line
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter('%(message)s'))
+    root = logging.getLogger('diagnosis')
+    root.handlers = [handler]
+    root.setLevel(level)
+    root.propagate = False
+
+
+# the registry shared by the whole program
+METRICS = Metrics()
+stage = METRICS.stage
+observe = METRICS.observe
+increment = METRICS.increment
+set_gauge = METRICS.set_gauge
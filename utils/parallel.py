@@ -0,0 +1,186 @@
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+from utils import df_utils
+from nlp import DiseaseSearcher, DEFAULT_BATCH_SIZE
+
+# default number of clinical notes given to a worker process at a time
+DEFAULT_CHUNK_SIZE = 256
+
+# the NER model of the current worker process, loaded once by _init_worker
+_searcher = None
+_batch_size = DEFAULT_BATCH_SIZE
+_single_pass = False
+
+
+def _init_worker(model_name: str, batch_size: int, single_pass: bool, searcher_kwargs: dict) -> None:
+    """
+    Loads the NER model of a worker process
+
+    Parameters
+    ----------
+    model_name: str
+        The name of one of scispacy's NER models
+    batch_size: int
+        The number of notes passed through the NER model at a time
+    single_pass: bool
+        Whether each note only goes through the NER model once, see utils.df_utils.process_txt_df
+    searcher_kwargs: dict
+        Keyword arguments passed to DiseaseSearcher
+    """
+    global _searcher, _batch_size, _single_pass
+    _searcher = DiseaseSearcher(model_name, **searcher_kwargs)
+    _batch_size = batch_size
+    _single_pass = single_pass
+
+
+def _process_shard(shard: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    Runs the section split, primary disease and underlying factor extraction on a shard of clinical notes
+
+    Parameters
+    ----------
+    shard: pandas DataFrame
+        A slice of the clinical notes DataFrame as output by utils.load_data.load_txt
+
+    Returns
+    -------
+    pandas DataFrame
+        The columns "file_idx", "primary_diseases", and "underlying_factors" of the processed shard
+    Dict[str, str]
+        The concept identifier each canonical name was first linked from by the worker process,
+        see nlp.DiseaseSearcher.linked_cuis
+
+    """
+    shard = df_utils.process_txt_df(shard, _searcher, _batch_size, single_pass=_single_pass)
+    return shard[['file_idx', 'primary_diseases', 'underlying_factors']], dict(_searcher.linked_cuis)
+
+
+def _find_mentions(text: str) -> List[Tuple[int, int, str]]:
+    """
+    Finds the linked diseases of a window of a long text with the NER model of the worker process,
+    see nlp.DiseaseSearcher.mentions
+    """
+    return _searcher.mentions(_searcher.process_one(text))
+
+
+def shard_txt_df(txt_df: pd.DataFrame, chunk_size: int) -> List[pd.DataFrame]:
+    """
+    Splits a DataFrame of clinical notes into consecutive shards
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        The clinical notes DataFrame as output by utils.load_data.load_txt
+    chunk_size: int
+        The maximum number of notes in a shard
+
+    Returns
+    -------
+    List[pandas DataFrame]
+        The shards of txt_df, in order
+
+    """
+    return [txt_df.iloc[start:start + chunk_size] for start in range(0, len(txt_df), chunk_size)]
+
+
+def process_txt_df_parallel(
+        txt_df: pd.DataFrame,
+        model_name: str,
+        n_workers: int = os.cpu_count(),
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        single_pass: bool = False,
+        searcher_kwargs: dict = None,
+        linked_cuis: Dict[str, str] = None
+) -> pd.DataFrame:
+    """
+    Parallel version of utils.df_utils.process_txt_df which processes shards of the clinical notes
+    in a pool of worker processes, each with its own NER model
+
+    Parameters
+    ----------
+    txt_df: pandas DataFrame
+        The clinical notes DataFrame as output by utils.load_data.load_txt
+    model_name: str
+        The name of one of scispacy's NER models
+    n_workers: int (default=os.cpu_count())
+        The number of worker processes
+    chunk_size: int (default=DEFAULT_CHUNK_SIZE)
+        The number of notes given to a worker process at a time
+    batch_size: int (default=DEFAULT_BATCH_SIZE)
+        The number of notes passed through the NER model at a time within a worker
+    single_pass: bool (default=False)
+        Whether each note only goes through the NER model once, see utils.df_utils.process_txt_df
+    searcher_kwargs: dict (default=None)
+        Keyword arguments passed to the DiseaseSearcher of each worker
+    linked_cuis: Dict[str, str] (default=None)
+        If given, filled with the concept identifier each canonical name was first linked from by the workers,
+        see nlp.DiseaseSearcher.linked_cuis
+
+    Returns
+    -------
+    pandas DataFrame
+        A DataFrame with columns "file_idx", "primary_diseases", and "underlying_factors"
+        whose rows are in the same order as the output of utils.df_utils.process_txt_df,
+        so that utils.df_utils.create_disease_df gives the same database as a serial build
+
+    """
+    shards = shard_txt_df(txt_df, chunk_size)
+    initargs = (model_name, batch_size, single_pass, searcher_kwargs or {})
+
+    # executor.map returns the shards in submission order, which keeps the merge deterministic
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs) as executor:
+        results = list(executor.map(_process_shard, shards))
+
+    # keep the concept of the earliest shard which linked each name, as a serial build would
+    if linked_cuis is not None:
+        for _, shard_cuis in results:
+            for name, cui in shard_cuis.items():
+                linked_cuis.setdefault(name, cui)
+    results = [shard for shard, _ in results]
+
+    if not results:
+        return pd.DataFrame(columns=['file_idx', 'primary_diseases', 'underlying_factors'])
+    return pd.concat(results)
+
+
+class WindowPool:
+    """
+    A pool of worker processes, each with its own NER model, which finds the linked diseases of the windows
+    of long clinical notes in parallel, see utils.text_utils.find_mentions_windowed
+
+    The workers load their models once and are kept for the lifetime of the pool,
+    so a note only pays for sending its windows to the workers and back
+
+    Attributes:
+        executor: ProcessPoolExecutor
+            The worker processes
+    """
+    def __init__(self, model_name: str, n_workers: int = os.cpu_count(), searcher_kwargs: dict = None):
+        """
+        Initializes the WindowPool and starts its worker processes
+
+        Parameters
+        ----------
+        model_name: str
+            The name of one of scispacy's NER models
+        n_workers: int (default=os.cpu_count())
+            The number of worker processes
+        searcher_kwargs: dict (default=None)
+            Keyword arguments passed to the DiseaseSearcher of each worker, which should match those of
+            the DiseaseSearcher of the windows' notes so both link to the same canonical names
+        """
+        initargs = (model_name, DEFAULT_BATCH_SIZE, False, searcher_kwargs or {})
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs)
+
+    def map(self, texts: List[str]) -> List[List[Tuple[int, int, str]]]:
+        """
+        Finds the linked diseases of each window, as nlp.DiseaseSearcher.get_mentions_batch,
+        with one window per task so the windows of a single note are spread over all workers
+        """
+        return list(self.executor.map(_find_mentions, texts))
+
+    def close(self) -> None:
+        self.executor.shutdown()
@@ -0,0 +1,61 @@
+import sys
+import time
+import logging
+from contextlib import contextmanager
+from typing import Iterator, Union
+from utils import metrics
+
+try:
+    import resource
+except ImportError:
+    # the resource module is not available on Windows
+    resource = None
+
+logger = logging.getLogger('diagnosis.profiling')
+
+
+def peak_rss() -> Union[int, None]:
+    """
+    Finds the peak resident set size of the current process so far
+
+    Returns
+    -------
+    int or None
+        The peak resident set size in bytes, or None if it cannot be measured on this platform
+
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports the peak in bytes, other platforms in kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Logs how long a stage of a procedure took and the peak memory of the process once it finished,
+    along with how much the stage raised that peak, and records both in utils.metrics
+
+    Parameters
+    ----------
+    name: str
+        The name of the stage, such as "build.load_notes"
+
+    """
+    start_peak = peak_rss()
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    end_peak = peak_rss()
+    metrics.observe(name, elapsed)
+
+    if end_peak is None:
+        logger.info(f'{name}: {elapsed:.1f}s', extra={'stage': name, 'seconds': elapsed})
+    else:
+        metrics.set_gauge('peak_rss_bytes', end_peak, stage=name)
+        logger.info(
+            f'{name}: {elapsed:.1f}s, peak RSS {end_peak / 2**20:.0f} MiB (+{(end_peak - start_peak) / 2**20:.0f} MiB)',
+            extra={'stage': name, 'seconds': elapsed, 'peak_rss_bytes': end_peak}
+        )
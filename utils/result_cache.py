@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+from importlib import metadata
+from typing import Iterable, Union
+from utils.cache import LRUCache
+from utils.manifest import hash_text
+
+# default number of clinical notes whose diagnoses are remembered
+DEFAULT_RESULT_CACHE_SIZE = 100000
+
+
+def file_fingerprint(paths: Iterable[str]) -> list:
+    """
+    The size and modification time of each file, which change whenever a file is written or replaced
+
+    Parameters
+    ----------
+    paths: Iterable[str]
+        Paths of files
+
+    Returns
+    -------
+    list
+        For each path, the path with its size and modification time in nanoseconds, or None if it does not exist
+
+    """
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            fingerprint.append([path, None])
+        else:
+            fingerprint.append([path, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def package_version(name: str) -> Union[str, None]:
+    """
+    The installed version of a package, such as a scispacy model, or None if it is not installed as a package
+    """
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def combine_versions(*parts) -> str:
+    """
+    A short digest of JSON serializable version information, such as file fingerprints and package versions
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Remembers the diagnoses of clinical notes by the content hash of their text, so notes which are sent again
+    are answered without running the NER model
+
+    Entries are keyed by the version of the database and the NER model as well as the text, so that a cache saved
+    by save is only reused by a detector with the same database and model, and stale entries are dropped when loaded
+
+    Attributes:
+        version: str
+            The version of the database and NER model of the cached diagnoses
+        path: str or None
+            Where the cache is saved, or None if it is not saved
+        cache: LRUCache
+            The diagnoses of each note by its version and content hash
+    """
+    def __init__(self, version: str, maxsize: int = DEFAULT_RESULT_CACHE_SIZE, path: str = None):
+        """
+        Initializes the ResultCache, loading the entries of the same version saved at path
+
+        Parameters
+        ----------
+        version: str
+            The version of the database and NER model, such as given by DiagnosisDatabase.version
+        maxsize: int (default=DEFAULT_RESULT_CACHE_SIZE)
+            The maximum number of notes whose diagnoses are remembered, the least recently used are evicted first
+        path: str (default=None)
+            If given, the cache is loaded from this file if it exists and self.save writes to it
+        """
+        self.version = version
+        self.path = path
+        if path is not None:
+            self.cache = LRUCache.load(path, maxsize, keep=lambda key: key[0] == version)
+        else:
+            self.cache = LRUCache(maxsize)
+
+    def key(self, text: str) -> tuple:
+        return self.version, hash_text(text)
+
+    def get(self, text: str) -> Union[dict, None]:
+        """
+        Look up the diagnoses of a clinical note
+
+        Parameters
+        ----------
+        text: str
+            The text of a clinical note
+
+        Returns
+        -------
+        dict or None
+            A copy of the cached diagnoses of the note, or None if they are not cached
+
+        """
+        result = self.cache.get(self.key(text))
+        if result is None:
+            return None
+        return {disease: list(factors) for disease, factors in result.items()}
+
+    def put(self, text: str, result: dict) -> None:
+        """
+        Remember the diagnoses of a clinical note, as output by DiagnosisDetector.give_diagnosis
+        """
+        self.cache.put(self.key(text), {disease: list(factors) for disease, factors in result.items()})
+
+    def save(self) -> None:
+        """
+        Save the cache to self.path, if it is set
+        """
+        if self.path is not None:
+            self.cache.save(self.path)
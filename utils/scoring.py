@@ -0,0 +1,274 @@
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import Iterable, List, Tuple, Union
+from utils import text_utils
+
+# how each co-occurring factor contributes to the score of a disease
+# "overlap" counts the factors of the note which occur with the disease
+# "frequency" adds the fraction of the notes with the disease in which each factor occurs
+# "lift" adds the logarithm of the lift of each factor for the disease, ignoring factors with a lift below 1
+WEIGHTINGS = ['overlap', 'frequency', 'lift']
+
+
+class DifferentialScorer:
+    """
+    Ranks candidate primary diseases for the factors found in clinical notes, by the weighted overlap of the factors
+    of the note with the factors of each disease in the database, computed as sparse matrix products
+
+    Also serves as the inverted index from each factor to the diseases it occurs with, and matches the factors
+    of notes to those of diseases by integer factor id instead of comparing names
+
+    Attributes:
+        diseases: numpy ndarray
+            The names of the diseases, in the order of the rows of the database
+        factors: pandas Index
+            The factor vocabulary
+        counts: scipy.sparse.csr_matrix
+            Matrix of shape (len(diseases), len(factors)) whose entry (i, j) is the number of notes
+            in which factors[j] occurs with the primary disease diseases[i]
+        inverted: scipy.sparse.csr_matrix
+            The transpose of counts, whose row j holds the diseases that factors[j] occurs with
+        support: numpy ndarray
+            The number of notes with each disease as a primary disease
+        factor_ids: numpy ndarray
+            The ids of the factors of every disease, in the ranked order of the database, split by factor_indptr
+        factor_indptr: numpy ndarray
+            The offsets of the factors of each disease in factor_ids
+    """
+    def __init__(
+            self,
+            diseases: List[str],
+            factors: List[List[str]],
+            counts: List[List[int]],
+            lifts: List[List[float]],
+            support: Iterable[int]
+    ):
+        """
+        Builds the sparse matrices of the scorer from the columns of a disease database
+
+        Parameters
+        ----------
+        diseases: List[str]
+            The "disease" column of the database
+        factors: List[List[str]]
+            The "factors" column of the database
+        counts: List[List[int]]
+            The "counts" column of the database, the number of notes of each factor of each disease
+        lifts: List[List[float]]
+            The "lifts" column of the database, the lift of each factor of each disease
+        support: Iterable[int]
+            The "support" column of the database, the number of notes of each disease
+        """
+        self.diseases = np.asarray(diseases, dtype=object)
+
+        # one CSR row per disease, with the factors of the row as column ids
+        indptr = np.zeros(len(factors) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in factors], out=indptr[1:])
+        codes, vocabulary = pd.factorize(pd.Series(list(itertools.chain.from_iterable(factors)), dtype=object))
+        self.factors = pd.Index(vocabulary)
+        shape = (len(diseases), len(vocabulary))
+
+        # keep the ranked order of the factors of each disease, which sparse matrix operations may sort
+        self.factor_ids = codes.astype(np.int64)
+        self.factor_indptr = indptr
+        self._factor_names = np.asarray(vocabulary, dtype=object)
+
+        def matrix(values: List[list]) -> sparse.csr_matrix:
+            data = np.fromiter(itertools.chain.from_iterable(values), dtype=np.float64, count=indptr[-1])
+            return sparse.csr_matrix((data, codes.copy(), indptr.copy()), shape=shape)
+
+        self.counts = matrix(counts)
+        self.inverted = self.counts.T.tocsr()
+        self.support = np.asarray(list(support), dtype=np.float64)
+        self._lifts = matrix(lifts)
+
+        # normalized factor names, to look up the factors found by the NER model
+        self._factor_ids = {}
+        for factor_id, factor in enumerate(self.factors):
+            self._factor_ids.setdefault(text_utils.normalize_name(factor), factor_id)
+        self._weights = {}
+
+    @classmethod
+    def from_database(cls, database) -> 'DifferentialScorer':
+        """
+        Builds the scorer of a disease database
+        Databases created before counts were stored weigh every factor of a disease equally
+
+        Parameters
+        ----------
+        database: pandas DataFrame or utils.storage.CompactDatabase
+            A database as output by utils.df_utils.create_disease_df
+
+        Returns
+        -------
+        DifferentialScorer
+            The scorer of the database
+
+        """
+        factors = list(database['factors'])
+        if 'counts' not in database:
+            ones = [[1] * len(row) for row in factors]
+            return cls(list(database['disease']), factors, ones, ones, [1] * len(factors))
+        return cls(
+            list(database['disease']),
+            factors,
+            list(database['counts']),
+            list(database['lifts']),
+            database['support']
+        )
+
+    def weights(self, weighting: str) -> sparse.csr_matrix:
+        """
+        The matrix of the contribution of each factor to the score of each disease, computed once per weighting
+
+        Parameters
+        ----------
+        weighting: str
+            One of WEIGHTINGS
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+            Matrix with the shape and sparsity of self.counts
+
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f'Unknown weighting {weighting}, expected one of {WEIGHTINGS}')
+        if weighting not in self._weights:
+            if weighting == 'overlap':
+                data = np.ones_like(self.counts.data)
+            elif weighting == 'frequency':
+                rows = np.repeat(np.arange(self.counts.shape[0]), np.diff(self.counts.indptr))
+                data = self.counts.data / np.maximum(self.support[rows], 1)
+            else:
+                data = np.log(np.maximum(self._lifts.data, 1))
+            self._weights[weighting] = sparse.csr_matrix(
+                (data, self.counts.indices, self.counts.indptr), shape=self.counts.shape
+            )
+        return self._weights[weighting]
+
+    def factor_id(self, factor: str) -> Union[int, None]:
+        return self._factor_ids.get(text_utils.normalize_name(factor))
+
+    def find_diseases(self, factor: str, top_k: int = None) -> List[str]:
+        """
+        Find the diseases which a factor occurs with, through the inverted index
+
+        Parameters
+        ----------
+        factor: str
+            The canonical name of a factor
+        top_k: int (default=None)
+            If given, at most this many diseases are returned
+
+        Returns
+        -------
+        List[str]
+            The diseases the factor occurs with, from the most to the least notes, with ties in database order
+
+        """
+        factor_id = self.factor_id(factor)
+        if factor_id is None:
+            return []
+        start, end = self.inverted.indptr[factor_id], self.inverted.indptr[factor_id + 1]
+        rows = self.inverted.indices[start:end]
+        order = np.lexsort((rows, -self.inverted.data[start:end]))
+        return self.diseases[rows[order[:top_k]]].tolist()
+
+    def factor_mask(self, factors: Iterable[str]) -> np.ndarray:
+        """
+        The bitset of the factors of a note over the factor vocabulary, factors not in the vocabulary are left out
+        """
+        mask = np.zeros(len(self.factors), dtype=bool)
+        ids = [self.factor_id(factor) for factor in factors]
+        mask[[factor_id for factor_id in ids if factor_id is not None]] = True
+        return mask
+
+    def match_factors(self, rows: Iterable[Union[int, None]], factors: Iterable[str]) -> List[List[str]]:
+        """
+        Find the factors of a note which occur with each of its primary diseases in the database
+
+        Parameters
+        ----------
+        rows: Iterable[int or None]
+            The rows of the primary diseases of the note in the database, or None for diseases not in it
+        factors: Iterable[str]
+            The canonical names of the factors found in the note
+
+        Returns
+        -------
+        List[List[str]]
+            For each row, the factors of its disease which were found in the note, in the ranked order of the database
+            The names are only looked up for the matching factors
+
+        """
+        mask = self.factor_mask(factors)
+        matched = []
+        for row in rows:
+            if row is None:
+                matched.append([])
+                continue
+            ids = self.factor_ids[self.factor_indptr[row]:self.factor_indptr[row + 1]]
+            matched.append(self._factor_names[ids[mask[ids]]].tolist())
+        return matched
+
+    def note_matrix(self, factor_lists: Iterable[Iterable[str]]) -> sparse.csr_matrix:
+        """
+        The incidence matrix of the factors of notes, with a row per note and a column per factor of the vocabulary
+        Factors which are not in the vocabulary are left out
+        """
+        indptr, indices = [0], []
+        for factors in factor_lists:
+            ids = {self.factor_id(factor) for factor in factors}
+            ids.discard(None)
+            indices.extend(sorted(ids))
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.ones(len(indices)), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, len(self.factors))
+        )
+
+    def score_batch(
+            self,
+            factor_lists: Iterable[Iterable[str]],
+            weighting: str = 'frequency',
+            top_k: int = 10
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Rank the candidate primary diseases of many notes with one sparse matrix product
+
+        Parameters
+        ----------
+        factor_lists: Iterable[Iterable[str]]
+            For each note, the canonical names of the factors found in it
+        weighting: str (default='frequency')
+            One of WEIGHTINGS, how much each shared factor adds to the score of a disease
+        top_k: int (default=10)
+            The maximum number of diseases returned per note, or None for all diseases with a positive score
+
+        Returns
+        -------
+        List[List[Tuple[str, float]]]
+            For each note, pairs of a disease and its score, from the highest to the lowest score
+            Diseases without a shared factor are left out
+
+        """
+        # note x disease scores, only nonzero for diseases which share a factor with the note
+        scores = (self.note_matrix(factor_lists) @ self.weights(weighting).T).tocsr()
+        scores.eliminate_zeros()
+
+        ranked = []
+        for note in range(scores.shape[0]):
+            start, end = scores.indptr[note], scores.indptr[note + 1]
+            rows, values = scores.indices[start:end], scores.data[start:end]
+            order = np.lexsort((rows, -values))[:top_k]
+            ranked.append(list(zip(self.diseases[rows[order]].tolist(), values[order].tolist())))
+        return ranked
+
+    def score(self, factors: Iterable[str], weighting: str = 'frequency', top_k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Rank the candidate primary diseases of a single note, see self.score_batch
+        """
+        return self.score_batch([factors], weighting, top_k)[0]
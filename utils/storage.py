@@ -0,0 +1,255 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Union
+
+# version of the compact format, stored in its metadata
+COMPACT_VERSION = 1
+
+# kinds of columns in the compact format
+STR_KIND = 'str'
+STR_LIST_KIND = 'str_list'
+INT_LIST_KIND = 'int_list'
+FLOAT_LIST_KIND = 'float_list'
+NUMERIC_KIND = 'numeric'
+
+
+def _column_kind(column: pd.Series) -> str:
+    # numeric columns are stored as they are
+    if column.dtype != object:
+        return NUMERIC_KIND
+
+    # object columns hold strings or lists, identified by their first non empty value
+    values = [value for value in column if value is not None]
+    if not values or isinstance(values[0], str):
+        return STR_KIND
+    for value in values:
+        if len(value) > 0:
+            if isinstance(value[0], str):
+                return STR_LIST_KIND
+            return FLOAT_LIST_KIND if isinstance(value[0], (float, np.floating)) else INT_LIST_KIND
+    return STR_LIST_KIND
+
+
+def save_compact(disease_db: pd.DataFrame, path: str) -> None:
+    """
+    Save a DataFrame in the compact format
+        Every distinct string is stored once in a table of UTF-8 bytes with integer offsets
+        String columns are stored as integer ids into that table, -1 for missing values
+        List columns are stored in CSR form, as an offset array "indptr" into a flat array of ids or values
+    All arrays are .npy files which CompactDatabase memory-maps
+    The directory is replaced atomically, so processes which have the old files mapped keep a consistent view
+
+    Parameters
+    ----------
+    disease_db: pandas DataFrame
+        A DataFrame whose columns hold numbers, strings, or lists of strings or numbers,
+        such as the output of utils.df_utils.create_disease_df
+    path: str
+        The directory to save to
+    """
+    kinds = {name: _column_kind(disease_db[name]) for name in disease_db.columns}
+
+    # intern every string of the string and string list columns
+    string_ids = {}
+    for name, kind in kinds.items():
+        if kind == STR_KIND:
+            values = disease_db[name]
+        elif kind == STR_LIST_KIND:
+            values = (value for values in disease_db[name] for value in values)
+        else:
+            continue
+        for value in values:
+            if value is not None and value not in string_ids:
+                string_ids[value] = len(string_ids)
+
+    # write into a temporary directory and swap it in at the end
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    encoded = [string.encode('utf-8') for string in string_ids]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    np.save(os.path.join(tmp_path, 'strings.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save(os.path.join(tmp_path, 'string_offsets.npy'), offsets)
+
+    for name, kind in kinds.items():
+        column = disease_db[name]
+        if kind == NUMERIC_KIND:
+            np.save(os.path.join(tmp_path, f'{name}.npy'), column.to_numpy())
+        elif kind == STR_KIND:
+            ids = [string_ids[value] if value is not None else -1 for value in column]
+            np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(ids, dtype=np.int32))
+        else:
+            indptr = np.zeros(len(column) + 1, dtype=np.int64)
+            np.cumsum([len(values) for values in column], out=indptr[1:])
+            flat = [value for values in column for value in values]
+            if kind == STR_LIST_KIND:
+                flat = np.asarray([string_ids[value] for value in flat], dtype=np.int32)
+            else:
+                flat = np.asarray(flat, dtype=np.float64 if kind == FLOAT_LIST_KIND else np.int64)
+            np.save(os.path.join(tmp_path, f'{name}_indptr.npy'), indptr)
+            np.save(os.path.join(tmp_path, f'{name}_values.npy'), flat)
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump({
+            'version': COMPACT_VERSION,
+            'n_rows': len(disease_db),
+            'columns': [{'name': name, 'kind': kind} for name, kind in kinds.items()]
+        }, file)
+
+    # swap the new directory in place of the old one
+    old_path = path.rstrip(os.sep) + '.old'
+    if os.path.isdir(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class CompactDatabase:
+    """
+    A read only table saved by save_compact, whose arrays are memory-mapped
+    and whose strings are only decoded when they are looked up
+
+    Since the arrays are memory-mapped, loading takes milliseconds
+    and processes which load the same files share them through the page cache
+
+    Attributes:
+        path: str
+            The directory the table was loaded from
+        columns: List[str]
+            The names of the columns
+    """
+    def __init__(self, path: str):
+        """
+        Memory-maps a table saved by save_compact
+
+        Parameters
+        ----------
+        path: str
+            The directory the table was saved to
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        if meta['version'] != COMPACT_VERSION:
+            raise ValueError(f'Unsupported compact database version {meta["version"]}')
+
+        self._n_rows = meta['n_rows']
+        self._kinds = {column['name']: column['kind'] for column in meta['columns']}
+        self.columns = list(self._kinds)
+
+        self._strings = self._load('strings')
+        self._string_offsets = self._load('string_offsets')
+        self._arrays = {}
+        for name, kind in self._kinds.items():
+            if kind in (NUMERIC_KIND, STR_KIND):
+                self._arrays[name] = self._load(name)
+            else:
+                self._arrays[name] = (self._load(f'{name}_indptr'), self._load(f'{name}_values'))
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return self._n_rows
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._kinds
+
+    def __getitem__(self, name: str) -> list:
+        """
+        Decode a whole column
+
+        Parameters
+        ----------
+        name: str
+            The name of the column
+
+        Returns
+        -------
+        list
+            The values of the column, in row order
+
+        """
+        return [self.row(name, row) for row in range(self._n_rows)]
+
+    def array(self, name: str) -> np.ndarray:
+        """
+        The memory-mapped array of a numeric column, without copying it
+        """
+        if self._kinds[name] != NUMERIC_KIND:
+            raise ValueError(f'Column {name} is not numeric')
+        return self._arrays[name]
+
+    def string(self, string_id: int) -> Union[str, None]:
+        """
+        Decode a string of the string table
+
+        Parameters
+        ----------
+        string_id: int
+            The id of the string
+
+        Returns
+        -------
+        str or None
+            The string, or None for the id -1 of missing values
+
+        """
+        if string_id < 0:
+            return None
+        start, end = self._string_offsets[string_id], self._string_offsets[string_id + 1]
+        return self._strings[start:end].tobytes().decode('utf-8')
+
+    def row(self, name: str, row: int) -> Union[str, float, int, List, None]:
+        """
+        Decode the value of one row of a column
+
+        Parameters
+        ----------
+        name: str
+            The name of the column
+        row: int
+            The position of the row
+
+        Returns
+        -------
+        str, float, int, List, or None
+            The value as it was in the saved DataFrame
+
+        """
+        kind = self._kinds[name]
+        if kind == NUMERIC_KIND:
+            return self._arrays[name][row].item()
+        if kind == STR_KIND:
+            return self.string(int(self._arrays[name][row]))
+
+        indptr, values = self._arrays[name]
+        values = values[indptr[row]:indptr[row + 1]]
+        if kind == STR_LIST_KIND:
+            return [self.string(int(string_id)) for string_id in values]
+        return values.tolist()
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Decode the whole table
+
+        Returns
+        -------
+        pandas DataFrame
+            The DataFrame which was saved
+
+        """
+        return pd.DataFrame({
+            name: np.asarray(self._arrays[name]) if kind == NUMERIC_KIND else self[name]
+            for name, kind in self._kinds.items()
+        }, columns=self.columns)
+
+
+def is_compact(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, 'meta.json'))
@@ -1,7 +1,26 @@
+import re
+import bisect
 import pandas as pd
-from typing import Tuple, Union, List
+from functools import lru_cache
+from typing import Tuple, Union, List, Dict, NamedTuple, Pattern, Callable, Iterable
 from nlp import DiseaseSearcher
 
+# the headers of the sections of a clinical note which are searched for diseases
+DIAGNOSIS_HEADERS = ('Discharge Diagnosis', 'Discharge Diagnoses', 'Final Discharge Diagnosis', 'Final Discharge Diagnoses')
+HISTORY_HEADERS = ('History of Present Illness',)
+COMPLAINT_HEADERS = ('Chief Complaint',)
+SECTION_HEADERS = DIAGNOSIS_HEADERS + HISTORY_HEADERS + COMPLAINT_HEADERS
+
+# the number of notes whose section indices are kept for repeated lookups
+SECTION_CACHE_SIZE = 256
+
+# default number of characters in each window of a long text, and shared by consecutive windows
+DEFAULT_WINDOW_SIZE = 2000
+DEFAULT_WINDOW_OVERLAP = 200
+
+# the end of a sentence or of a line, after which a window may start
+_SENTENCE_BREAK = re.compile(r'[.!?;]\s+|\n\s*')
+
 
 def load_text(file_path: str) -> str:
     """
@@ -22,6 +41,108 @@ def load_text(file_path: str) -> str:
     return text
 
 
+class SectionIndex(NamedTuple):
+    """
+    Character offsets of the known section headers in a clinical note
+
+    Attributes:
+        chunks: Dict[str, Tuple[int, int]]
+            For each header, the start and end of the first chunk of text separated by empty lines
+            which starts with the header, with surrounding whitespace left out
+        lines: Dict[str, Union[Tuple[int, int], None]]
+            For each header, the start and end of the line after the first line containing the header,
+            or None if that line is the last line of the note
+    """
+    chunks: Dict[str, Tuple[int, int]]
+    lines: Dict[str, Union[Tuple[int, int], None]]
+
+
+def _with_uppercase(headers: Tuple[str, ...]) -> Tuple[str, ...]:
+    # add uppercase version of the headers since some notes have sections in all caps
+    return headers + tuple(header.upper() for header in headers if header.upper() not in headers)
+
+
+@lru_cache(maxsize=None)
+def _compile_headers(headers: Tuple[str, ...]) -> Tuple[Pattern, Dict[str, Tuple[str, ...]]]:
+    """
+    Compiles the pattern used to find and remove a set of headers, once per set of headers
+    Parameters
+    ----------
+    headers: Tuple[str, ...]
+        The headers to be found, including their uppercase variants
+
+    Returns
+    -------
+    Tuple[Pattern, Dict[str, Tuple[str, ...]]]
+        A tuple of:
+            1. A pattern matching the headers, longest first
+            2. For each header, the headers it starts with, including itself
+
+    """
+    alternatives = '|'.join(re.escape(header) for header in sorted(set(headers), key=len, reverse=True))
+    prefixes = {header: tuple(other for other in headers if header.startswith(other)) for header in headers}
+    return re.compile(alternatives), prefixes
+
+
+@lru_cache(maxsize=SECTION_CACHE_SIZE)
+def segment_sections(text: str, headers: Tuple[str, ...] = SECTION_HEADERS) -> SectionIndex:
+    """
+    Scans a clinical note once for all the given headers and records where their sections are
+    Parameters
+    ----------
+    text: str
+        Text to be searched through
+    headers: Tuple[str, ...] (default=SECTION_HEADERS)
+        The headers to be found, their uppercase variants are found as well
+
+    Returns
+    -------
+    SectionIndex
+        The offsets of the chunks starting with and the lines following each header found in the text
+        The most recent indices are cached, so the different sections of a note are found with one scan
+
+    """
+    finder, prefixes = _compile_headers(_with_uppercase(headers))
+
+    # find where the chunks separated by blank lines start and end once their whitespace is stripped
+    chunk_ends = {}
+    position = 0
+    for chunk in text.split('\n\n'):
+        start = position + len(chunk) - len(chunk.lstrip())
+        chunk_ends[start] = position + len(chunk.rstrip())
+        position += len(chunk) + 2
+
+    # record the first chunk starting with and the first line containing each header
+    # each search starts right after the previous match started, so headers overlapping a match are found too
+    chunks, lines = {}, {}
+    match = finder.search(text)
+    while match is not None:
+        position = match.start()
+        found = prefixes[match.group()]
+        if position in chunk_ends:
+            for header in found:
+                chunks.setdefault(header, (position, chunk_ends[position]))
+        if any(header not in lines for header in found):
+            line_end = text.find('\n', position)
+            if line_end == -1:
+                next_line = None
+            else:
+                next_end = text.find('\n', line_end + 1)
+                next_line = (line_end + 1, len(text) if next_end == -1 else next_end)
+            for header in found:
+                lines.setdefault(header, next_line)
+        match = finder.search(text, position + 1)
+    return SectionIndex(chunks, lines)
+
+
+_KNOWN_HEADERS = frozenset(_with_uppercase(SECTION_HEADERS))
+
+
+def _headers_for(category: Tuple[str, ...]) -> Tuple[str, ...]:
+    # look the known headers up in the shared index, and scan for any others separately
+    return SECTION_HEADERS if set(category) <= _KNOWN_HEADERS else category
+
+
 def contains_category(text: str, category: Tuple[str, ...]) -> Union[str, None]:
     """
     Searches a text for line containing given categories
@@ -38,18 +159,17 @@ def contains_category(text: str, category: Tuple[str, ...]) -> Union[str, None]:
         Returns line after the first line containing one of the categories if one is found
         Otherwise returns None
     """
-    # add uppercase version of the categories since some notes have sections in all caps
-    category += tuple([x.upper() for x in category])
+    index = segment_sections(text, _headers_for(category))
 
-    # split text into lines
-    lines = text.split('\n')
+    # take the line after the earliest line containing one of the categories
+    lines = [index.lines[cat] for cat in _with_uppercase(category) if cat in index.lines]
+    next_lines = [line for line in lines if line is not None]
 
-    # search for category in lines, and return the following line
-    for index, line in enumerate(lines):
-        for cat in category:
-            if cat in line:
-                return lines[index + 1].strip()
-    return None
+    # a category on the last line of the note has no following line
+    if not next_lines:
+        return None
+    start, end = min(next_lines)
+    return text[start:end].strip()
 
 
 def get_category(text: str, category: Tuple[str, ...]) -> Union[str, None]:
@@ -68,26 +188,37 @@ def get_category(text: str, category: Tuple[str, ...]) -> Union[str, None]:
         Returns the first chunk of text to start with one of the given categories if any are found
         Otherwise returns None
     """
-    # add uppercase version of the categories since some notes have sections in all caps
-    category += tuple([x.upper() for x in category])
+    category = _with_uppercase(category)
+    index = segment_sections(text, _headers_for(category))
 
-    # split the text into chunks separated by blank lines
-    categories = text.split('\n\n')
+    # find the earliest chunk that starts with one of our categories
+    spans = [index.chunks[cat] for cat in category if cat in index.chunks]
 
-    # find chunks that start with our category
-    category_chunks = [chunk.strip() for chunk in categories if chunk.strip().startswith(category)]
+    # if we don't find any chunks, return nothing
+    if not spans:
+        return None
 
-    # if we find chunks, iterate through them and remove their titles
-    if category_chunks:
-        category_chunk = category_chunks[0]
-        for cat in category:
-            category_chunk = category_chunk.replace(cat, '')
-        category_chunk = category_chunk.strip(':').strip()
+    # remove the titles from the chunk, longest first so that no part of a longer title is left behind
+    start, end = min(spans)
+    remover, _ = _compile_headers(category)
+    return remover.sub('', text[start:end]).strip(':').strip()
 
-    # if we don't find any chunks, return nothing
-    else:
-        category_chunk = None
-    return category_chunk
+
+def normalize_name(name: str) -> str:
+    """
+    Normalizes the name of a disease for lookups
+    Parameters
+    ----------
+    name: str
+        The name of a disease
+
+    Returns
+    -------
+    str
+        The lowercased name with surrounding whitespace removed and inner whitespace collapsed to single spaces
+
+    """
+    return ' '.join(name.lower().split())
 
 
 def find_primary_diagnoses(diagnosis: str) -> str:
@@ -140,6 +271,28 @@ def find_factors(
         List of canonical names of illnesses found in the diagnosis, history, and complaint that are not
         found in the primary diagnosis
 
+    """
+    full_context = build_context(diagnosis, history, complaint)
+    return searcher.get_factors(full_context, primary_diseases)
+
+
+def build_context(diagnosis: str, history: Union[str, None], complaint: Union[str, None]) -> str:
+    """
+    Combines the sections of a clinical note that are searched for underlying factors
+    Parameters
+    ----------
+    diagnosis: str
+        Text pertaining to the diagnoses of a patient
+    history: str
+        Text pertaining to the history of the present illness
+    complaint: str
+        Text pertaining to the chief complaint of the patient
+
+    Returns
+    -------
+    str
+        The lowercased diagnosis, history, and complaint joined by spaces
+
     """
     # turn empty sections into empty strings
     if not history:
@@ -147,5 +300,166 @@ def find_factors(
     if not complaint:
         complaint = ''
 
-    full_context = diagnosis.lower() + ' ' + history.lower() + ' ' + complaint.lower()
-    return searcher.get_factors(full_context, primary_diseases)
+    return diagnosis.lower() + ' ' + history.lower() + ' ' + complaint.lower()
+
+
+def build_routed_context(
+        diagnosis: str,
+        history: Union[str, None],
+        complaint: Union[str, None]
+) -> Tuple[str, Tuple[int, int]]:
+    """
+    Combines the sections of a clinical note that are searched for diseases into a single text,
+    keeping track of where the primary diagnoses are so that one NER pass can serve both
+    the primary diseases and the underlying factors
+    Parameters
+    ----------
+    diagnosis: str
+        Text pertaining to the diagnoses of a patient
+    history: str
+        Text pertaining to the history of the present illness
+    complaint: str
+        Text pertaining to the chief complaint of the patient
+
+    Returns
+    -------
+    Tuple[str, Tuple[int, int]]
+        A tuple of:
+            1. The same text as build_context
+            2. The start and end character offsets in that text of the primary diagnoses,
+               as found by find_primary_diagnoses
+
+    """
+    return build_context(diagnosis, history, complaint), primary_span(diagnosis)
+
+
+def primary_span(diagnosis: str) -> Tuple[int, int]:
+    """
+    Finds where the primary diagnoses are in the text output by build_context, without building it
+    Parameters
+    ----------
+    diagnosis: str
+        Text pertaining to the diagnoses of a patient
+
+    Returns
+    -------
+    Tuple[int, int]
+        The start and end character offsets of the primary diagnoses, as found by find_primary_diagnoses
+
+    """
+    # the context starts with the lowercased diagnosis, whose primary part is everything before 'secondary'
+    primary_diagnosis = diagnosis.lower().split('secondary')[0]
+    start = len(primary_diagnosis) - len(primary_diagnosis.lstrip())
+    return start, start + len(primary_diagnosis.strip())
+
+
+def split_windows(
+        text: str,
+        window_size: int = DEFAULT_WINDOW_SIZE,
+        overlap: int = DEFAULT_WINDOW_OVERLAP
+) -> List[Tuple[int, int]]:
+    """
+    Splits a long text into overlapping windows which start and end at sentence boundaries,
+    falling back to word boundaries within sentences longer than a window
+    Parameters
+    ----------
+    text: str
+        A text, such as the output of build_context
+    window_size: int (default=DEFAULT_WINDOW_SIZE)
+        The maximum number of characters in a window
+    overlap: int (default=DEFAULT_WINDOW_OVERLAP)
+        The maximum number of characters a window shares with the previous one,
+        so that entities at the boundary of a window are seen whole by its neighbor
+
+    Returns
+    -------
+    List[Tuple[int, int]]
+        The start and end character offsets of the windows, in order
+        A text of at most window_size characters is a single window
+
+    """
+    if not 0 <= overlap < window_size:
+        raise ValueError(f'The overlap {overlap} must be at least 0 and less than the window size {window_size}')
+    if len(text) <= window_size:
+        return [(0, len(text))]
+    breaks = [match.end() for match in _SENTENCE_BREAK.finditer(text)]
+
+    windows = []
+    start = 0
+    while start + window_size < len(text):
+        # end at the last sentence break which fits in the window, or else the last word break
+        limit = start + window_size
+        index = bisect.bisect_right(breaks, limit) - 1
+        if index >= 0 and breaks[index] > start:
+            end = breaks[index]
+        else:
+            space = text.rfind(' ', start + 1, limit)
+            end = space + 1 if space != -1 else limit
+        windows.append((start, end))
+
+        # start the next window at the first sentence break within the overlap, or else the first word break
+        index = bisect.bisect_left(breaks, max(end - overlap, start + 1))
+        if index < len(breaks) and breaks[index] < end:
+            start = breaks[index]
+        else:
+            space = text.find(' ', max(end - overlap, start + 1), end)
+            start = space + 1 if space != -1 else end
+    windows.append((start, len(text)))
+    return windows
+
+
+def find_mentions_windowed(
+        texts: Iterable[str],
+        searcher: DiseaseSearcher,
+        window_size: int = DEFAULT_WINDOW_SIZE,
+        overlap: int = DEFAULT_WINDOW_OVERLAP,
+        map_windows: Callable[[List[str]], List[list]] = None
+) -> List[List[Tuple[int, int, str]]]:
+    """
+    Finds the linked diseases of long texts by running the NER model on their windows, see split_windows,
+    and merging the entities found in the windows of each text
+
+    An entity in the overlap of two windows is kept from the window whose edge it is farthest from,
+    so it is neither counted twice nor taken from a window which cuts it off
+    Parameters
+    ----------
+    texts: Iterable[str]
+        Texts such as the output of build_context
+    searcher: DiseaseSearcher
+        A NER model linked to a medical database, used if map_windows is not given
+    window_size: int (default=DEFAULT_WINDOW_SIZE)
+        The maximum number of characters in a window
+    overlap: int (default=DEFAULT_WINDOW_OVERLAP)
+        The maximum number of characters a window shares with the previous one
+    map_windows: Callable (default=None)
+        A function giving the output of DiseaseSearcher.get_mentions_batch for a list of windows,
+        such as utils.parallel.WindowPool.map which runs them in parallel
+        If not given, the windows go through searcher one after the other
+
+    Returns
+    -------
+    List[List[Tuple[int, int, str]]]
+        For each text, the start and end character offsets in the text and the canonical name of each linked
+        disease, in order, as output by DiseaseSearcher.mentions for the whole text
+
+    """
+    texts = list(texts)
+    windows = [split_windows(text, window_size, overlap) for text in texts]
+    window_texts = [text[start:end] for text, spans in zip(texts, windows) for start, end in spans]
+    if map_windows is None:
+        window_mentions = iter(searcher.get_mentions_batch(window_texts))
+    else:
+        window_mentions = iter(map_windows(window_texts))
+
+    merged = []
+    for text, spans in zip(texts, windows):
+        mentions = []
+        for index, (start, end) in enumerate(spans):
+            # each window owns the text between the middles of its overlaps with its neighbors
+            first = start if index == 0 else (start + spans[index - 1][1]) // 2
+            last = len(text) if index == len(spans) - 1 else (spans[index + 1][0] + end) // 2
+            for mention_start, mention_end, name in next(window_mentions):
+                if first <= start + mention_start < last:
+                    mentions.append((start + mention_start, start + mention_end, name))
+        merged.append(mentions)
+    return merged